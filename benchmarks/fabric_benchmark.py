@@ -0,0 +1,349 @@
+''' fabric_benchmark.py
+
+    Load generator and latency benchmark.
+
+    Starts a service registry, a number of service containers hosting an
+    echo service and a number of clients in this process, each end-point
+    running its poll loop on a thread of its own, then drives requests
+    through them and reports throughput, latency percentiles, CPU time per
+    request and memory use as JSON, one record per scenario, so results
+    can be kept and compared across changes.
+
+        PYTHONPATH=src python benchmarks/fabric_benchmark.py \\
+            --transport ipc --containers 2 --clients 4 --workers 4 \\
+            --payload 64 4096 --concurrency 1 32 --fanout 1 4 \\
+            --output results.json
+
+    A scenario is run for every combination of --payload, --concurrency
+    and --fanout.  Each client keeps concurrency operations in flight; an
+    operation sends one request to each of fanout service paths, all hosted
+    by every container, and completes once all of them have replied.
+
+    Everything runs in one process, so the numbers include the clients'
+    own overhead and contend for the same interpreter lock; they are meant
+    for comparing revisions on the same machine, not as absolute figures.
+'''
+from __future__ import print_function
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zmq
+
+from zen.fabric import service_registry
+from zen.fabric.service import Service
+from zen.fabric.service_client import ServiceClient
+from zen.fabric.service_container import ServiceContainer
+from zen.fabric.service_registry.service import ServiceRegistry
+from zen.fabric.task_schedule import clock
+from zen.fabric.transport import INPROC, IPC
+
+# Milliseconds each poll loop waits at most
+PACING = 100
+
+
+class Echo(Service):
+    ''' Service the benchmark requests are sent to '''
+    def echo(self, payload):
+        return { 'payload' : payload }
+
+    def work(self, payload, iterations):
+        ''' Spend some CPU before replying '''
+        total = 0
+        for i in range(iterations):
+            total += i
+        return { 'payload' : payload }
+
+
+class Driver(object):
+    ''' Driver
+
+        Keeps a client's operations in flight and records their latency.
+        Runs on the client's poll loop thread.
+    '''
+    def __init__(self, client, requests, operations, concurrency, done):
+        self._client = client
+        # Requests making up each operation
+        self._requests = requests
+        self._remaining = operations
+        self._concurrency = concurrency
+        self._done = done
+        self._in_flight = 0
+        self.latencies = []
+        self.errors = 0
+
+    def start(self):
+        for i in range(min(self._concurrency, self._remaining)):
+            self._next()
+
+    def _next(self):
+        self._remaining -= 1
+        self._in_flight += 1
+        started = clock()
+        pending = [len(self._requests)]
+
+        def replied(reply):
+            if not isinstance(reply, dict) or reply.get('status') == 'error':
+                self.errors += 1
+            pending[0] -= 1
+            if not pending[0]:
+                self._finished(started)
+
+        def failed(failure):
+            replied(None)
+
+        for request in self._requests:
+            self._client.send_request(request).addCallbacks(replied, failed)
+
+    def _finished(self, started):
+        self.latencies.append(clock() - started)
+        self._in_flight -= 1
+        if self._remaining > 0:
+            self._next()
+        elif not self._in_flight:
+            self._done.set()
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss():
+    ''' Peak resident set size of the process, in bytes '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Fabric(object):
+    ''' The registry, containers and clients under test '''
+    def __init__(self, options):
+        # One context, so inproc:// addresses are reachable everywhere
+        self.context = zmq.Context()
+        self._threads = []
+        self._endpoints = []
+        # Socket files of ipc:// addresses, removed on shutdown
+        self._ipc_files = []
+
+        self.registry = self._container(options.transport)
+        address, port = self._address(options.transport, 'registry')
+        self.registry.init(address, port)
+        self.registry.register_service(ServiceRegistry(), service_registry.PATH, localOnly=True)
+        srap = (address if '://' in address
+                else '127.0.0.1:{0}'.format(self.registry._request_port))
+        self._start(self.registry)
+
+        self.paths = ['/bench/echo/{0}'.format(index) for index in range(max(options.fanout))]
+        self.containers = []
+        for index in range(options.containers):
+            container = self._container(options.transport)
+            container.COMPRESS_THRESHOLD = options.compress_threshold
+            address, port = self._address(options.transport, 'container-{0}'.format(index))
+            container.init(address, port, srap, workers=options.workers)
+            for path in self.paths:
+                container.register_service(Echo(), path)
+            self.containers.append(container)
+            self._start(container)
+
+        self.clients = []
+        for index in range(options.clients):
+            client = ServiceClient(self.context)
+            if options.codec:
+                client.CODECS = (options.codec,)
+            if options.compression:
+                client.COMPRESSIONS = (options.compression,)
+                client.COMPRESS_THRESHOLD = options.compress_threshold
+            client.init(srap)
+            self.clients.append(client)
+            self._start(client)
+
+    def _container(self, transport):
+        ''' A container reached over transport only; with 'auto' it also
+            binds ipc and inproc and clients choose.
+        '''
+        container = ServiceContainer(self.context)
+        if transport == 'auto':
+            container.LOCAL_TRANSPORTS = (IPC, INPROC)
+        else:
+            container.LOCAL_TRANSPORTS = ()
+        return container
+
+    def _address(self, transport, name):
+        ''' Address and port to bind a container (or the registry) to; a
+            random port for tcp, and no port for ipc:// and inproc://
+        '''
+        if transport in ('tcp', 'auto'):
+            return '127.0.0.1', None
+        if transport == 'ipc':
+            path = os.path.join(tempfile.gettempdir(), 'zen-bench-{0}-{1}.ipc'.format(name, uuid.uuid4().hex))
+            self._ipc_files.append(path)
+            return 'ipc://{0}'.format(path), None
+        return 'inproc://zen-bench-{0}'.format(name), None
+
+    def _start(self, endpoint):
+        thread = threading.Thread(target=endpoint.run, args=(PACING,))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        self._endpoints.append(endpoint)
+
+    def call(self, endpoint, func, *args):
+        ''' Call func(*args) on the poll loop of endpoint '''
+        endpoint.call_soon_threadsafe(func, *args)
+
+    def shutdown(self):
+        for endpoint in reversed(self._endpoints):
+            self.call(endpoint, endpoint.shutdown)
+        for thread in self._threads:
+            thread.join(PACING / 1000.0 * 10)
+        for path in self._ipc_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def run_scenario(fabric, options, payload_size, concurrency, fanout):
+    payload = 'x' * payload_size
+    requests = []
+    for path in fabric.paths[:fanout]:
+        if options.work:
+            requests.append({ 'path' : path, 'command' : 'work',
+                              'args' : { 'payload' : payload, 'iterations' : options.work } })
+        else:
+            requests.append({ 'path' : path, 'command' : 'echo', 'args' : { 'payload' : payload } })
+    operations = max(1, options.operations // len(fabric.clients))
+
+    # Warm up the connections and lookups, then measure
+    for count in (min(operations, options.warmup), operations):
+        if not count:
+            continue
+        gc.collect()
+        drivers = []
+        for client in fabric.clients:
+            done = threading.Event()
+            driver = Driver(client, requests, count, concurrency, done)
+            drivers.append((driver, done))
+        cpu_started = _cpu_time()
+        started = time.time()
+        for (driver, done), client in zip(drivers, fabric.clients):
+            fabric.call(client, driver.start)
+        for driver, done in drivers:
+            if not done.wait(options.timeout):
+                raise RuntimeError('Scenario did not complete within {0} seconds'.format(options.timeout))
+        elapsed = time.time() - started
+        cpu = _cpu_time() - cpu_started
+
+    latencies = sorted(itertools.chain.from_iterable(driver.latencies for driver, done in drivers))
+    completed = len(latencies)
+    return {
+        'scenario' : {
+            'payload' : payload_size,
+            'concurrency' : concurrency,
+            'fanout' : fanout,
+            'operations' : completed,
+            'requests' : completed * fanout,
+        },
+        'elapsed' : elapsed,
+        'operations_per_second' : completed / elapsed,
+        'requests_per_second' : completed * fanout / elapsed,
+        'errors' : sum(driver.errors for driver, done in drivers),
+        'latency' : {
+            'mean' : sum(latencies) / completed,
+            'p50' : _percentile(latencies, 0.5),
+            'p99' : _percentile(latencies, 0.99),
+            'p999' : _percentile(latencies, 0.999),
+            'max' : latencies[-1],
+        },
+        'cpu_per_request' : cpu / (completed * fanout),
+        'max_rss' : _max_rss(),
+    }
+
+
+def environment():
+    ''' Description of what the results were measured with '''
+    return {
+        'time' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python' : platform.python_version(),
+        'implementation' : platform.python_implementation(),
+        'pyzmq' : zmq.pyzmq_version(),
+        'zmq' : zmq.zmq_version(),
+        'platform' : platform.platform(),
+        'cpus' : os.sysconf('SC_NPROCESSORS_ONLN') if hasattr(os, 'sysconf') else None,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark zen.fabric request latency and throughput')
+    parser.add_argument('--transport', choices=('tcp', 'ipc', 'inproc', 'auto'), default='tcp',
+                        help="'auto' registers every transport and lets the clients pick the cheapest")
+    parser.add_argument('--containers', type=int, default=1, help='Number of service containers')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Worker threads per container; 0 handles requests one at a time')
+    parser.add_argument('--clients', type=int, default=1, help='Number of clients')
+    parser.add_argument('--payload', type=int, nargs='+', default=[64],
+                        help='Payload sizes, in bytes')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16],
+                        help='Operations in flight per client')
+    parser.add_argument('--fanout', type=int, nargs='+', default=[1],
+                        help='Requests per operation, each to a different path')
+    parser.add_argument('--operations', type=int, default=10000,
+                        help='Operations per scenario, across all clients')
+    parser.add_argument('--warmup', type=int, default=200, help='Operations per client before measuring')
+    parser.add_argument('--work', type=int, default=0,
+                        help='Loop iterations each request spends in the service')
+    parser.add_argument('--codec', help='Codec the clients send requests with')
+    parser.add_argument('--compression', help='Compression the clients use for requests and replies')
+    parser.add_argument('--compress-threshold', type=int, default=ServiceClient.COMPRESS_THRESHOLD,
+                        help='Smallest body, in bytes, the clients compress')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds a scenario may take')
+    parser.add_argument('--output', help='File to write the results to; standard output when omitted')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    fabric = Fabric(options)
+    try:
+        results = [run_scenario(fabric, options, payload, concurrency, fanout)
+                   for payload, concurrency, fanout in itertools.product(options.payload, options.concurrency,
+                                                                          options.fanout)]
+    finally:
+        fabric.shutdown()
+    report = {
+        'environment' : environment(),
+        'config' : {
+            'transport' : options.transport,
+            'containers' : options.containers,
+            'workers' : options.workers,
+            'clients' : options.clients,
+            'work' : options.work,
+            'codec' : options.codec,
+            'compression' : options.compression,
+        },
+        'results' : results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
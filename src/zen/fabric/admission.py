@@ -0,0 +1,164 @@
+''' admission.py
+
+    Admission control for the requests a ServiceContainer receives.
+
+    A container handles at most a limited number of requests at once, in
+    total and for each service path, and keeps the requests beyond that in
+    a queue of limited length, from which they are started highest priority
+    first.  A request arriving to a full queue displaces a queued request of
+    lower priority, or is rejected; either way the container replies to the
+    request it turns away with
+
+        { 'status' : 'error', 'error' : 'overloaded', 'message' : ... }
+
+    straight away, so callers find out in a round trip instead of waiting
+    behind a backlog that only grows.
+
+    Requests carry their priority in the 'priority' header parameter; see
+    ServiceEndpoint.REQUEST_PRIORITY.
+'''
+import collections
+
+# Request priorities; higher ones are started first
+LOW = -1
+NORMAL = 0
+HIGH = 1
+
+
+def priority_of(params):
+    ''' Priority of a request with the given header parameters '''
+    try:
+        return int(params.get('priority', NORMAL))
+    except ValueError:
+        return NORMAL
+
+
+class Admission(object):
+    ''' Admission
+
+        Bookkeeping of the requests being handled and of those waiting for
+        their turn.  The container decides what a request is; Admission only
+        holds them and says which to start and which to turn away.
+    '''
+    def __init__(self, max_concurrent=None, max_queued=None):
+        ''' Params
+            ======
+            max_concurrent : int, optional
+                Number of requests handled at once; unlimited when None.
+            max_queued : int, optional
+                Number of requests waiting to be handled; unlimited when
+                None.
+        '''
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        # path : (max concurrent, max queued)
+        self._path_limits = {}
+        self._running = 0
+        # path : number of its requests being handled
+        self._path_running = collections.Counter()
+        # priority : deque of (path, request), oldest first
+        self._queues = {}
+        self._queued = 0
+        # path : number of its requests waiting
+        self._path_queued = collections.Counter()
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def queued(self):
+        return self._queued
+
+    @property
+    def has_path_limits(self):
+        ''' True if requests must be admitted by path '''
+        return bool(self._path_limits)
+
+    def set_path_limits(self, path, max_concurrent=None, max_queued=None):
+        ''' Limit the requests for one path, on top of the overall limits '''
+        if max_concurrent is None and max_queued is None:
+            self._path_limits.pop(path, None)
+        else:
+            self._path_limits[path] = (max_concurrent, max_queued)
+
+    def path_limits(self, path):
+        ''' Returns (max concurrent, max queued) for path '''
+        return self._path_limits.get(path, (None, None))
+
+    def add(self, path, priority, request):
+        ''' Queue a request for path, to be started by next().
+
+            Returns
+            =======
+            rejected : object
+                None, or the request turned away to keep the queues within
+                their limits: either this request or a queued one of lower
+                priority.
+        '''
+        path = path if path in self._path_limits else None
+        max_queued = self.path_limits(path)[1]
+        if max_queued is not None and self._path_queued[path] >= max_queued and not self._can_start(path):
+            rejected = self._displace(priority, path)
+            if rejected is None:
+                return request
+        elif self.max_queued is not None and self._queued >= self.max_queued and not self._can_start(path):
+            rejected = self._displace(priority)
+            if rejected is None:
+                return request
+        else:
+            rejected = None
+        self._queues.setdefault(priority, collections.deque()).append((path, request))
+        self._queued += 1
+        self._path_queued[path] += 1
+        return rejected
+
+    def next(self):
+        ''' Remove the next request that can be started from the queues and
+            count it as running; None if there is none.
+        '''
+        if self.max_concurrent is not None and self._running >= self.max_concurrent:
+            return None
+        for priority in sorted(self._queues, reverse=True):
+            queue = self._queues[priority]
+            for index, (path, request) in enumerate(queue):
+                if self._can_start(path):
+                    del queue[index]
+                    if not queue:
+                        del self._queues[priority]
+                    self._queued -= 1
+                    self._path_queued[path] -= 1
+                    self._running += 1
+                    self._path_running[path] += 1
+                    return path, request
+        return None
+
+    def done(self, path):
+        ''' Count a request returned by next() as no longer running '''
+        self._running -= 1
+        self._path_running[path] -= 1
+
+    def _can_start(self, path):
+        if self.max_concurrent is not None and self._running >= self.max_concurrent:
+            return False
+        max_concurrent = self.path_limits(path)[0]
+        return max_concurrent is None or self._path_running[path] < max_concurrent
+
+    def _displace(self, priority, path=None):
+        ''' Remove and return the newest queued request (for path, if given)
+            of the lowest priority below priority; None if there is none.
+        '''
+        for lower in sorted(self._queues):
+            if lower >= priority:
+                break
+            queue = self._queues[lower]
+            for index in range(len(queue) - 1, -1, -1):
+                queued_path, request = queue[index]
+                if path is None or queued_path == path:
+                    del queue[index]
+                    if not queue:
+                        del self._queues[lower]
+                    self._queued -= 1
+                    self._path_queued[queued_path] -= 1
+                    return request
+        return None
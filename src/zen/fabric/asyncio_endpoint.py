@@ -0,0 +1,382 @@
+''' asyncio_endpoint.py
+
+    End-points that run on an asyncio event loop instead of the poll loop in
+    ServiceEndpoint.run, for Python 3.
+
+    send_request returns an asyncio Future, which can be awaited, and
+    service commands can be coroutine functions (async def); the container
+    runs any number of them at once on the event loop and sends each reply
+    as it completes.  Twisted is not imported.
+
+        async def main():
+            client = AsyncioServiceClient()
+            client.init('localhost:5555')
+            client.start()
+            reply = await client.send_request({ 'path' : '/orders', ... })
+'''
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import logging
+import threading
+import zmq
+import zmq.asyncio
+
+from zen.fabric.cache import request_key
+from zen.fabric.codec import decode_message, message_params
+from zen.fabric.deferred import Deferred
+from zen.fabric.errors import UnsupportedCodecError
+from zen.fabric.service_container import ServiceContainer
+from zen.fabric.service_endpoint import ServiceEndpoint
+from zen.fabric.task_schedule import clock
+
+log = logging.getLogger(__name__)
+
+
+def _current_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+
+class AsyncioServiceEndpoint(ServiceEndpoint):
+    ''' Asyncio Service End-point
+
+        A ServiceEndpoint whose sockets are polled, and whose scheduled
+        calls run, on an asyncio event loop.
+    '''
+    def __init__(self, loop=None, context=None):
+        ''' Params
+            ======
+            loop : asyncio event loop, optional
+                Loop to run on; the running loop when omitted, or a new one
+                if no loop is running.
+            context : zmq.Context, optional
+                Context to create the sockets with; see
+                ServiceEndpoint.
+        '''
+        super(AsyncioServiceEndpoint, self).__init__(context)
+        self._loop = loop or _current_loop()
+        self._poll = zmq.asyncio.Poller()
+        self._polling = None
+        self._stopped = None
+
+    def start(self):
+        ''' Start handling messages on the event loop and return; the loop
+            has to be run by the caller.
+        '''
+        self._is_running = True
+        self._loop.call_soon(self._started)
+
+    def run(self, pacing=None):
+        ''' Run the event loop in the current thread until shutdown() is
+            called.  pacing is ignored; it is only accepted for compatibility
+            with ServiceEndpoint.run.
+        '''
+        self._stopped = self._loop.create_future()
+        self.start()
+        self._loop.run_until_complete(self._stopped)
+
+    def shutdown(self):
+        super(AsyncioServiceEndpoint, self).shutdown()
+        self._loop.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        if self._polling is not None:
+            self._polling.cancel()
+            self._polling = None
+        if self._stopped is not None and not self._stopped.done():
+            self._stopped.set_result(None)
+        self._teardown()
+        self._loop_thread = None
+
+    def _started(self):
+        self._loop_thread = threading.current_thread()
+        self._poll_next()
+
+    def _poll_next(self):
+        if not self._is_running:
+            return
+        self._polling = self._poll.poll()
+        self._polling.add_done_callback(self._polled)
+
+    def _polled(self, polling):
+        if polling.cancelled():
+            return
+        self._polling = None
+        try:
+            self._handle_ready(dict(polling.result()))
+        except Exception:
+            #TODO Handle errors instead of simply ignoring them.
+            log.exception('Error in poll loop')
+        self._poll_next()
+
+    def socket(self, socketType, handler):
+        socket = super(AsyncioServiceEndpoint, self).socket(socketType, handler)
+        if handler is not None:
+            self._repoll()
+        return socket
+
+    def disconnect_request(self, socket):
+        super(AsyncioServiceEndpoint, self).disconnect_request(socket)
+        self._repoll()
+
+    def _repoll(self):
+        ''' Restart the poll in progress, if any: it only watches the
+            sockets registered when it started.  Polls end once sockets
+            are ready, so this isn't needed while their handlers run.
+        '''
+        if self._polling is not None:
+            self._polling.cancel()
+            self._polling = None
+            self._poll_next()
+
+    def call_later(self, seconds, func, *args):
+        ''' Call func(*args) from the event loop in the specified number of
+            seconds.  Returns an asyncio.TimerHandle that can cancel the
+            call.
+        '''
+        return self._loop.call_later(seconds, func, *args)
+
+    def call_soon_threadsafe(self, func, *args):
+        ''' Call func(*args) on the event loop; this can be called from any
+            thread.
+        '''
+        self._loop.call_soon_threadsafe(func, *args)
+
+    def _call_from_thread(self, func, *args):
+        ''' Call func(*args), which returns a Deferred, on the event loop for
+            a call made on another thread.  Returns a
+            concurrent.futures.Future, which that thread can wait on,
+            resolved on the event loop with the result of func's.
+        '''
+        future = concurrent.futures.Future()
+
+        def call():
+            try:
+                deferred = func(*args)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            deferred.addCallbacks(future.set_result, lambda failure: future.set_exception(failure.value))
+
+        self.call_soon_threadsafe(call)
+        return future
+
+    def _new_deferred(self):
+        return Deferred()
+
+    def send_request(self, request, timeout=None, max_age=None, idempotent=False):
+        ''' Send a request; see ServiceEndpoint.send_request.
+
+            Returns
+            =======
+            reply_received : asyncio.Future
+                Future resolved with the reply, or with a
+                RequestTimeoutError if the deadline passes first.  Called
+                from another thread, e.g. by a command running on the
+                container's thread pool, send_request returns a
+                concurrent.futures.Future instead, whose result() blocks
+                until the reply arrives.
+        '''
+        reply_received = super(AsyncioServiceEndpoint, self).send_request(request, timeout, max_age, idempotent)
+        if not self._on_loop_thread():
+            return reply_received
+        return self._as_future(reply_received)
+
+    def stream_request(self, request, on_item, window=None, timeout=None):
+        ''' Send a request whose response is streamed; see
+            ServiceEndpoint.stream_request.  on_item can be a coroutine
+            function, in which case each item counts as consumed once its
+            coroutine completes.  The stream's finished attribute is an
+            asyncio.Future.
+        '''
+        def consume(item):
+            result = on_item(item)
+            if inspect.isawaitable(result):
+                return self._as_deferred(result)
+            return result
+
+        stream = super(AsyncioServiceEndpoint, self).stream_request(request, consume, window, timeout)
+        stream.finished = self._as_future(stream.finished)
+        return stream
+
+    def _as_future(self, deferred):
+        future = self._loop.create_future()
+
+        def succeeded(result):
+            if not future.done():
+                future.set_result(result)
+
+        def failed(failure):
+            if not future.done():
+                future.set_exception(failure.value)
+
+        deferred.addCallbacks(succeeded, failed)
+        return future
+
+    def _as_deferred(self, awaitable):
+        deferred = Deferred()
+
+        def done(future):
+            if future.cancelled():
+                deferred.errback(asyncio.CancelledError())
+            elif future.exception() is not None:
+                deferred.errback(future.exception())
+            else:
+                deferred.callback(future.result())
+
+        asyncio.ensure_future(awaitable, loop=self._loop).add_done_callback(done)
+        return deferred
+
+
+class AsyncioServiceClient(AsyncioServiceEndpoint):
+    ''' Asyncio Service Client
+
+        Service client running on an asyncio event loop.
+    '''
+    pass
+
+
+class AsyncioServiceContainer(AsyncioServiceEndpoint, ServiceContainer):
+    ''' Asyncio Service Container
+
+        Service container running on an asyncio event loop.  The container
+        always binds a ROUTER socket.  Commands that are coroutine functions
+        run on the event loop; other commands run on a thread pool when the
+        container has workers, or on the event loop otherwise.  Iterators
+        returned by services are sent whole rather than streamed.
+
+        Every request, whichever way it runs, is admitted under
+        MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS and the limits given
+        to register_service.  Both are unlimited by default: unlike
+        ServiceContainer, MAX_CONCURRENT_REQUESTS does not default to the
+        number of workers.
+    '''
+    def __init__(self, loop=None, context=None):
+        super(AsyncioServiceContainer, self).__init__(loop, context)
+        self._executor = None
+
+    def init(self, request_address='*', request_port=None, srap=None, workers=0, metrics_path=None,
+             prefetch=None):
+        ''' Initialize the container; see ServiceContainer.init.  workers
+            is the number of threads that run commands which aren't
+            coroutine functions; process workers are not supported.
+        '''
+        super(AsyncioServiceContainer, self).init(request_address, request_port, srap,
+                                                  workers, metrics_path=metrics_path, prefetch=prefetch)
+
+    def _request_socket(self, workers, worker_type):
+        if workers:
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        return self.socket(zmq.ROUTER, self._route_request)
+
+    def _teardown(self):
+        super(AsyncioServiceContainer, self)._teardown()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _submit_request(self, socket, envelope, msg_id, frames):
+        params = message_params(frames)
+        if 'credit' in params or 'cancel' in params:
+            # Responses aren't streamed, so there is nothing to control
+            return
+        received = self._received.pop(msg_id, None)
+        span = self._server_span(frames, received)
+        started = clock()
+        try:
+            request, codec_name = decode_message(frames)
+        except UnsupportedCodecError:
+            # Let the normal request path build the error reply
+            socket.send_multipart(envelope + [msg_id] + self._process_request(msg_id, frames, received),
+                                  copy=False)
+            self._request_done(msg_id)
+            return
+        self.metrics.observe('decode_time', codec_name, clock() - started)
+        dispatch = self._dispatch
+        if span is not None:
+            span.name = '{0} {1}'.format(request.get('path'), request.get('command'))
+            span.lap('decode')
+            dispatch = functools.partial(self._dispatch_in_span, span)
+
+        send_reply = functools.partial(self._send_reply, socket, envelope, msg_id, frames, codec_name, request,
+                                       span)
+        key = request_key(request) if 'idempotent' in params else None
+        if key is not None:
+            key = (codec_name,) + key + (params.get('accept'),)
+            if key in self._shared_calls:
+                # Reply along with the identical request being handled
+                self._shared_calls[key].add_done_callback(send_reply)
+                self.metrics.increment('coalesced_requests', '{0} {1}'.format(key[1], key[2]))
+                self._request_done(msg_id)
+                return
+
+        future = self._run(dispatch, msg_id, request)
+        if key is not None and not future.done():
+            self._shared_calls[key] = future
+            future.add_done_callback(lambda future: self._shared_calls.pop(key, None))
+        future.add_done_callback(send_reply)
+
+    def _run(self, dispatch, msg_id, request):
+        ''' Dispatch a request with dispatch(msg_id, request): on the thread
+            pool if there is one, unless its command is a coroutine
+            function, or else on the event loop.  Returns a future resolved
+            with the response.
+        '''
+        if self._executor is not None and not self._is_coroutine(request):
+            return self._loop.run_in_executor(self._executor, dispatch, msg_id, request)
+        future = self._loop.create_future()
+        try:
+            response = dispatch(msg_id, request)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if inspect.isawaitable(response):
+            return asyncio.ensure_future(response, loop=self._loop)
+        future.set_result(response)
+        return future
+
+    def _is_coroutine(self, request):
+        ''' True if the command of a request is a coroutine function '''
+        service = self._get_service(request.get('path'))
+        command = service.commands().get(request.get('command')) if service is not None else None
+        return command is not None and asyncio.iscoroutinefunction(command.bind(service))
+
+    def _send_reply(self, socket, envelope, msg_id, frames, codec_name, request, span, future):
+        try:
+            response = future.result()
+        except (Exception, asyncio.CancelledError) as e:
+            # Described the way the service describes errors of its commands
+            service = self._get_service(request.get('path'))
+            if service is not None:
+                response = service._failure(request.get('command'), e)
+            else:
+                log.debug('Request %s failed', msg_id, exc_info=True)
+                response = { 'status' : 'error', 'message' : '{0}: {1}'.format(type(e).__name__, e) }
+        if span is not None:
+            span.lap('dispatch')
+        reply = self._encode_reply(msg_id, frames, codec_name, response, self._reply_params(span))
+        socket.send_multipart(envelope + [msg_id] + reply, copy=False)
+        if span is not None:
+            span.lap('encode')
+            self._end_server_span(span, response)
+        self._request_done(msg_id)
+
+    def _admits_requests(self):
+        return True
+
+    def _submit_local(self, msg_id, request):
+        def done(future):
+            try:
+                response = future.result()
+            except (Exception, asyncio.CancelledError) as e:
+                self._local_failed(msg_id, e)
+                return
+            self._local_reply(msg_id, response)
+
+        self._run(self._call_local, msg_id, request).add_done_callback(done)
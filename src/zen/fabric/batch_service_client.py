@@ -1,8 +1,88 @@
+from zen.fabric import admission, tracing
 from zen.fabric.service_client import ServiceClient
+from zen.fabric.service_endpoint import new_msg_id
 
 class BatchServiceClient(ServiceClient):
     ''' Batch Service Client
-    
-        Service Client for batch / head-less processes
+
+        Service Client for batch / head-less processes, whose requests
+        give way to others when containers are busy.
     '''
-    pass
+    REQUEST_PRIORITY = admission.LOW
+
+    def send_batch(self, path, calls, chunk_size=None, parallel=False, timeout=None):
+        ''' Send many calls to one service as a single request.
+
+            The container runs the calls and sends the results back in
+            chunks, so results are delivered as they become available and
+            the calls only cost one round trip (and one registry lookup)
+            between them.
+
+            Params
+            ======
+            path : string
+                Path of the service
+            calls : list
+                Calls to make, each a dictionary { 'command' : command,
+                'args' : { argument : value } }
+            chunk_size : int, optional
+                Number of results sent back together; the container's
+                default when omitted.
+            parallel : bool, optional
+                Allow the container to run the chunks at the same time, in
+                which case they can complete in any order.
+            timeout : float, optional
+                Seconds to wait for each chunk of results; REQUEST_TIMEOUT
+                when omitted.  The container gives each chunk as long to
+                run, so a long batch doesn't expire as a whole.
+
+            Returns
+            =======
+            list of Deferreds, one per call, each of which fires with the
+            result of that call.
+        '''
+        results = [self._new_deferred() for call in calls]
+        if not calls:
+            return results
+        pending = set(range(len(calls)))
+        msg_id = new_msg_id()
+        if timeout is None:
+            timeout = self.REQUEST_TIMEOUT
+
+        def on_partial(reply):
+            batch = reply.get('batch') if isinstance(reply, dict) else None
+            if batch is None:
+                # The batch as a whole failed
+                return False
+            for index, result in enumerate(batch['results'], batch['offset']):
+                if index in pending:
+                    pending.discard(index)
+                    results[index].callback(result)
+            if not pending:
+                return False
+            if timeout is not None:
+                # Wait as long again for the next chunk
+                self._extend_request(msg_id, timeout)
+            return True
+
+        def finished(reply):
+            # Calls without a result of their own get the final reply,
+            # which is the error that ended the batch
+            for index in sorted(pending):
+                results[index].callback(reply)
+            pending.clear()
+
+        def failed(failure):
+            for index in sorted(pending):
+                results[index].errback(failure)
+            pending.clear()
+
+        request = { 'path': path, 'batch': calls, 'parallel': parallel }
+        if chunk_size:
+            request['chunk_size'] = chunk_size
+        if timeout is not None:
+            request['chunk_timeout'] = timeout
+        reply_received = self._send_request(request, timeout, { 'batch': 1 }, on_partial, msg_id,
+                                            tracing.current_span())
+        reply_received.addCallbacks(finished, failed)
+        return results
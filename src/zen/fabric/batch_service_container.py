@@ -1,9 +1,105 @@
+import collections
+import logging
+import time
+
+from zen.fabric import service_container
+from zen.fabric.codec import decode_message, encode_message, message_params, to_bytes
+from zen.fabric.errors import UnsupportedCodecError
 from zen.fabric.service_container import ServiceContainer
 
+log = logging.getLogger(__name__)
+
+
+def _run_chunk_in_worker(msg_id, request, offset, calls, codec_name, compression_name):
+    frames = service_container._worker_container._run_chunk(msg_id, request, offset, calls, codec_name,
+                                                            compression_name)
+    return [to_bytes(frame) for frame in frames]
+
+
 class BatchServiceContainer(ServiceContainer):
     ''' Batch Service Container
-    
+
         Service container for batch / head-less processes
+
+        Besides normal requests, the container runs batch requests, which
+        carry a list of { 'command', 'args' } calls for one path instead of
+        a single command (see BatchServiceClient.send_batch).  The results
+        are sent back in chunks of 'chunk_size' calls as
+        { 'batch' : { 'offset' : index of the first call, 'results' : [...] } }.
+        With a worker pool the chunks are streamed as they complete, and
+        run in parallel (as many at once as there are workers) if the
+        request asks for it; otherwise all of the results are sent in one
+        chunk.  A request's 'chunk_timeout' gives each chunk its own
+        deadline, that many seconds after the chunk is started, instead of
+        the request's.
     '''
-    pass
+    # Number of calls whose results are sent back together, unless the
+    # request specifies a chunk_size
+    CHUNK_SIZE = 100
+
+    def _dispatch(self, msg_id, request):
+        if 'batch' not in request:
+            return super(BatchServiceContainer, self)._dispatch(msg_id, request)
+        calls = request['batch']
+        request = self._call_base(request)
+        return { 'batch': { 'offset': 0, 'results': self._run_calls(msg_id, request, calls) } }
+
+    def _submit_request(self, socket, envelope, msg_id, frames):
+        if 'batch' not in message_params(frames):
+            return super(BatchServiceContainer, self)._submit_request(socket, envelope, msg_id, frames)
+        try:
+            request, codec_name = decode_message(frames)
+        except UnsupportedCodecError:
+            # Let the normal request path send the error reply
+            return super(BatchServiceContainer, self)._submit_request(socket, envelope, msg_id, frames)
+
+        calls = request['batch']
+        size = request.get('chunk_size') or self.CHUNK_SIZE
+        # Chunks run at once; only as many as there are workers, so each
+        # starts (and its deadline runs) once a worker is free for it
+        window = self._worker_pool.size if request.get('parallel', False) else 1
+        chunk_timeout = request.get('chunk_timeout')
+        compression_name = self._reply_compression(frames)
+        request = self._call_base(request)
+        chunks = collections.deque((offset, calls[offset:offset + size])
+                                   for offset in range(0, max(len(calls), 1), size))
+        remaining = [len(chunks)]
+
+        def send_chunk(succeeded, result):
+            if not succeeded:
+                log.error('Worker failed: %s', result)
+                result = encode_message({ 'status' : 'error', 'message' : result }, codec_name)
+            socket.send_multipart(envelope + [msg_id] + result, copy=False)
+            remaining[0] -= 1
+            if chunks:
+                submit_chunk()
+            elif not remaining[0]:
+                self._request_done(msg_id)
+
+        def submit_chunk():
+            offset, calls = chunks.popleft()
+            chunk_request = request
+            if chunk_timeout is not None:
+                chunk_request = dict(request, deadline=time.time() + chunk_timeout)
+            self._submit(self._run_chunk, _run_chunk_in_worker,
+                         (msg_id, chunk_request, offset, calls, codec_name, compression_name), send_chunk)
+
+        for index in range(window):
+            if chunks:
+                submit_chunk()
+
+    def _call_base(self, request):
+        ''' The parts of a batch request shared by each of its calls '''
+        return dict((key, value) for key, value in request.items()
+                    if key not in ('batch', 'chunk_size', 'chunk_timeout', 'parallel'))
+
+    def _run_chunk(self, msg_id, request, offset, calls, codec_name, compression_name=None):
+        response = { 'batch': { 'offset': offset, 'results': self._run_calls(msg_id, request, calls) } }
+        return self._encode_response(response, codec_name, compression_name)
 
+    def _run_calls(self, msg_id, request, calls):
+        results = []
+        for call in calls:
+            call_request = dict(request, command=call.get('command'), args=call.get('args', {}))
+            results.append(super(BatchServiceContainer, self)._dispatch(msg_id, call_request))
+        return results
@@ -0,0 +1,100 @@
+''' cache.py
+
+    Response caching.
+
+    A container caches the responses of Service commands decorated with
+    @cached, keyed by path, command and args, until they expire or the
+    service invalidates them (Service.invalidate).  Clients can also reuse
+    the replies to earlier requests; see ServiceEndpoint.send_request.
+
+        class Prices(Service):
+            @cached(ttl=30)
+            def get(self, symbol):
+                ...
+
+            def set(self, symbol, price):
+                ...
+                self.invalidate('get', { 'symbol' : symbol })
+'''
+import collections
+import json
+import threading
+
+from zen.fabric.task_schedule import clock
+
+
+def cached(ttl=60):
+    ''' Decorator for Service commands whose response depends only on their
+        args, so the container can reuse it for ttl seconds.
+    '''
+    def decorate(func):
+        func.cache_ttl = ttl
+        return func
+    return decorate
+
+
+def _args_key(args):
+    return json.dumps(args, sort_keys=True, separators=(',', ':'))
+
+
+def request_key(request):
+    ''' Key identifying the path, command and args of a request, or None if
+        the args can't be compared (e.g. they contain buffers).
+    '''
+    try:
+        args = _args_key(request.get('args', {}))
+    except (TypeError, ValueError):
+        return None
+    return (request.get('path'), request.get('command'), args)
+
+
+class ResponseCache(object):
+    ''' Response Cache
+
+        Least recently used cache of responses, each with its own expiry.
+        Safe to use from worker threads.
+    '''
+    def __init__(self, size):
+        self._size = size
+        self._lock = threading.Lock()
+        # key : (time stored, time it expires, response), least recently
+        # used first
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, max_age=None):
+        ''' Returns (True, response), or (False, None) if there is no
+            unexpired response for key that is at most max_age seconds old.
+        '''
+        now = clock()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < now:
+                return False, None
+            self._entries[key] = entry
+        if max_age is not None and now - entry[0] > max_age:
+            return False, None
+        return True, entry[2]
+
+    def put(self, key, response, ttl):
+        now = clock()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now, now + ttl, response)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path=None, command=None, args=None):
+        ''' Drop the responses for path, command and args; each of them
+            matches everything when omitted.  Responses of a service
+            handling a subtree are keyed by its path, followed by the path
+            requested, and match either.
+        '''
+        args = None if args is None else _args_key(args)
+        with self._lock:
+            for key in list(self._entries):
+                if ((path is None or key[0] == path or key[3:] == (path,))
+                        and (command is None or key[1] == command) and (args is None or key[2] == args)):
+                    del self._entries[key]
@@ -0,0 +1,243 @@
+''' codec.py
+
+    Message codecs.
+
+    A message travels as the frames [header, body, buffer...] after the
+    message id.  The header names the codec used for the body, e.g. 'json'
+    or 'msgpack', optionally followed by ';key=value' parameters.  Buffers
+    wrapped in Buffer (and memoryview / bytearray values) are not encoded
+    into the body; each is sent as a frame of its own, without copying, and
+    the body holds a placeholder for it.
+
+    A JSON message with no buffers and no parameters is sent as the body
+    alone, which is the original wire format, so peers that predate codecs
+    keep working.
+
+    A body can be compressed after encoding (see zen.fabric.compression);
+    the header then names the compression in its 'compressed' parameter,
+    and decode_message() decompresses the body first.
+'''
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from zen.fabric.compression import get_compression
+from zen.fabric.errors import UnsupportedCodecError
+
+DEFAULT_CODEC = 'json'
+
+# Key of the placeholder that stands in for a buffer sent as its own frame
+FRAME_KEY = '__frame__'
+
+
+class Buffer(object):
+    ''' Buffer
+
+        Wraps an object supporting the buffer protocol (bytes, bytearray,
+        numpy arrays, ...) so that it is sent as a separate frame instead of
+        being encoded into the message body.  The receiver gets a read-only
+        memoryview (or bytes) in its place.
+    '''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Codec(object):
+    ''' Codec
+
+        Encodes messages to bytes and back.  encode() and decode() work on
+        the whole message in a single pass; buffers found while encoding
+        are collected into a list and sent as separate frames.
+    '''
+    name = None
+
+    def encode(self, obj):
+        ''' Returns (body, buffers) '''
+        raise NotImplementedError()
+
+    def decode(self, body, buffers):
+        ''' Returns the decoded message; placeholders in the body are
+            replaced by the corresponding entries of buffers.
+        '''
+        raise NotImplementedError()
+
+    def _default(self, buffers):
+        ''' Returns the hook called for values the encoder doesn't support '''
+        def default(obj):
+            if isinstance(obj, Buffer):
+                # Anything supporting the buffer protocol, bytes included;
+                # memoryview() raises TypeError for anything else
+                memoryview(obj.data)
+                buffers.append(obj.data)
+                return { FRAME_KEY : len(buffers) - 1 }
+            if isinstance(obj, (memoryview, bytearray)) or hasattr(obj, '__array_interface__'):
+                buffers.append(obj)
+                return { FRAME_KEY : len(buffers) - 1 }
+            if isinstance(obj, (set, frozenset)):
+                return list(obj)
+            return str(obj)
+        return default
+
+    def _object_hook(self, buffers):
+        def object_hook(obj):
+            if len(obj) == 1 and FRAME_KEY in obj:
+                return buffers[obj[FRAME_KEY]]
+            return obj
+        return object_hook
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def encode(self, obj):
+        buffers = []
+        body = json.dumps(obj, separators=(',', ':'), default=self._default(buffers))
+        return body.encode('utf-8'), buffers
+
+    def decode(self, body, buffers):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if buffers:
+            return json.loads(body, object_hook=self._object_hook(buffers))
+        return json.loads(body)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def encode(self, obj):
+        buffers = []
+        body = msgpack.packb(obj, use_bin_type=True, default=self._default(buffers))
+        return body, buffers
+
+    def decode(self, body, buffers):
+        if buffers:
+            return msgpack.unpackb(body, raw=False, object_hook=self._object_hook(buffers))
+        return msgpack.unpackb(body, raw=False)
+
+
+# codec name : Codec
+_codecs = {}
+
+
+def register_codec(codec):
+    ''' Make a codec available to every end-point in this process '''
+    _codecs[codec.name] = codec
+
+
+def get_codec(name):
+    ''' Returns the named codec, raising UnsupportedCodecError if it isn't
+        available in this process.
+    '''
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise UnsupportedCodecError('Unsupported codec {0}'.format(name))
+
+
+def available_codecs():
+    ''' Names of the codecs available in this process, default first '''
+    return [DEFAULT_CODEC] + sorted(name for name in _codecs if name != DEFAULT_CODEC)
+
+
+def negotiate(preferred, supported):
+    ''' Returns the first codec in preferred that is both in supported (the
+        peer's codecs) and available here, falling back to the default.
+    '''
+    if supported:
+        for name in preferred:
+            if name in supported and name in _codecs:
+                return name
+    return DEFAULT_CODEC
+
+
+def make_header(codec_name, params=None):
+    header = codec_name
+    if params:
+        header += ''.join(';{0}={1}'.format(k, v) for k, v in sorted(params.items()))
+    return header.encode('ascii')
+
+
+def parse_header(header):
+    ''' Returns (codec name, { param : value }) '''
+    parts = to_bytes(header).decode('ascii').split(';')
+    params = dict(part.split('=', 1) for part in parts[1:])
+    return parts[0], params
+
+
+def to_bytes(frame):
+    ''' Contents of a received zmq.Frame, buffer or bytes as bytes '''
+    if isinstance(frame, bytes):
+        return frame
+    if hasattr(frame, 'bytes'):
+        return frame.bytes
+    return memoryview(frame).tobytes()
+
+
+def _to_buffer(frame):
+    if hasattr(frame, 'buffer'):
+        return frame.buffer
+    return frame
+
+
+def encode_message(message, codec_name=DEFAULT_CODEC, params=None):
+    ''' Encode a message into the frames that follow the message id.
+        params are added to the header.
+    '''
+    body, buffers = get_codec(codec_name).encode(message)
+    if codec_name == DEFAULT_CODEC and not buffers and not params:
+        return [body]
+    return [make_header(codec_name, params), body] + buffers
+
+
+def message_body(frames):
+    ''' Body of the frames returned by encode_message() '''
+    return frames[0] if len(frames) == 1 else frames[1]
+
+
+def compress_message(frames, compression_name):
+    ''' The frames returned by encode_message() with the body compressed
+        with the named compression
+    '''
+    if len(frames) == 1:
+        codec_name, params, buffers = DEFAULT_CODEC, {}, []
+    else:
+        codec_name, params = parse_header(frames[0])
+        buffers = frames[2:]
+    params['compressed'] = compression_name
+    body = get_compression(compression_name).compress(to_bytes(message_body(frames)))
+    return [make_header(codec_name, params), body] + buffers
+
+
+def message_params(frames):
+    ''' Header parameters of the frames that follow the message id, without
+        decoding the message.
+    '''
+    if len(frames) == 1:
+        return {}
+    return parse_header(frames[0])[1]
+
+
+def decode_message(frames):
+    ''' Decode the frames that follow the message id.
+
+        Returns (message, codec name)
+    '''
+    if len(frames) == 1:
+        return get_codec(DEFAULT_CODEC).decode(to_bytes(frames[0]), ()), DEFAULT_CODEC
+    codec_name, params = parse_header(frames[0])
+    body = to_bytes(frames[1])
+    if 'compressed' in params:
+        body = get_compression(params['compressed']).decompress(body)
+    buffers = [_to_buffer(frame) for frame in frames[2:]]
+    return get_codec(codec_name).decode(body, buffers), codec_name
+
+
+register_codec(JsonCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
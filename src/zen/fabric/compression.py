@@ -0,0 +1,101 @@
+''' compression.py
+
+    Compression of message bodies.
+
+    Compression is negotiated for each request connection, the way codecs
+    are: containers register the compressions available to them, and a
+    client uses the first of its COMPRESSIONS that the container also
+    supports (see ServiceEndpoint).  The client names it in the 'accept'
+    header parameter of its requests, so the container compresses its
+    replies the same way.
+
+    Only bodies of at least COMPRESS_THRESHOLD bytes are compressed, so
+    small messages are sent as they are.  A compressed body is marked with
+    the 'compressed' header parameter; buffers sent as frames of their own
+    are never compressed.
+'''
+import zlib
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from zen.fabric.errors import UnsupportedCodecError
+
+
+class Compression(object):
+    ''' Compression
+
+        Compresses message bodies and back.
+    '''
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class ZlibCompression(Compression):
+    name = 'zlib'
+    # zlib compression level, 1 (fastest) to 9 (smallest)
+    LEVEL = 6
+
+    def compress(self, data):
+        return zlib.compress(data, self.LEVEL)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Lz4Compression(Compression):
+    ''' Compresses less than zlib, several times faster '''
+    name = 'lz4'
+
+    def compress(self, data):
+        return lz4_frame.compress(data)
+
+    def decompress(self, data):
+        return lz4_frame.decompress(data)
+
+
+# compression name : Compression
+_compressions = {}
+
+
+def register_compression(compression):
+    ''' Make a compression available to every end-point in this process '''
+    _compressions[compression.name] = compression
+
+
+def get_compression(name):
+    ''' Returns the named compression, raising UnsupportedCodecError if it
+        isn't available in this process.
+    '''
+    try:
+        return _compressions[name]
+    except KeyError:
+        raise UnsupportedCodecError('Unsupported compression {0}'.format(name))
+
+
+def available_compressions():
+    ''' Names of the compressions available in this process '''
+    return sorted(_compressions)
+
+
+def negotiate(preferred, supported):
+    ''' Returns the first compression in preferred that is both in supported
+        (the peer's compressions) and available here, or None.
+    '''
+    if supported:
+        for name in preferred:
+            if name in supported and name in _compressions:
+                return name
+    return None
+
+
+register_compression(ZlibCompression())
+if lz4_frame is not None:
+    register_compression(Lz4Compression())
@@ -0,0 +1,153 @@
+''' deferred.py
+
+    A minimal Deferred for end-points that don't use Twisted (see
+    asyncio_endpoint).  It implements the part of
+    twisted.internet.defer.Deferred that zen.fabric relies on internally:
+    callbacks and errbacks run in order as soon as a result is available,
+    each receiving the result of the one before, and a callback returning
+    a Deferred pauses the chain until that fires.
+
+    ThreadSafeDeferred is what ServiceEndpoint.send_request returns to
+    threads other than the loop's, e.g. those of a container's workers.
+'''
+import sys
+import threading
+
+from zen.fabric.errors import RequestTimeoutError
+
+
+class Failure(object):
+    ''' An exception passed down the errback chain, standing in for
+        twisted.python.failure.Failure.
+    '''
+    def __init__(self, value=None):
+        if value is None:
+            value = sys.exc_info()[1]
+        self.value = value
+        self.type = type(value)
+
+    def check(self, *types):
+        for error_type in types:
+            if isinstance(self.value, error_type):
+                return error_type
+        return None
+
+    def getErrorMessage(self):
+        return str(self.value)
+
+    def raiseException(self):
+        raise self.value
+
+    def __repr__(self):
+        return '<Failure {0}: {1}>'.format(self.type.__name__, self.value)
+
+
+class Deferred(object):
+    ''' Deferred
+
+        Placeholder for a result that isn't available yet.
+    '''
+    def __init__(self):
+        self.called = False
+        self.result = None
+        # [(callback, errback)], each a (func, args, kwargs) or None
+        self._chain = []
+        self._paused = False
+
+    def addCallbacks(self, callback, errback=None):
+        self._chain.append(((callback, (), {}), errback and (errback, (), {})))
+        self._run()
+        return self
+
+    def addCallback(self, callback, *args, **kwargs):
+        self._chain.append(((callback, args, kwargs), None))
+        self._run()
+        return self
+
+    def addErrback(self, errback, *args, **kwargs):
+        self._chain.append((None, (errback, args, kwargs)))
+        self._run()
+        return self
+
+    def addBoth(self, callback, *args, **kwargs):
+        self._chain.append(((callback, args, kwargs), (callback, args, kwargs)))
+        self._run()
+        return self
+
+    def callback(self, result):
+        self._start(result)
+
+    def errback(self, fail=None):
+        ''' Fire the errbacks with fail, an exception or Failure; the
+            exception being handled when omitted.
+        '''
+        if not isinstance(fail, Failure):
+            fail = Failure(fail)
+        self._start(fail)
+
+    def _start(self, result):
+        if self.called:
+            raise RuntimeError('Deferred already called')
+        self.called = True
+        self.result = result
+        self._run()
+
+    def _resume(self, result):
+        self._paused = False
+        self.result = result
+        self._run()
+
+    def _run(self):
+        if not self.called or self._paused:
+            return
+        while self._chain:
+            callback, errback = self._chain.pop(0)
+            handler = errback if isinstance(self.result, Failure) else callback
+            if handler is None:
+                continue
+            func, args, kwargs = handler
+            try:
+                self.result = func(self.result, *args, **kwargs)
+            except Exception:
+                self.result = Failure()
+            if isinstance(self.result, Deferred):
+                # Continue with its result once it has one
+                self._paused = True
+                self.result.addBoth(self._resume)
+                return
+
+
+class ThreadSafeDeferred(Deferred):
+    ''' Thread-safe Deferred
+
+        A Deferred fired on the loop's thread and used from another one.
+        Its callbacks run one at a time: on the thread firing it, or on the
+        thread adding them once it has fired.  wait() blocks until it fires.
+    '''
+    def __init__(self):
+        super(ThreadSafeDeferred, self).__init__()
+        self._lock = threading.RLock()
+        self._fired = threading.Event()
+
+    def wait(self, timeout=None):
+        ''' Block until the Deferred fires and return the result of the
+            callbacks added so far, raising the exception if it is a
+            failure, or RequestTimeoutError if timeout seconds pass first.
+            Never call it on the loop's thread, which would have to fire it.
+        '''
+        if not self._fired.wait(timeout):
+            raise RequestTimeoutError('No result within {0} seconds'.format(timeout))
+        with self._lock:
+            result = self.result
+        if isinstance(result, Failure):
+            result.raiseException()
+        return result
+
+    def _start(self, result):
+        with self._lock:
+            super(ThreadSafeDeferred, self)._start(result)
+        self._fired.set()
+
+    def _run(self):
+        with self._lock:
+            super(ThreadSafeDeferred, self)._run()
@@ -0,0 +1,18 @@
+''' errors.py
+
+    Exceptions delivered through the errbacks of request Deferreds.
+'''
+
+class RequestTimeoutError(Exception):
+    ''' The reply to a request did not arrive before its deadline '''
+    pass
+
+
+class ServiceNotFoundError(Exception):
+    ''' The service registry does not know the requested path '''
+    pass
+
+
+class UnsupportedCodecError(Exception):
+    ''' A message was encoded with a codec that isn't available here '''
+    pass
@@ -1,8 +1,10 @@
+from zen.fabric import admission
 from zen.fabric.service_client import ServiceClient
 
 class InteractiveServiceClient(ServiceClient):
     ''' Interactive Service Client
     
-        Service Client for GUI's and other interactive processes
+        Service Client for GUI's and other interactive processes, whose
+        requests are served ahead of others when containers are busy.
     '''
-    pass
+    REQUEST_PRIORITY = admission.HIGH
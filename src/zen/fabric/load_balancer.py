@@ -0,0 +1,69 @@
+''' load_balancer.py
+
+    Policies for choosing which instance of a service a request is sent to,
+    when several containers host the same path.
+'''
+import itertools
+import random
+
+
+class LoadBalancer(object):
+    ''' Load Balancer
+
+        Chooses one of the request connections to the instances of a
+        service.
+    '''
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+
+    def choose(self, sockets):
+        ''' Returns one of sockets, which is never empty '''
+        raise NotImplementedError()
+
+
+class RoundRobin(LoadBalancer):
+    ''' Sends requests to each instance in turn '''
+    def __init__(self, endpoint):
+        super(RoundRobin, self).__init__(endpoint)
+        self._counter = itertools.count()
+
+    def choose(self, sockets):
+        return sockets[next(self._counter) % len(sockets)]
+
+
+class LeastOutstanding(LoadBalancer):
+    ''' Sends requests to the instance with the fewest unanswered requests '''
+    def choose(self, sockets):
+        return min(sockets, key=self._endpoint.outstanding)
+
+
+class LatencyWeighted(LoadBalancer):
+    ''' Picks instances at random, weighted by the inverse of their recent
+        average latency, so faster instances get more of the traffic while
+        slow ones still get enough to notice when they recover.
+    '''
+    def choose(self, sockets):
+        weights = [1.0 / max(self._endpoint.latency(socket), 1e-6) for socket in sockets]
+        point = random.random() * sum(weights)
+        for socket, weight in zip(sockets, weights):
+            point -= weight
+            if point <= 0:
+                return socket
+        return sockets[-1]
+
+
+POLICIES = {
+    'round_robin': RoundRobin,
+    'least_outstanding': LeastOutstanding,
+    'latency_weighted': LatencyWeighted,
+}
+
+
+def create(policy, endpoint):
+    ''' Create a load balancer from a policy name or LoadBalancer subclass '''
+    if isinstance(policy, type):
+        return policy(endpoint)
+    try:
+        return POLICIES[policy](endpoint)
+    except KeyError:
+        raise ValueError('Unknown load balancing policy {0}'.format(policy))
@@ -0,0 +1,134 @@
+''' metrics.py
+
+    Counters, gauges and latency histograms kept by each end-point, and a
+    service that exposes them to clients.
+'''
+import threading
+
+from zen.fabric.service import Service
+
+PATH = '/metrics'
+
+
+class Histogram(object):
+    ''' Histogram
+
+        Latency histogram with power-of-two microsecond buckets; recording
+        a value is O(1) and percentiles are accurate to within a factor of
+        two.
+    '''
+    __slots__ = ('count', 'total', 'min', 'max', '_buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # bucket index : count; bucket i holds values below 2**i microseconds
+        self._buckets = {}
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1000000).bit_length()
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        ''' Upper bound, in seconds, of the bucket holding the given
+            fraction (0 - 1) of the observations.
+        '''
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min((2 ** bucket) / 1000000.0, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Metrics(object):
+    ''' Metrics
+
+        Named counters and histograms, each broken down by key (typically
+        'path command'), plus gauges that are sampled when a snapshot is
+        taken.  Safe to update from worker threads.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name : { key : count }
+        self._counters = {}
+        # name : { key : Histogram }
+        self._histograms = {}
+        # name : function returning the current value
+        self._gauges = {}
+
+    def increment(self, name, key='', value=1):
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, key, seconds):
+        ''' Record a duration, in seconds, in the named histogram '''
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def counter(self, name):
+        ''' Current values of the named counter: { key : count } '''
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def gauge(self, name, func):
+        ''' Register a function whose value is reported as the named gauge '''
+        self._gauges[name] = func
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def snapshot(self):
+        ''' Current values of every metric, as a JSON-compatible dict '''
+        with self._lock:
+            counters = dict((name, dict(values)) for name, values in self._counters.items())
+            histograms = dict((name, dict((key, histogram.snapshot()) for key, histogram in values.items()))
+                              for name, values in self._histograms.items())
+        gauges = dict((name, func()) for name, func in self._gauges.items())
+        return {
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': gauges,
+        }
+
+
+class MetricsService(Service):
+    ''' Metrics Service
+
+        Reports the metrics of the container it is registered with.
+    '''
+    def get(self):
+        return self._container.metrics.snapshot()
+
+    def reset(self):
+        self._container.metrics.reset()
+        return {'status' : 'ok'}
@@ -1,46 +1,260 @@
 ''' service.py
 
     Server side service
-    
-    Extend this class to create a service.
+
+    Extend this class to create a service.  Its public methods (those not
+    starting with '_', nor marked with @internal) are the commands clients
+    can call; the table of them is built once per class, when a service of
+    that class is first registered.
 '''
+import collections
+import inspect
+import logging
+import threading
+import traceback
+
+log = logging.getLogger(__name__)
+
+# The call being handled by each thread
+_calls = threading.local()
+
+# Client and request of the call being handled
+CallContext = collections.namedtuple('CallContext', ['client_id', 'request'])
+
+# Coroutines (async def) only exist in Python 3
+_iscoroutine = getattr(inspect, 'iscoroutine', None)
+
+
+def internal(func):
+    ''' Decorator for public methods of a Service that are meant for the
+        process running it, not for clients: they aren't exported as
+        commands.
+    '''
+    func.exported = False
+    return func
+
+
+class Command(object):
+    ''' Command
+
+        A method a service exports, with what it takes as arguments.
+    '''
+    __slots__ = ('name', 'cache_ttl', '_method', '_params', '_required', '_any_args')
+
+    def __init__(self, name, method):
+        ''' Params
+            ======
+            name : string
+                Name of the command
+            method : function, staticmethod or classmethod
+                The method as defined in the class
+        '''
+        self.name = name
+        self._method = method
+        if isinstance(method, (staticmethod, classmethod)):
+            func = method.__func__
+            skip = 1 if isinstance(method, classmethod) else 0
+        else:
+            func = method
+            skip = 1
+        self.cache_ttl = getattr(func, 'cache_ttl', None)
+        getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+        try:
+            spec = getargspec(func)
+        except TypeError:
+            # Can't be introspected, so the args aren't checked
+            self._any_args = True
+            self._params = self._required = frozenset()
+            return
+        names = spec.args[skip:]
+        required = names[:len(names) - len(spec.defaults or ())]
+        kwonly = getattr(spec, 'kwonlyargs', None) or []
+        kwonly_defaults = getattr(spec, 'kwonlydefaults', None) or {}
+        self._params = frozenset(names + kwonly)
+        self._required = frozenset(required + [name for name in kwonly if name not in kwonly_defaults])
+        self._any_args = bool(getattr(spec, 'varkw', None) or getattr(spec, 'keywords', None))
+
+    def bind(self, service):
+        ''' The command as a method of service '''
+        return self._method.__get__(service, type(service))
+
+    def check(self, args):
+        ''' Returns why args can't be passed to the command, or None if they
+            can.
+        '''
+        if not isinstance(args, dict):
+            return 'args of {0} must be a dictionary'.format(self.name)
+        missing = self._required.difference(args)
+        if missing:
+            return '{0} missing args: {1}'.format(self.name, ', '.join(sorted(missing)))
+        if not self._any_args:
+            unknown = set(args).difference(self._params)
+            if unknown:
+                return '{0} got unknown args: {1}'.format(self.name, ', '.join(sorted(unknown)))
+        return None
+
 
 class Service(object):
-    
+    # Check the args of each request against the command's signature, so
+    # calls with missing or unknown args are answered with an
+    # 'invalid_args' error without calling the command
+    VALIDATE_ARGS = True
+    # Include the traceback of exceptions raised by commands in the error
+    # replies; otherwise only the exception is described, and the
+    # traceback is logged at debug level.
+    SEND_TRACEBACKS = False
+
     def __init__(self):
         # Initialize the service container that contains this service as None
         # This will be populated with the correct value when the service
         # is registered with container.register_service(service)
         self._container = None
 
+    @classmethod
+    def commands(cls):
+        ''' The commands services of this class export: name : Command.
+            Methods defined by Service itself and those marked with
+            @internal are not commands.
+        '''
+        table = cls.__dict__.get('_command_table')
+        if table is None:
+            table = {}
+            for klass in cls.__mro__:
+                if klass in (Service, object):
+                    continue
+                for name, method in klass.__dict__.items():
+                    if (name.startswith('_') or name in table or hasattr(Service, name)
+                            or not isinstance(method, (staticmethod, classmethod)) and not inspect.isfunction(method)):
+                        continue
+                    if not getattr(getattr(method, '__func__', method), 'exported', True):
+                        continue
+                    table[name] = Command(name, method)
+            cls._command_table = table
+        return table
+
+    @property
+    def call_context(self):
+        ''' CallContext of the request being handled by the current thread,
+            or None.  Each call has its own, so commands can run
+            concurrently; coroutine commands see theirs every time they
+            resume.
+        '''
+        return getattr(_calls, 'context', None)
+
+    @property
+    def _client_id(self):
+        ''' Identifier of the client of the request being handled; kept for
+            services written before call_context.
+        '''
+        context = self.call_context
+        return context.client_id if context is not None else None
+
     def handle_request(self, client_id, request):
         ''' Handle a request message
-            
+
             It's not necessary to implement this handler.  The default
-            implementation will take the 'command' property from the 
+            implementation will take the 'command' property from the
             request message and attempt to execute it as a function,
             passing the 'args' property as arguments
-            
+
             Params
             ======
             client_id : string
                 Identifier for this client (should this be session instead?)
             request : dictionary
-                Example 
-                    { 
-                        'path' : '/path/to/this/service', 
-                        'command' : 'method_to_invoke', 
+                Example
+                    {
+                        'path' : '/path/to/this/service',
+                        'command' : 'method_to_invoke',
                         'args' : { } # args to pass to method
                     }
         '''
-        command = request['command']
+        command = self.commands().get(request.get('command'))
+        if command is None:
+            return { 'status' : 'error', 'error' : 'unknown_command',
+                     'message' : 'Unknown command {0}'.format(request.get('command')) }
+        args = request.get('args', {})
+        if self.VALIDATE_ARGS:
+            problem = command.check(args)
+            if problem is not None:
+                return { 'status' : 'error', 'error' : 'invalid_args', 'message' : problem }
+
+        context = CallContext(client_id, request)
+        previous = getattr(_calls, 'context', None)
+        _calls.context = context
         try:
-            self._client_id = client_id
-            func = getattr(self, command)
-            response = func(**request['args'])
-        except:
-            response = { 'status' : 'error', 'message' : traceback.format_exc() }
+            response = command.bind(self)(**args)
+        except Exception as e:
+            response = self._failure(command.name, e)
         finally:
-            self._client_id = None
+            _calls.context = previous
 
+        if _iscoroutine is not None and _iscoroutine(response):
+            response = _CoroutineCall(self, command.name, response, context)
         return response
+
+    def _failure(self, command, error):
+        ''' The error response for a command that raised error; call it
+            while handling the exception.
+        '''
+        if self.SEND_TRACEBACKS:
+            message = traceback.format_exc()
+        else:
+            log.debug('Command %s failed', command, exc_info=True)
+            message = '{0}: {1}'.format(type(error).__name__, error)
+        return { 'status' : 'error', 'message' : message }
+
+    def invalidate(self, command=None, args=None):
+        ''' Drop this service's responses cached by its container (see
+            zen.fabric.cache.cached): all of them, those of command, or
+            only the one for command called with args.  Call this when the
+            state the responses depend on changes.  This raises
+            RuntimeError on a container's process workers.
+        '''
+        for path in self._container.service_paths(self):
+            self._container.invalidate_responses(path, command, args)
+
+
+class _CoroutineCall(object):
+    ''' Awaitable running the coroutine of a command with the call's
+        context set each time it resumes, and answering exceptions it
+        raises with an error response, as handle_request does for other
+        commands.
+    '''
+    def __init__(self, service, command, coroutine, context):
+        self._service = service
+        self._command = command
+        self._context = context
+        self._steps = coroutine.__await__()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._step(self._steps.send, None)
+
+    next = __next__
+
+    def send(self, value):
+        return self._step(self._steps.send, value)
+
+    def throw(self, *args):
+        return self._step(self._steps.throw, *args)
+
+    def close(self):
+        return self._step(self._steps.close)
+
+    def _step(self, resume, *args):
+        previous = getattr(_calls, 'context', None)
+        _calls.context = self._context
+        try:
+            return resume(*args)
+        except StopIteration:
+            raise
+        except Exception as e:
+            raise StopIteration(self._service._failure(self._command, e))
+        finally:
+            _calls.context = previous
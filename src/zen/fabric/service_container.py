@@ -1,53 +1,223 @@
-import json
+import logging
+import os
 import socket as sys_socket
+import tempfile
+import time
 import traceback
 import zmq
 
+from zen.fabric.admission import Admission, priority_of
+from zen.fabric.cache import ResponseCache, request_key
+from zen.fabric.codec import (DEFAULT_CODEC, available_codecs, decode_message, encode_message, message_params,
+                              parse_header, to_bytes)
+from zen.fabric.compression import available_compressions
+from zen.fabric.errors import UnsupportedCodecError
+from zen.fabric.metrics import MetricsService
 from zen.fabric.service_endpoint import ServiceEndpoint
-from zen.fabric.json_util import filter_json
+from zen.fabric.service_registry.path_tree import ancestors
+from zen.fabric.stream import OutputStream, is_iterator
+from zen.fabric.supervisor import Supervisor
+from zen.fabric.task_schedule import clock
+from zen.fabric import tracing, transport
+from zen.fabric.worker_pool import WorkerPool, THREAD
+
+log = logging.getLogger(__name__)
+
+# Container used by process pool workers; set before the workers are forked
+_worker_container = None
+
+
+def _process_in_worker(msg_id, frames, received=None):
+    # Buffers can't be pickled back to the parent, so return plain bytes
+    return [to_bytes(frame) for frame in _worker_container._process_request(msg_id, frames, received)]
+
+
+def _dispatch_in_worker(msg_id, request):
+    return _worker_container._dispatch(msg_id, request)
+
 
 class ServiceContainer(ServiceEndpoint):
     ''' Service Container
     
         Container for services.
     '''
-    def __init__(self):
-        super(ServiceContainer, self).__init__()
+    # Seconds the service registry keeps this container's registrations
+    # without hearing from it; they are renewed well before they expire
+    REGISTRATION_TTL = 30
+    # Seconds a streamed response waits for the client to return credit
+    # before it is abandoned
+    STREAM_TIMEOUT = 60
+    # Number of responses of @cached commands kept by the container
+    RESPONSE_CACHE_SIZE = 1024
+    # Number of requests handled at once; the number of workers when None.
+    # Further requests wait, highest priority first (see zen.fabric.admission).
+    MAX_CONCURRENT_REQUESTS = None
+    # Number of requests that can wait; further requests are answered as
+    # overloaded.  Unlimited when None.
+    MAX_QUEUED_REQUESTS = None
+    # Transports the request socket also accepts requests on, besides
+    # request_address, and registers: 'inproc' for clients using the same
+    # zmq.Context and 'ipc' for those on the same host.  Clients pick the
+    # cheapest they can reach (see zen.fabric.transport).  ipc is opt-in:
+    # its socket file, in the temporary directory, is removed on shutdown
+    # but left behind if the process dies.
+    LOCAL_TRANSPORTS = (transport.INPROC,)
+
+    def __init__(self, context=None):
+        super(ServiceContainer, self).__init__(context)
         self._request_port = None
+        # Registration entries of the LOCAL_TRANSPORTS bound
+        self._local_addresses = {}
         self._services = {}
         self._is_running = False
+        self._worker_pool = None
+        self._supervisor = None
+        # Paths registered with the remote service registry
+        self._registered_paths = []
+        # Paths registered as subtrees
+        self._subtrees = set()
+        self._renewal = None
+        # Streamed responses being sent - msg_id : OutputStream
+        self._streams = {}
+        self._response_cache = ResponseCache(self.RESPONSE_CACHE_SIZE)
+        # Idempotent requests being handled - (codec name, path, command,
+        # args) : [(envelope, msg_id), ...] of the identical requests that
+        # arrived meanwhile and share the reply
+        self._shared_calls = {}
+        # Limits on the requests handled by a worker pool; set by init, so
+        # that MAX_CONCURRENT_REQUESTS and MAX_QUEUED_REQUESTS can be set
+        # on the instance
+        self._admission = Admission()
+        # Requests admitted and not yet answered - msg_id : path they were
+        # admitted under
+        self._admitted = {}
+        self.metrics.gauge('queued_requests', lambda: self._admission.queued)
+        # Traced requests waiting to be handled - msg_id : clock() time
+        # they were received
+        self._received = {}
+        self._profiler = None
 
-    def init(self, request_address='*', request_port=None, srap=None):
+    def init(self, request_address='*', request_port=None, srap=None,
+             workers=0, worker_type=THREAD, metrics_path=None, processes=0, prefetch=None):
         ''' Initialize the container with the specified request port
         
             Params
             ======
             request_address : string, optional
                 Address to which the request socket should bound.  Use '*' as a
-                wildcard to bind to all addresses.
+                wildcard to bind to all addresses.  An ipc:// or inproc://
+                address is bound (and registered) as it is, without a port.
+                The socket is also bound to the LOCAL_TRANSPORTS other than
+                this address's own, and those addresses are registered too.
 
             request_port : int, optional
                 Port to which the request socket should be bound
             srap : string, optional
                 String of address:port where the service registry is located
+            workers : int, optional
+                Number of workers used to handle requests concurrently.  When
+                zero (the default) requests are handled one at a time on a
+                REP socket.  Otherwise the container binds a ROUTER socket,
+                hands each request to a worker and routes the replies back
+                as they complete, in any order.  Only containers with
+                workers apply MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS
+                and the limits of register_service.  Commands running on
+                worker threads can send requests of their own with
+                send_request, which hands them to the poll loop.
+            worker_type : string, optional
+                'thread' or 'process'; the kind of workers in the pool.
+                Metrics recorded while handling requests in worker processes
+                stay in those processes and are not reported.  Process
+                workers are forked from the container and cannot use it:
+                commands running on them cannot send requests nor
+                invalidate cached responses (Service.invalidate), which
+                raise RuntimeError there.
+            metrics_path : string, optional
+                If given, a MetricsService reporting this container's metrics
+                is registered at this path, e.g. '/metrics/orders-1'.
+            processes : int, optional
+                If given, the container supervises this many forked
+                processes, each hosting every service registered with the
+                container (with its own workers, if any), and forwards the
+                requests it receives to them; see zen.fabric.supervisor.
+                The processes are started by run(), so register the services
+                first.  Requests for metrics_path are answered by one of the
+                processes, with its own metrics.
+            prefetch : list, optional
+                Paths or prefixes of the services this container calls, to
+                resolve up front; see ServiceEndpoint.init.
         '''
-        socket = self.socket(zmq.REP, self._handle_request)
-        if request_port:
+        self._set_limits()
+        if processes:
+            self._supervisor = Supervisor(self, processes, srap, workers, worker_type)
+            socket = self._supervisor.frontend
+        else:
+            socket = self._request_socket(workers, worker_type)
+        if '://' in request_address:
+            socket.bind(request_address)
+        elif request_port:
             socket.bind('tcp://{0}:{1}'.format(request_address, request_port))
             self._request_port = request_port
         else:
             bind_address = 'tcp://{0}'.format(request_address)
-            print('Binding to {0}'.format(bind_address))
+            log.debug('Binding to %s', bind_address)
             self._request_port = socket.bind_to_random_port(bind_address)                 
         
         if request_address == '*':
             self._request_address = 'localhost' #sys_socket.getfqdn()
         else:
             self._request_address = request_address
+        self._local_addresses = self._bind_local(socket, transport.transport_of(request_address))
+        super(ServiceContainer, self).init(srap, prefetch)
+        log.info('Service container ready on %s',
+                 transport.request_address(self._request_address, self._request_port))
+        if metrics_path:
+            self.register_service(MetricsService(), metrics_path)
+
+    def _bind_local(self, socket, bound):
+        ''' Bind the request socket to the LOCAL_TRANSPORTS other than the
+            one already bound, and return their registration entries.
+        '''
+        addresses = {}
+        for name in self.LOCAL_TRANSPORTS:
+            if name == bound or name == transport.IPC and not zmq.has('ipc'):
+                continue
+            address = transport.local_address(name, tempfile.gettempdir())
+            socket.bind(address)
+            log.debug('Also accepting requests on %s', address)
+            addresses[name] = address
+        return transport.local_addresses(addresses, self._context)
+
+    def _request_socket(self, workers, worker_type):
+        ''' Create the request socket, and the worker pool if there is one '''
+        if not workers:
+            return self.socket(zmq.REP, self._handle_request)
+        self._worker_pool = WorkerPool(self, workers, worker_type)
+        self.metrics.gauge('worker_queue', lambda: self._worker_pool.pending)
+        if self.MAX_CONCURRENT_REQUESTS is None:
+            self._admission.max_concurrent = workers
+        return self.socket(zmq.ROUTER, self._route_request)
+
+    def _init_worker_process(self, address, srap, workers, worker_type):
+        ''' Initialize a container in a process forked by a Supervisor,
+            serving the requests it forwards to address.
+        '''
+        self._set_limits()
+        socket = self._request_socket(workers, worker_type)
+        socket.bind(address)
         super(ServiceContainer, self).init(srap)
-        print('Service container ready on port {0}'.format(self._request_port))
 
-    def register_service(self, service, path, localOnly=False):
+    def _set_limits(self):
+        self._admission.max_concurrent = self.MAX_CONCURRENT_REQUESTS
+        self._admission.max_queued = self.MAX_QUEUED_REQUESTS
+
+    def run(self, pacing=1000):
+        if self._supervisor is not None:
+            self._supervisor.start()
+        super(ServiceContainer, self).run(pacing)
+
+    def register_service(self, service, path, localOnly=False, max_concurrent=None, max_queued=None,
+                         subtree=False):
         ''' Register a local service with this service registery
         
         Params
@@ -55,45 +225,626 @@ class ServiceContainer(ServiceEndpoint):
         localOnly : boolean
             True if this service should not be registered with the remote service
             registry.
+        max_concurrent : int, optional
+            Number of requests for path handled at once, within the
+            container's MAX_CONCURRENT_REQUESTS.
+        max_queued : int, optional
+            Number of requests for path that can wait; further ones are
+            answered as overloaded.
+        subtree : boolean
+            True if the service also handles the paths below path (e.g.
+            '/orders/42' for '/orders') that have no service of their own.
         '''
         self._services[path] = service
+        if subtree:
+            self._subtrees.add(path)
+        else:
+            self._subtrees.discard(path)
         service._container = self
+        # Build the class's command table now rather than on the first request
+        service.commands()
+        self._admission.set_path_limits(path, max_concurrent, max_queued)
         if localOnly:
             return
         # Register with the remote service registry
-        self._service_registry.register_service(path, self._request_address, self._request_port)
+        self._registered_paths.append(path)
+        self._register_remote(path)
+        if self._renewal is None:
+            self._renewal = self.call_later(self.REGISTRATION_TTL / 3.0, self._renew_registrations)
+
+    def _register_remote(self, path):
+        self._service_registry.register_service(path, self._request_address, self._request_port,
+                                                available_codecs(), self.REGISTRATION_TTL,
+                                                path in self._subtrees, self._local_addresses,
+                                                available_compressions())
+
+    def _renew_registrations(self):
+        for path in self._registered_paths:
+            self._register_remote(path)
+        self._renewal = self.call_later(self.REGISTRATION_TTL / 3.0, self._renew_registrations)
+
+    def service_paths(self, service):
+        ''' Paths a service is registered at '''
+        return [path for path, registered in self._services.items() if registered is service]
+
+    def set_profiler(self, profiler):
+        ''' Have profiler (e.g. a zen.fabric.tracing.SamplingProfiler) run
+            the calls to the services' handle_request, as
+            profiler.call('path command', handle_request, client_id,
+            request); None stops profiling.
+        '''
+        self._profiler = profiler
+
+    def invalidate_responses(self, path=None, command=None, args=None):
+        ''' Drop cached responses (see zen.fabric.cache.cached) for path,
+            command and args; each of them matches everything when omitted.
+            Only this container's cache is affected, not those of the
+            processes of a supervisor or of other instances.  Process
+            workers cannot invalidate responses: this raises RuntimeError
+            there.
+        '''
+        self._check_process()
+        self._response_cache.invalidate(path, command, args)
 
     def _get_service(self, path):
+        owner = self._owner_path(path)
+        return self._services[owner] if owner is not None else None
+
+    def _owner_path(self, path):
+        ''' Path of the service that handles path: path itself, or the
+            subtree it is below; None if no service handles it.
+        '''
         if path in self._services:
-            return self._services[path]
+            return path
+        if self._subtrees and path:
+            for prefix in ancestors(path):
+                if prefix in self._subtrees:
+                    return prefix
+        return None
+
+    def _deliver(self, request, msg_id, params=None):
+        ''' Requests for services registered with this container (including
+            localOnly ones) are handed to the service directly, without
+            going through the service registry, a socket or a codec; the
+            reply is the object returned by the service, not a copy (unless
+            the workers are processes).  With workers, they are admitted
+            and run on the worker pool like the requests the container
+            receives; otherwise they run on the poll loop.  Other requests,
+            and those answered by several replies, are sent as usual.
+        '''
+        if msg_id in self._partial_replies or self._get_service(request['path']) is None:
+            super(ServiceContainer, self)._deliver(request, msg_id, params)
+        # On the next pass of the poll loop, so the call stays asynchronous
+        # like a remote one
+        elif self._admits_requests():
+            self.call_later(0, self._admit_local, msg_id, request, params)
         else:
-            return None
+            self.call_later(0, self._dispatch_local, msg_id, request)
+
+    def _admits_requests(self):
+        ''' True if requests are admitted (see _admit_request) before they
+            are handled, which they are when there are workers to run them
+        '''
+        return self._worker_pool is not None
+
+    def _admit_local(self, msg_id, request, params=None):
+        ''' Admit a request sent to one of this container's services the
+            way _admit_request admits those received
+        '''
+        if msg_id not in self._requests:
+            # Timed out already
+            return
+        path = self._owner_path(request['path']) if self._admission.has_path_limits else None
+        rejected = self._admission.add(path, priority_of(params or {}), (None, None, msg_id, request))
+        if rejected is not None:
+            self._reject_request(*rejected)
+        self._start_requests()
+
+    def _submit_local(self, msg_id, request):
+        ''' Hand an admitted request sent to one of this container's
+            services to the worker pool
+        '''
+        def done(succeeded, result):
+            if not succeeded:
+                log.error('Worker failed: %s', result)
+                result = { 'status' : 'error', 'message' : result }
+            self._local_reply(msg_id, result)
+
+        self._submit(self._call_local, _dispatch_in_worker, (msg_id, request), done)
+
+    def _dispatch_local(self, msg_id, request):
+        ''' Dispatch a request sent to one of this container's services on
+            the poll loop
+        '''
+        if msg_id not in self._requests:
+            # Timed out already
+            return
+        try:
+            response = self._call_local(msg_id, request)
+        except Exception as e:
+            self._local_failed(msg_id, e)
+            return
+        self._local_reply(msg_id, response)
+
+    def _call_local(self, msg_id, request):
+        ''' Dispatch a request sent to one of this container's services,
+            within the span of the request if it is traced
+        '''
+        span = self._spans.get(msg_id)
+        if span is None:
+            return self._dispatch(msg_id, request)
+        return self._dispatch_in_span(span, msg_id, request)
+
+    def _local_reply(self, msg_id, response):
+        ''' Answer a request sent to one of this container's services '''
+        self._request_done(msg_id)
+        reply_received = self._pop_request(msg_id)
+        if reply_received is None:
+            # Timed out meanwhile
+            return
+        key, sent = self._request_started.pop(msg_id)
+        self.metrics.observe('request_latency', key, clock() - sent)
+        span = self._spans.pop(msg_id, None)
+        if span is not None:
+            self._end_client_span(span, None, 0.0, response)
+        reply_received.callback(response)
+
+    def _local_failed(self, msg_id, error):
+        self._request_done(msg_id)
+        if msg_id in self._requests:
+            self._request_failed(error, msg_id)
+
+    def _teardown(self):
+        super(ServiceContainer, self)._teardown()
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+            # Best effort; registrations expire anyway if this doesn't reach
+            # the service registry
+            for path in self._registered_paths:
+                self._service_registry.unregister_service(path, self._request_address, self._request_port)
+        if self._worker_pool is not None:
+            self._worker_pool.close()
+            self._worker_pool = None
+        if self._supervisor is not None:
+            self._supervisor.close()
+            self._supervisor = None
+        self._streams = {}
+        if 'IPC' in self._local_addresses:
+            try:
+                os.remove(self._local_addresses['IPC'][len('ipc://'):])
+            except OSError:
+                pass
 
     def _handle_request(self, socket):
         ''' Handler for the request port.  This handles inbound request 
             messages.
         '''
-        print('in _handle_request')
-        msg_id, request_string = socket.recv_multipart()
-        print('REQ: {0}'.format(request_string))
-        request = filter_json(json.loads(request_string))
+        frames = socket.recv_multipart(copy=False)
+        received = clock()
+        msg_id = frames[0].bytes
+        socket.send_multipart([msg_id] + self._process_request(msg_id, frames[1:], received), copy=False)
+
+    def _route_request(self, socket):
+        ''' Handler for the request port when running with a worker pool.
+            Requests are handed to the pool and the replies are routed back
+            to the originating client by its identity envelope.
+        '''
+        frames = socket.recv_multipart(copy=False)
+        # Everything up to and including the empty delimiter frame is the
+        # routing envelope added by the client's socket and the ROUTER.
+        delimiter = 0
+        while len(frames[delimiter]):
+            delimiter += 1
+        envelope = [frame.bytes for frame in frames[:delimiter + 1]]
+        msg_id = frames[delimiter + 1].bytes
+        self._admit_request(socket, envelope, msg_id, frames[delimiter + 2:])
+
+    def _admit_request(self, socket, envelope, msg_id, frames):
+        ''' Submit a request received on the ROUTER socket if the
+            container's limits allow, else queue it, or answer it as
+            overloaded if the queue is full.
+        '''
+        params = message_params(frames)
+        if 'credit' in params or 'cancel' in params:
+            # Control messages of streams already admitted
+            self._submit_request(socket, envelope, msg_id, frames)
+            return
+        if 'trace' in params:
+            self._received[msg_id] = clock()
+        # Requests for paths below a subtree count against the subtree's limits
+        path = self._owner_path(self._request_path(frames)) if self._admission.has_path_limits else None
+        rejected = self._admission.add(path, priority_of(params), (socket, envelope, msg_id, frames))
+        if rejected is not None:
+            self._reject_request(*rejected)
+        self._start_requests()
+
+    def _start_requests(self):
+        ''' Submit the queued requests the limits now allow '''
+        while True:
+            admitted = self._admission.next()
+            if admitted is None:
+                return
+            path, (socket, envelope, msg_id, frames) = admitted
+            self._admitted[msg_id] = path
+            try:
+                if socket is not None:
+                    self._submit_request(socket, envelope, msg_id, frames)
+                elif msg_id in self._requests:
+                    # Sent to one of this container's own services; frames
+                    # is the request itself
+                    self._submit_local(msg_id, frames)
+                else:
+                    # Sent to one of this container's own services, and
+                    # timed out while it waited
+                    self._request_done(msg_id)
+            except Exception:
+                log.exception('Failed to submit request %s', msg_id)
+                self._request_done(msg_id)
+
+    def _request_done(self, msg_id):
+        ''' Release the place of an admitted request once it is answered (or
+            its response is streaming) and start the next one
+        '''
+        if msg_id not in self._admitted:
+            return
+        self._admission.done(self._admitted.pop(msg_id))
+        self._start_requests()
+
+    def _request_path(self, frames):
+        try:
+            return decode_message(frames)[0].get('path')
+        except UnsupportedCodecError:
+            return None
+
+    def _reject_request(self, socket, envelope, msg_id, frames):
+        ''' Answer a request the container has no room for '''
+        self._received.pop(msg_id, None)
+        log.info('Rejecting request %s; overloaded', msg_id)
+        self.metrics.increment('overloaded')
+        response = { 'status' : 'error', 'error' : 'overloaded',
+                     'message' : 'Service container overloaded; try again later' }
+        if socket is None:
+            # Sent to one of this container's own services
+            self._local_reply(msg_id, response)
+            return
+        codec_name = parse_header(frames[0])[0] if len(frames) > 1 else DEFAULT_CODEC
+        if codec_name not in available_codecs():
+            codec_name = DEFAULT_CODEC
+        socket.send_multipart(envelope + [msg_id] + encode_message(response, codec_name), copy=False)
+
+    def _submit_request(self, socket, envelope, msg_id, frames):
+        ''' Hand a request received on the ROUTER socket to the worker pool
+            and send the reply when it completes.
+
+            Params
+            ======
+            envelope : list
+                Routing frames, up to and including the empty delimiter
+            frames : list
+                Frames of the request message (header, body, buffers)
+        '''
+        params = message_params(frames)
+        if 'credit' in params or 'cancel' in params:
+            self._control_stream(msg_id, params)
+            return
+        received = self._received.pop(msg_id, None)
+        if 'stream' in params and self._worker_pool.worker_type == THREAD:
+            self._open_stream(socket, envelope, msg_id, frames, int(params['stream']), received)
+            return
+        key = self._call_key(frames) if 'idempotent' in params else None
+        if key is not None:
+            if key in self._shared_calls:
+                # Reply along with the identical request being handled,
+                # which needs no place of its own
+                self._shared_calls[key].append((envelope, msg_id))
+                self.metrics.increment('coalesced_requests', '{0} {1}'.format(key[1], key[2]))
+                self._request_done(msg_id)
+                return
+            self._shared_calls[key] = []
+
+        def send_reply(succeeded, result):
+            if not succeeded:
+                log.error('Worker failed: %s', result)
+                result = encode_message({ 'status' : 'error', 'message' : result })
+            socket.send_multipart(envelope + [msg_id] + result, copy=False)
+            if key is not None:
+                for shared_envelope, shared_msg_id in self._shared_calls.pop(key):
+                    socket.send_multipart(shared_envelope + [shared_msg_id] + result, copy=False)
+            self._request_done(msg_id)
+
+        if self._worker_pool.worker_type != THREAD:
+            # Frames are handed to the worker processes by pickling
+            frames = [to_bytes(frame) for frame in frames]
+        self._submit(self._process_request, _process_in_worker, (msg_id, frames, received), send_reply)
+
+    def _call_key(self, frames):
+        ''' Key identifying identical requests, or None if the request can't
+            be shared.  Requests are only decoded here, on the poll loop,
+            when they are marked idempotent.
+        '''
+        try:
+            request, codec_name = decode_message(frames)
+        except UnsupportedCodecError:
+            return None
+        key = request_key(request)
+        # Replies are encoded and compressed once for all the requests
+        # sharing them
+        return key and (codec_name,) + key + (message_params(frames).get('accept'),)
+
+    def _submit(self, func, worker_func, args, on_done):
+        ''' Submit func(*args) to the worker pool, or worker_func(*args) if
+            the workers are processes.  worker_func must be a module level
+            function; it can reach the container through _worker_container.
+            on_done is called as on_done(succeeded, result).
+        '''
+        if self._worker_pool.worker_type == THREAD:
+            self._worker_pool.submit(func, args, on_done)
+        else:
+            global _worker_container
+            _worker_container = self
+            self._worker_pool.submit(worker_func, args, on_done)
+
+    def _open_stream(self, socket, envelope, msg_id, frames, credit, received=None):
+        ''' Dispatch a request for a streamed response on the worker pool,
+            and start streaming the response if the service returns an
+            iterator.
+        '''
+        def opened(succeeded, result):
+            if not succeeded:
+                log.error('Worker failed: %s', result)
+                result = (None, encode_message({ 'status' : 'error', 'message' : result }))
+            codec_name, response = result
+            if codec_name is None:
+                # Not an iterator; the response is already encoded
+                socket.send_multipart(envelope + [msg_id] + response, copy=False)
+                self._request_done(msg_id)
+                return
+            stream = OutputStream(socket, envelope, msg_id, response, codec_name, credit)
+            self._streams[msg_id] = stream
+            stream.timer = self.call_later(self.STREAM_TIMEOUT, self._stream_timed_out, msg_id)
+            # A stream can wait for credit indefinitely, so it doesn't keep
+            # its place; its items are produced alongside other requests.
+            self._request_done(msg_id)
+            self._pump_stream(stream)
+
+        self._worker_pool.submit(self._begin_stream, (msg_id, frames, received), opened)
+
+    def _begin_stream(self, msg_id, frames, received=None):
+        ''' Returns (codec name, iterator) if the service returned an
+            iterator, else (None, frames of the encoded response).  Runs on
+            a worker thread.  The span of a traced request ends once the
+            service has returned; the items streamed aren't part of it.
+        '''
+        span = self._server_span(frames, received)
+        codec_name, response = self._handle(msg_id, frames, span)
+        if is_iterator(response):
+            if span is not None:
+                self._end_span(span)
+            return codec_name, response
+        frames = self._encode_response(response, codec_name, self._reply_compression(frames),
+                                       self._reply_params(span))
+        if span is not None:
+            span.lap('encode')
+            self._end_server_span(span, response)
+        return None, frames
+
+    def _pump_stream(self, stream):
+        ''' Have a worker pull as many items from a stream's iterator as its
+            credit allows, unless one already is.
+        '''
+        if stream.busy or stream.finished or stream.credit <= 0:
+            return
+
+        def produced(succeeded, result):
+            stream.busy = False
+            if not succeeded:
+                log.error('Worker failed: %s', result)
+                result = [encode_message({ 'status' : 'error', 'message' : result }, stream.codec_name)]
+                stream.finished = True
+            for frames in result:
+                stream.socket.send_multipart(stream.envelope + [stream.msg_id] + frames, copy=False)
+            stream.credit -= len(result)
+            self.metrics.increment('stream_messages', value=len(result))
+            if stream.finished or stream.cancelled:
+                self._close_stream(stream)
+            else:
+                self._pump_stream(stream)
+
+        stream.busy = True
+        self._worker_pool.submit(stream.produce, (stream.credit,), produced)
+
+    def _control_stream(self, msg_id, params):
+        ''' Handle a control message from the client of a stream '''
+        stream = self._streams.get(msg_id)
+        if stream is None:
+            # Already finished or abandoned
+            return
+        if 'cancel' in params:
+            self._cancel_stream(stream)
+            return
+        stream.credit += int(params['credit'])
+        stream.timer.cancel()
+        stream.timer = self.call_later(self.STREAM_TIMEOUT, self._stream_timed_out, msg_id)
+        self._pump_stream(stream)
+
+    def _stream_timed_out(self, msg_id):
+        stream = self._streams.get(msg_id)
+        if stream is not None:
+            log.info('Abandoning stream %s; no credit from the client', msg_id)
+            stream.timer = None
+            self._cancel_stream(stream)
+
+    def _cancel_stream(self, stream):
+        stream.cancelled = True
+        if not stream.busy:
+            # Otherwise closed when the worker is done with it
+            self._close_stream(stream)
+
+    def _close_stream(self, stream):
+        self._streams.pop(stream.msg_id, None)
+        stream.close()
+
+    def _process_request(self, msg_id, frames, received=None):
+        ''' Decode a request, dispatch it to its service and return the
+            frames of the encoded response.  The response is encoded with
+            the same codec as the request.  This may run on a worker thread
+            or process.  received is the clock() time the request arrived,
+            if it is traced.
+        '''
+        span = self._server_span(frames, received)
+        codec_name, response = self._handle(msg_id, frames, span)
+        if span is None:
+            return self._encode_reply(msg_id, frames, codec_name, response)
+        reply = self._encode_reply(msg_id, frames, codec_name, response, self._reply_params(span))
+        span.lap('encode')
+        self._end_server_span(span, response)
+        return reply
+
+    def _server_span(self, frames, received=None):
+        ''' A span for handling the request in frames if it is traced, else
+            None.  Its first lap is the time since the request was received.
+        '''
+        context = message_params(frames).get('trace')
+        context = context and tracing.parse_context(context)
+        if not context:
+            return None
+        span = tracing.Span(context[0], context[1], 'server', started=received)
+        span.lap('queue')
+        return span
+
+    def _reply_params(self, span):
+        ''' Header parameters of the reply to a traced request: the seconds
+            spent on it so far, which the client takes from its latency to
+            tell the time on the network
+        '''
+        if span is None:
+            return None
+        return { 'elapsed' : '{0:.6f}'.format(span.elapsed()) }
+
+    def _end_server_span(self, span, response):
+        error = None
+        if isinstance(response, dict) and response.get('status') == 'error':
+            error = response.get('error', 'error')
+        self._end_span(span, error)
+
+    def _encode_reply(self, msg_id, frames, codec_name, response, params=None):
+        ''' Returns the frames of the response to the request in frames '''
+        if is_iterator(response):
+            # The response can't be streamed from here, so collect it
+            try:
+                response = list(response)
+            except Exception:
+                log.exception('Response to %s failed', msg_id)
+                response = { 'status' : 'error', 'message' : traceback.format_exc() }
+            else:
+                if 'stream' in message_params(frames):
+                    response = { 'stream' : { 'items' : response, 'end' : True } }
+        return self._encode_response(response, codec_name, self._reply_compression(frames), params)
+
+    def _handle(self, msg_id, frames, span=None):
+        ''' Decode a request and dispatch it to its service, recording the
+            time taken by each in span, if given.
+
+            Returns (codec name, response)
+        '''
+        started = clock()
+        try:
+            request, codec_name = decode_message(frames)
+        except UnsupportedCodecError as e:
+            log.warning('Rejecting request %s: %s', msg_id, e)
+            response = { 'status' : 'error', 'error' : 'unsupported_codec',
+                         'message' : str(e), 'codecs' : available_codecs() }
+            return DEFAULT_CODEC, response
+        decoded = clock()
+        self.metrics.observe('decode_time', codec_name, decoded - started)
+
+        log.debug('REQ %s: %s', msg_id, request)
+        if span is None:
+            response = self._dispatch(msg_id, request)
+        else:
+            span.name = '{0} {1}'.format(request.get('path'), request.get('command'))
+            span.lap('decode')
+            response = self._dispatch_in_span(span, msg_id, request)
+            span.lap('dispatch')
+        log.debug('REP %s: %s', msg_id, response)
+        return codec_name, response
+
+    def _dispatch_in_span(self, span, msg_id, request):
+        ''' Dispatch a request with span as the current span, so requests
+            the service sends meanwhile are part of its trace
+        '''
+        previous = tracing.activate(span)
+        try:
+            return self._dispatch(msg_id, request)
+        finally:
+            tracing.activate(previous)
+
+    def _encode_response(self, response, codec_name, compression_name=None, params=None):
+        started = clock()
+        frames = encode_message(response, codec_name, params)
+        self.metrics.observe('encode_time', codec_name, clock() - started)
+        return self._compress(frames, compression_name)
+
+    def _reply_compression(self, frames):
+        ''' The compression the client of the request in frames accepts
+            replies compressed with, if any
+        '''
+        accept = message_params(frames).get('accept')
+        return accept if accept in available_compressions() else None
+
+    def _dispatch(self, msg_id, request):
+        ''' Dispatch a decoded request to its service and return the
+            response.
+        '''
         if 'path' not in request:
             #TODO Log error; requests without a path cannot be handled
-            print('Error, no path specified.')
-            return
+            log.warning('Request %s has no path', msg_id)
+            return { 'status' : 'error', 'message' : 'No path specified' }
+
+        deadline = request.get('deadline')
+        if deadline is not None and deadline < time.time():
+            # The caller has already given up on this request
+            log.info('Skipping expired request %s', msg_id)
+            self.metrics.increment('expired', request['path'])
+            return { 'status' : 'error', 'error' : 'expired',
+                     'message' : 'Request deadline expired' }
 
         service = self._get_service(request['path'])
         if not service:
             #TODO Log an error, or check to see if  the service exists in a 
             # federated registry or gateway
-            print('Error, service path not specified')
-            return
+            log.warning('Request %s for unknown service %s', msg_id, request['path'])
+            return { 'status' : 'error', 
+                     'message' : 'Unknown service path {0}'.format(request['path']) }
 
-        response = service.handle_request(msg_id, request)
+        key = '{0} {1}'.format(request['path'], request.get('command'))
+        command = service.commands().get(request.get('command'))
+        ttl = command.cache_ttl if command is not None else None
+        cache_key = request_key(request) if ttl is not None else None
+        if cache_key is not None and service is not self._services.get(request['path']):
+            # Keyed by the subtree's path, so the service's invalidate()
+            # drops it too
+            cache_key = (self._owner_path(request['path']),) + cache_key[1:] + (request['path'],)
+        if cache_key is not None:
+            hit, response = self._response_cache.get(cache_key)
+            self.metrics.increment('response_cache', 'hit' if hit else 'miss')
+            if hit:
+                return response
+
+        started = clock()
+        if self._profiler is not None:
+            response = self._profiler.call(key, service.handle_request, msg_id, request)
+        else:
+            response = service.handle_request(msg_id, request)
+        self.metrics.observe('dispatch_time', key, clock() - started)
+        self.metrics.increment('requests', key)
         
         if response is None:
             response = {}
-
-        response_string = json.dumps(response)
-        print('REP: {0}'.format(response_string))
-        socket.send_multipart([msg_id, response_string])
+        elif isinstance(response, dict) and response.get('status') == 'error':
+            self.metrics.increment('errors', key)
+            return response
+        if cache_key is not None and isinstance(response, (dict, list)):
+            self._response_cache.put(cache_key, response, ttl)
+        return response
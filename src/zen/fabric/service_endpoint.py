@@ -1,42 +1,153 @@
-import json
-import traceback
-from twisted.internet import defer
+import collections
+import logging
+import math
+import os
+import random
+import threading
+import time
 import uuid
 import zmq
 
-from zen.fabric.task_schedule import TaskSchedule
+from zen.fabric import admission, codec, compression, tracing
+from zen.fabric.cache import ResponseCache, request_key
+from zen.fabric.deferred import ThreadSafeDeferred
+from zen.fabric.errors import RequestTimeoutError, ServiceNotFoundError
+from zen.fabric.metrics import Metrics
+from zen.fabric.stream import ResponseStream
+from zen.fabric.task_schedule import TaskSchedule, clock
+from zen.fabric.transport import endpoint_url
 from zen.fabric.service_registry.proxy import ServiceRegistryProxy
-from zen.fabric.json_util import filter_json
+
+log = logging.getLogger(__name__)
+
+
+def new_msg_id():
+    ''' A unique message id, as bytes since it is sent as a frame '''
+    return uuid.uuid4().hex.encode('ascii')
+
 
 class ServiceEndpoint(object):
     ''' Service End-point
     
         An end-point for services and service clients.
     '''
-    def __init__(self):
-        self._context = zmq.Context()
+    # Maximum number of requests in flight on a single request connection;
+    # further requests are queued until replies free up the window.
+    REQUEST_WINDOW = 64
+    # Default number of seconds to wait for a reply before the request's
+    # Deferred is errbacked with a RequestTimeoutError; None waits forever.
+    REQUEST_TIMEOUT = 60
+    # Codecs to encode requests with, in order of preference.  Each request
+    # connection uses the first one the remote container also supports.
+    CODECS = (codec.DEFAULT_CODEC,)
+    # Compressions to use on request connections, in order of preference,
+    # e.g. ('lz4', 'zlib').  Each connection uses the first one the remote
+    # container also supports, for its requests and for the replies; none
+    # by default.  See zen.fabric.compression.
+    COMPRESSIONS = ()
+    # Smallest message body, in bytes, that is compressed
+    COMPRESS_THRESHOLD = 4096
+    # Policy for spreading requests across the instances of a service:
+    # 'round_robin', 'least_outstanding', 'latency_weighted' or a
+    # zen.fabric.load_balancer.LoadBalancer subclass
+    LOAD_BALANCER = 'round_robin'
+    # Default number of streamed messages that can be in transit or waiting
+    # to be consumed before the container waits for credit
+    STREAM_WINDOW = 16
+    # Number of replies kept for send_request's max_age
+    REPLY_CACHE_SIZE = 1024
+    # Priority of the requests sent, for containers that have to queue
+    # them; see zen.fabric.admission
+    REQUEST_PRIORITY = admission.NORMAL
+    # Fraction of requests to trace, besides those sent while handling a
+    # traced request, which always are; see zen.fabric.tracing
+    TRACE_SAMPLE_RATE = 0.0
+
+    def __init__(self, context=None):
+        ''' Params
+            ======
+            context : zmq.Context, optional
+                Context to create the sockets with; a new one when omitted.
+                End-points must share a context to reach each other over
+                inproc:// addresses.
+        '''
+        self._context = context or zmq.Context()
         self._poll = zmq.Poller()
         self._task_schedule = TaskSchedule()
         self._service_registry = None
+        self.metrics = Metrics()
+        self.metrics.gauge('in_flight', lambda: len(self._requests))
+        self.metrics.gauge('scheduled_tasks', lambda: len(self._task_schedule))
+        self.metrics.gauge('compression_ratio', self._compression_ratio)
         # Dictionary of sockets and the handler
         self._sockets = {}
+        # Dictionary of sockets and their zmq socket type
+        self._socket_types = {}
+        # Dictionary of sockets and the codec used to encode messages sent
+        # on them; sockets not listed use the default codec
+        self._socket_codecs = {}
+        # Dictionary of request connections and the compression negotiated
+        # for them, if any
+        self._socket_compressions = {}
+        # Request connections - socket : number of requests in flight
+        self._in_flight = {}
+        # Request connections - socket : queue of frames waiting for the 
+        # in-flight window to open
+        self._backlog = {}
+        # Request connections - socket : moving average of the reply latency
+        self._latency = {}
         # Outstanding requests - msg_id : callback
         self._requests = {}
+        # Outstanding requests - msg_id : ScheduledTask that times them out
+        self._request_timers = {}
+        # Outstanding requests - msg_id : request connection they were sent
+        # (or queued) on
+        self._request_sockets = {}
+        # Outstanding requests - msg_id : ('path command', time sent)
+        self._request_started = {}
+        # Outstanding requests answered by several replies - msg_id : 
+        # function called with each reply, returning True while more replies
+        # are expected
+        self._partial_replies = {}
+        self._reply_cache = ResponseCache(self.REPLY_CACHE_SIZE)
+        # Idempotent requests in flight - (path, command, args) : [deferred,
+        # ...]; the Deferreds of identical requests made meanwhile, which
+        # fire with the same reply
+        self._shared_requests = {}
+        # Traced requests - msg_id : Span
+        self._spans = {}
+        self._span_exporters = []
+        # Thread running the loop, while it runs
+        self._loop_thread = None
+        # Calls handed to the loop by other threads - (func, args); see
+        # call_soon_threadsafe
+        self._handed_over = collections.deque()
+        # The loop polls one end of an inproc pair, opened on its thread, and
+        # call_soon_threadsafe pokes the other end
+        self._wake_recv = None
+        self._wake_send = None
+        self._wake_lock = threading.Lock()
+        # Process the end-point was created in; see _check_process
+        self._pid = os.getpid()
 
-    def init(self, srap):
+    def init(self, srap, prefetch=None):
         ''' Initialize the service endpoint
         
             Params
             ======
             srap : string, optional
-                String of address:port where the service registry is located
+                String of address:port where the service registry is located,
+                or its ipc:// or inproc:// address
+            prefetch : list, optional
+                Service paths or prefixes (e.g. '/orders') to resolve in one
+                request now, instead of loading every registered path; see
+                ServiceRegistryProxy.
         '''
         if self._service_registry is not None:
-            #TODO Log
-            print('Error, already connected to service registry.')
+            log.error('Already connected to service registry')
             raise RuntimeError('Already connected to service registry')
 
-        self._service_registry = ServiceRegistryProxy(self, srap)
+        self._service_registry = ServiceRegistryProxy(self, srap, prefetch)
 
     def run(self, pacing=1000):
         ''' Run the service container in the current thread.
@@ -44,11 +155,14 @@ class ServiceEndpoint(object):
             Params
             =====
             pacing : int
-                timeout in milliseconds for each poll; this is the finest 
-                granularity of timeouts and other timed events.
+                maximum timeout in milliseconds for each poll.  Polls end
+                early when a scheduled task is due, so timed events fire 
+                with millisecond accuracy regardless of the pacing.
         '''
         # Indicate that the container is running
         self._is_running = True
+        self._loop_thread = threading.current_thread()
+        self._open_wake()
         
         # Loop until something has indicated that the container is no longer 
         # running
@@ -56,21 +170,139 @@ class ServiceEndpoint(object):
             try:
                 self._poll_once(pacing)
             except KeyboardInterrupt as e:
-                print('Got an exception:{0}'.format(traceback.format_exc()))
-                print('Shutting down via keyboard interrupt...')
+                log.info('Shutting down via keyboard interrupt...')
                 self.shutdown()
             except:
                 #TODO Handle errors instead of simply ignoring them.
-                print('Got an exception:{0}'.format(traceback.format_exc()))
+                log.exception('Error in poll loop')
                 continue
+        self._teardown()
+        self._loop_thread = None
 
     def shutdown(self):
+        ''' Stop the loop running the end-point.  This only sets a flag, so
+            it can be called from any thread; the end-point releases what
+            it holds on the loop's thread, once the loop has stopped.
+        '''
         self._is_running = False
 
+    def _teardown(self):
+        ''' Called on the loop's thread once it has stopped '''
+        self._close_wake()
+
+    def call_soon_threadsafe(self, func, *args):
+        ''' Call func(*args) on the loop's thread, as soon as the loop gets
+            to it.  Unlike the end-point's other methods, this can be called
+            from any thread; it wakes the loop rather than waiting for its
+            next poll.  Calls made before the loop runs are made once it
+            does.
+        '''
+        self._check_process()
+        with self._wake_lock:
+            self._handed_over.append((func, args))
+            if self._wake_send is not None:
+                self._wake()
+
+    def _on_loop_thread(self):
+        ''' False when called from a thread other than the one running the
+            loop, while it runs
+        '''
+        return self._loop_thread is None or self._loop_thread is threading.current_thread()
+
+    def _check_process(self):
+        ''' Raise RuntimeError in processes forked from the one the
+            end-point was created in, e.g. a container's process workers,
+            which inherit its sockets but not the thread running its loop.
+        '''
+        if os.getpid() != self._pid:
+            raise RuntimeError('The end-point cannot be used from a forked process')
+
+    def _call_from_thread(self, func, *args):
+        ''' Call func(*args), which returns a Deferred, on the loop's thread
+            for a call made on another thread.  Returns a ThreadSafeDeferred
+            fired on the loop's thread with the result of func's.
+        '''
+        result = ThreadSafeDeferred()
+
+        def call():
+            try:
+                called = func(*args)
+            except Exception as e:
+                result.errback(e)
+                return
+            called.addCallbacks(result.callback, lambda failure: result.errback(failure.value))
+
+        self.call_soon_threadsafe(call)
+        return result
+
+    def _open_wake(self):
+        ''' Open the sockets call_soon_threadsafe wakes the loop through,
+            unless they are open; called on the loop's thread.
+        '''
+        if self._wake_recv is not None:
+            return
+        address = 'inproc://zen-wake-{0}'.format(uuid.uuid4().hex)
+        self._wake_recv = self.socket(zmq.PAIR, self._handle_wake)
+        self._wake_recv.bind(address)
+        with self._wake_lock:
+            self._wake_send = self._context.socket(zmq.PAIR)
+            self._wake_send.connect(address)
+            if self._handed_over:
+                # Handed over before the loop ran
+                self._wake()
+
+    def _close_wake(self):
+        if self._wake_recv is None:
+            return
+        with self._wake_lock:
+            self._wake_send.close(linger=0)
+            self._wake_send = None
+        self._poll.unregister(self._wake_recv)
+        self._sockets.pop(self._wake_recv, None)
+        self._socket_types.pop(self._wake_recv, None)
+        self._wake_recv.close(linger=0)
+        self._wake_recv = None
+
+    def _wake(self):
+        # Called with _wake_lock held
+        try:
+            self._wake_send.send(b'', zmq.NOBLOCK)
+        except zmq.Again:
+            # The loop already has wake-ups queued; it makes this call along
+            # with theirs
+            pass
+
+    def _handle_wake(self, socket):
+        # Drain every queued wake-up, then every call handed over
+        while True:
+            try:
+                socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while self._handed_over:
+            func, args = self._handed_over.popleft()
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Call handed to the loop failed')
+
     def _error(self, error):
-        print('Error: {0}'.format(error))
+        log.error('Error: %s', error)
+
+    def _new_deferred(self):
+        ''' Returns a new Deferred.  Twisted is only imported once one is
+            needed, so processes that never send a request don't load it.
+        '''
+        from twisted.internet import defer
+        return defer.Deferred()
 
-    def send_request(self, request):
+    def call_later(self, seconds, func, *args):
+        ''' Call func(*args) from the poll loop in the specified number of
+            seconds.  Returns a ScheduledTask that can cancel the call.
+        '''
+        return self._task_schedule.call_later(seconds, func, *args)
+
+    def send_request(self, request, timeout=None, max_age=None, idempotent=False):
         ''' Send a request. This assumes the request has a path, and it uses
             the service registry to determine which socket can handle the
             request based on the service registry.
@@ -80,57 +312,383 @@ class ServiceEndpoint(object):
             request : dictionary
                 Standard request message that contains a path, command, and
                 args entries.
+            timeout : float, optional
+                Seconds to wait for the reply; defaults to REQUEST_TIMEOUT.
+                The deadline is sent with the request so the container can
+                skip the work if it arrives too late.
+            max_age : float, optional
+                If given, a reply to an earlier request with the same path,
+                command and args that is at most this many seconds old is
+                used instead of sending the request, and the reply to this
+                one is kept for reuse.  Error replies are not kept.
+            idempotent : bool, optional
+                True if the request can be shared with identical requests
+                (same path, command and args): while one is in flight, the
+                others wait for its reply instead of being sent, and the
+                container lets identical requests from other clients share
+                its response too.  Every caller gets the same reply object.
+
+            Unlike the end-point's other methods, send_request can also be
+            called from threads other than the loop's, e.g. by commands
+            running on a container's worker threads.  The request is then
+            handed to the loop, which sends it, and the Deferred returned is
+            a zen.fabric.deferred.ThreadSafeDeferred, whose wait() blocks
+            until the reply arrives.  Requests to the container's own
+            services need a free worker to be handled by.  Commands running
+            on process workers cannot send requests: send_request raises
+            RuntimeError there.
 
             Returns
             =======
             reply_received : defer.Deferred
                 Deferred object that is fired when the reply to the request
-                has been received.
+                has been received, or errbacked with a RequestTimeoutError
+                if the deadline passes first.  It is fired on the loop's
+                thread.
+        '''
+        self._check_process()
+        parent = tracing.current_span()
+        if not self._on_loop_thread():
+            return self._call_from_thread(self._send, request, timeout, max_age, idempotent, parent)
+        return self._send(request, timeout, max_age, idempotent, parent)
+
+    def _send(self, request, timeout, max_age, idempotent, parent):
+        ''' Send a request; see send_request.  parent is the span of the
+            request being handled where send_request was called, if any,
+            which the request's span is a child of.
+        '''
+        key = request_key(request) if max_age is not None or idempotent else None
+        if key is None:
+            return self._send_request(request, timeout, parent=parent)
+
+        if max_age is not None:
+            hit, reply = self._reply_cache.get(key, max_age)
+            self.metrics.increment('reply_cache', 'hit' if hit else 'miss')
+            if hit:
+                reply_received = self._new_deferred()
+                reply_received.callback(reply)
+                return reply_received
+        if idempotent and key in self._shared_requests:
+            reply_received = self._new_deferred()
+            self._shared_requests[key].append(reply_received)
+            self.metrics.increment('coalesced_requests', '{0} {1}'.format(key[0], key[1]))
+            return reply_received
+
+        reply_received = self._send_request(request, timeout, { 'idempotent' : 1 } if idempotent else None,
+                                            parent=parent)
+        if max_age is not None:
+            reply_received.addCallback(self._cache_reply, key, max_age)
+        if idempotent:
+            self._shared_requests[key] = []
+            reply_received.addCallback(self._share_reply, key)
+            reply_received.addErrback(self._share_failure, key)
+        return reply_received
+
+    def _share_reply(self, reply, key):
+        # Fire the Deferreds of the requests sharing the reply
+        for reply_received in self._shared_requests.pop(key, []):
+            reply_received.callback(reply)
+        return reply
+
+    def _share_failure(self, failure, key):
+        for reply_received in self._shared_requests.pop(key, []):
+            reply_received.errback(failure)
+        return failure
+
+    def _cache_reply(self, reply, key, max_age):
+        if not (isinstance(reply, dict) and reply.get('status') == 'error'):
+            self._reply_cache.put(key, reply, max_age)
+        return reply
+
+    def invalidate_replies(self, path=None, command=None, args=None):
+        ''' Drop replies kept for send_request's max_age for path, command
+            and args; each of them matches everything when omitted.
+        '''
+        self._reply_cache.invalidate(path, command, args)
+
+    def stream_request(self, request, on_item, window=None, timeout=None):
+        ''' Send a request whose response is streamed, see zen.fabric.stream.
+            Call it on the loop's thread.
+
+            Params
+            ======
+            request : dictionary
+                Standard request message, as for send_request
+            on_item : function
+                Called with each item of the response as it arrives.  If it
+                returns a Deferred, the item only counts as consumed once
+                that fires, so a slow consumer holds back the container
+                instead of buffering the stream.
+            window : int, optional
+                Number of messages that can be in transit or waiting to be
+                consumed; defaults to STREAM_WINDOW.
+            timeout : float, optional
+                Seconds to wait for each message of the stream; defaults to
+                REQUEST_TIMEOUT.
+
+            Returns
+            =======
+            stream : ResponseStream
+                The stream's finished Deferred fires with the number of
+                items received once the stream ends.
+        '''
+        window = window or self.STREAM_WINDOW
+        if timeout is None:
+            timeout = self.REQUEST_TIMEOUT
+        stream = ResponseStream(self, new_msg_id(), on_item, window, timeout)
+        stream.finished = self._send_request(request, timeout, { 'stream' : window },
+                                             stream._on_message, stream.msg_id, tracing.current_span())
+        stream.finished.addCallback(stream._ended)
+        return stream
+
+    def _send_request(self, request, timeout=None, params=None, on_partial=None, msg_id=None, parent=None):
+        ''' Send a request; see send_request.
+
+            Params
+            ======
+            params : dictionary, optional
+                Parameters added to the message header
+            on_partial : function, optional
+                For requests answered by several replies: called with each
+                reply and returns True while more replies are expected.  The
+                returned Deferred fires with the last reply.
+            msg_id : string, optional
+                Message id to send the request with; a new one when omitted.
+            parent : Span, optional
+                Span of the request being handled by the caller, taken
+                (with tracing.current_span) on the caller's thread; the
+                request is traced as part of it.
         '''
         if 'path' not in request:
             raise RuntimeError('Cannot send request without a path')
+        self._check_process()
+        if not self._on_loop_thread():
+            raise RuntimeError('Only send_request can be called from threads other than the loop\'s')
+        if self.REQUEST_PRIORITY != admission.NORMAL:
+            params = dict(params or {}, priority=self.REQUEST_PRIORITY)
+        span = self._client_span(request, parent)
+        if span is not None:
+            params = dict(params or {}, trace=span.context)
 
         # Create a new Deferred to indicate when the reply to the request has
         # been received
-        reply_received = defer.Deferred()
+        reply_received = self._new_deferred()
         
         # The reponse will contain the message id, so associate the Deferred with 
         # this message id so it can be activated when the response is returned.
-        msg_id = uuid.uuid4().hex
+        if msg_id is None:
+            msg_id = new_msg_id()
         self._requests[msg_id] = reply_received
+        if span is not None:
+            self._spans[msg_id] = span
+        if on_partial is not None:
+            self._partial_replies[msg_id] = on_partial
+        self._request_started[msg_id] = (
+                '{0} {1}'.format(request['path'], request.get('command')), clock())
+
+        if timeout is None:
+            timeout = self.REQUEST_TIMEOUT
+        if timeout is not None:
+            # Wall clock time, since the container compares it with its own
+            request = dict(request, deadline=time.time() + timeout)
+            self._request_timers[msg_id] = self.call_later(timeout, self._request_timed_out, msg_id)
         
+        self._deliver(request, msg_id, params)
+        return reply_received
+
+    def _deliver(self, request, msg_id, params=None):
+        ''' Hand a request registered as outstanding by _send_request to
+            its service: resolve the service and send it the request.
+        '''
         # Asyncronously get the remote socket
         got_remote_socket = self._service_registry.get_remote_socket(request)
 
         # After that's gotten, send the request to that socket
-        got_remote_socket.addCallback(self.send_message_to_socket, request, msg_id)
-        got_remote_socket.addErrback(self._error)
+        got_remote_socket.addCallback(self._send_resolved_request, request, msg_id, params)
+        got_remote_socket.addErrback(self._request_failed, msg_id)
 
-        return reply_received
+    def _send_resolved_request(self, socket, request, msg_id, params=None):
+        if msg_id not in self._requests:
+            # Timed out while the service was being resolved
+            return
+        if socket is None:
+            raise ServiceNotFoundError('Unknown service {0}'.format(request['path']))
+        span = self._spans.get(msg_id)
+        if span is not None:
+            span.lap('resolve')
+        self.send_message_to_socket(socket, request, msg_id, params)
+
+    def add_span_exporter(self, exporter):
+        ''' Have exporter receive the spans of the traced requests this
+            end-point sends and handles; see zen.fabric.tracing.
+        '''
+        self._span_exporters.append(exporter)
+
+    def _client_span(self, request, parent=None):
+        ''' A span for a request about to be sent, if it is to be traced:
+            when it is sent while handling a traced request, whose span is
+            parent, or sampled at TRACE_SAMPLE_RATE
+        '''
+        name = '{0} {1}'.format(request['path'], request.get('command'))
+        if parent is not None:
+            return tracing.Span(parent.trace_id, parent.span_id, 'client', name)
+        if self.TRACE_SAMPLE_RATE and random.random() < self.TRACE_SAMPLE_RATE:
+            return tracing.Span(tracing.new_trace_id(), None, 'client', name)
+        return None
+
+    def _end_span(self, span, error=None):
+        ''' Finish a span and hand it to the exporters '''
+        span.end(error)
+        for exporter in self._span_exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                log.exception('Span exporter %s failed', exporter)
+
+    def _pop_request(self, msg_id):
+        ''' Remove an outstanding request, returning its Deferred (or None if
+            the request is no longer outstanding).
+        '''
+        timer = self._request_timers.pop(msg_id, None)
+        if timer is not None:
+            timer.cancel()
+        self._partial_replies.pop(msg_id, None)
+        return self._requests.pop(msg_id, None)
+
+    def _request_failed(self, failure, msg_id):
+        started = self._request_started.pop(msg_id, None)
+        if started is not None:
+            self.metrics.increment('request_failures', started[0])
+        span = self._spans.pop(msg_id, None)
+        if span is not None:
+            self._end_span(span, type(getattr(failure, 'value', failure)).__name__)
+        reply_received = self._pop_request(msg_id)
+        socket = self._request_sockets.pop(msg_id, None)
+        if socket is not None:
+            self._abandon_request(socket, msg_id)
+        if reply_received is None:
+            self._error(failure)
+        else:
+            reply_received.errback(failure)
+
+    def _cancel_request(self, msg_id, reply=None):
+        ''' Stop waiting for replies to an outstanding request; its Deferred
+            fires with reply.
+        '''
+        self._request_started.pop(msg_id, None)
+        span = self._spans.pop(msg_id, None)
+        if span is not None:
+            self._end_span(span, 'cancelled')
+        socket = self._request_sockets.pop(msg_id, None)
+        if socket is not None:
+            self._abandon_request(socket, msg_id)
+        reply_received = self._pop_request(msg_id)
+        if reply_received is not None:
+            reply_received.callback(reply)
+
+    def _extend_request(self, msg_id, timeout):
+        ''' Restart the timeout of an outstanding request '''
+        timer = self._request_timers.pop(msg_id, None)
+        if timer is not None:
+            timer.cancel()
+            self._request_timers[msg_id] = self.call_later(timeout, self._request_timed_out, msg_id)
+
+    def _send_control(self, msg_id, params):
+        ''' Send a control message (e.g. stream credit) for an outstanding
+            request on the connection the request was sent on.  Control
+            messages have no reply and bypass the in-flight window.
+        '''
+        socket = self._request_sockets.get(msg_id)
+        if socket is None:
+            return
+        codec_name = self._socket_codecs.get(socket, codec.DEFAULT_CODEC)
+        socket.send_multipart([b'', msg_id] + codec.encode_message({}, codec_name, params), copy=False)
+
+    def _request_timed_out(self, msg_id):
+        self._request_timers.pop(msg_id, None)
+        log.info('Request %s timed out', msg_id)
+        self.metrics.increment('request_timeouts', self._request_started[msg_id][0])
+        self._request_failed(RequestTimeoutError('No reply to request {0}'.format(msg_id)), msg_id)
+
+    def _abandon_request(self, socket, msg_id):
+        ''' Give up on a request sent or queued on a request connection; a
+            reply that arrives later is discarded.
+        '''
+        backlog = self._backlog.get(socket)
+        if backlog is None:
+            return
+        for entry in backlog:
+            if entry[0] == msg_id:
+                # Never sent; just drop it from the queue
+                backlog.remove(entry)
+                return
+        # The request is on the wire; DEALER connections don't wait for its
+        # reply, so only the slot in the in-flight window needs freeing.
+        self._release_window(socket)
+
+    def outstanding(self, socket):
+        ''' Number of requests sent or queued on a request connection that
+            have not been answered.
+        '''
+        return self._in_flight[socket] + len(self._backlog[socket])
 
-    def connect_request(self, address):
+    def latency(self, socket):
+        ''' Moving average of the reply latency, in seconds, on a request
+            connection; 0 until the first reply arrives.
+        '''
+        return self._latency.get(socket, 0.0)
+
+    def connect_request(self, address, codecs=None, compressions=None):
         ''' Connect to the specified address for sending request messages.
+
+            The connection is a DEALER socket, so any number of requests can
+            share it; replies are matched to their requests by msg_id.  At
+            most REQUEST_WINDOW requests are in flight at once, the rest are
+            queued and sent as replies arrive.
         
             Params
             ======
             address : string
-                address:port
+                address:port, or an ipc:// or inproc:// address
+            codecs : list, optional
+                Codecs supported by the remote container; requests are sent
+                with the first of CODECS in this list.
+            compressions : list, optional
+                Compressions supported by the remote container; requests
+                and replies are compressed with the first of COMPRESSIONS
+                in this list.
         '''
-        socket = self.socket(zmq.REQ, self._handle_response)
-        socket.connect('tcp://{0}'.format(address))
+        socket = self.socket(zmq.DEALER, self._handle_response)
+        socket.connect(endpoint_url(address))
+        self._socket_codecs[socket] = codec.negotiate(self.CODECS, codecs)
+        self._socket_compressions[socket] = compression.negotiate(self.COMPRESSIONS, compressions)
+        self._in_flight[socket] = 0
+        self._backlog[socket] = collections.deque()
         return socket
 
-    def send_message_to_socket(self, socket, message, msg_id=None):
+    def disconnect_request(self, socket):
+        ''' Close a connection opened by connect_request, which must have no
+            requests outstanding.
+        '''
+        self._poll.unregister(socket)
+        for sockets in (self._sockets, self._socket_types, self._socket_codecs, self._socket_compressions,
+                        self._in_flight, self._backlog, self._latency):
+            sockets.pop(socket, None)
+        socket.close(linger=0)
+
+    def send_message_to_socket(self, socket, message, msg_id=None, params=None):
         ''' Send a request to the specified socket.  
             
             Params
             ======
             socket : zmq.Socket
                 Socket through which the message will be sent
-            message : string
+            message : dictionary
                 Message to be sent
             msg_id : string
                 Unique message identifier
+            params : dictionary, optional
+                Parameters added to the message header
                 
             Returns
             =======
@@ -138,15 +696,60 @@ class ServiceEndpoint(object):
                 Message id of the message sent, which will be part of the
                 reply if there is one.
         '''
-        print('Sending to {0}'.format(socket))
         if msg_id is None:
-            msg_id = uuid.uuid4().hex
+            msg_id = new_msg_id()
+
+        log.debug('SND %s to %s: %s', msg_id, socket, message)
+        codec_name = self._socket_codecs.get(socket, codec.DEFAULT_CODEC)
+        compression_name = self._socket_compressions.get(socket)
+        if compression_name is not None:
+            # Have the reply compressed too
+            params = dict(params or {}, accept=compression_name)
+        started = clock()
+        frames = codec.encode_message(message, codec_name, params)
+        self.metrics.observe('encode_time', codec_name, clock() - started)
+        frames = [msg_id] + self._compress(frames, compression_name)
+        if self._socket_types.get(socket) == zmq.DEALER:
+            # Emulate the REQ envelope so REP and ROUTER peers can route the 
+            # reply back
+            frames.insert(0, b'')
 
-        message_str = json.dumps(message)
-        print('SND: {0}'.format(message_str))
-        socket.send_multipart([msg_id, message_str])
+        if socket in self._in_flight:
+            self._request_sockets[msg_id] = socket
+            if self._in_flight[socket] >= self.REQUEST_WINDOW:
+                self._backlog[socket].append((msg_id, frames))
+                return msg_id
+            self._in_flight[socket] += 1
+
+        socket.send_multipart(frames, copy=False)
         return msg_id
 
+    def _compress(self, frames, compression_name):
+        ''' Compress the body of the frames returned by encode_message with
+            the named compression, if any, when it is at least
+            COMPRESS_THRESHOLD bytes long
+        '''
+        if compression_name is None:
+            return frames
+        size = len(codec.message_body(frames))
+        if size < self.COMPRESS_THRESHOLD:
+            return frames
+        started = clock()
+        frames = codec.compress_message(frames, compression_name)
+        self.metrics.observe('compress_time', compression_name, clock() - started)
+        self.metrics.increment('compression_input_bytes', compression_name, size)
+        self.metrics.increment('compression_output_bytes', compression_name, len(frames[1]))
+        return frames
+
+    def _compression_ratio(self):
+        ''' compression : size of the bodies compressed with it over their
+            compressed size
+        '''
+        compressed = self.metrics.counter('compression_output_bytes')
+        return dict((name, float(size) / compressed[name])
+                    for name, size in self.metrics.counter('compression_input_bytes').items()
+                    if compressed.get(name))
+
     def socket(self, socketType, handler):
         ''' Construct a server socket and register it for input polling as well
             as register a handler to call when the socket receives request
@@ -159,39 +762,113 @@ class ServiceEndpoint(object):
             handler : function
                 Function that will handle any inbound requests.  The function
                 should take on parameter, which is the zmq socket on which
-                the request is being received.
+                the request is being received.  Use None for sockets that
+                only send (e.g. zmq.PUB); they are not polled.
             Returns
             =======
             socket : zmq socket
                 zmq socket that was constructed.
         '''
         socket = self._context.socket(socketType)
-        self._sockets[socket] = handler
-        self._poll.register(socket, zmq.POLLIN)
+        self._socket_types[socket] = socketType
+        if handler is not None:
+            self._sockets[socket] = handler
+            self._poll.register(socket, zmq.POLLIN)
 
-        print('Socket {0} of type {1} ready for input'.format(socket, socketType))
+        log.debug('Socket %s of type %s ready for input', socket, socketType)
         return socket
 
     def _poll_once(self, timeout):
+        # Don't sleep past the next scheduled task
+        next_task = self._task_schedule.next_timeout()
+        if next_task is not None:
+            # Round up so the poll doesn't wake just before the task is due
+            # and spin until it is
+            timeout = min(timeout, int(math.ceil(next_task * 1000)))
         # Poll the sockets using the timeout (milliseconds)
         sockets = dict(self._poll.poll(timeout))
+        self._handle_ready(sockets)
+        self._task_schedule.execute()
+
+    def _handle_ready(self, sockets):
+        ''' Call the handlers of the sockets returned by a poll '''
         # Iterate through the returned values
-        for socket, state in sockets.iteritems():
+        for socket, state in sockets.items():
             # Execute the handler 
             if state == zmq.POLLIN:
                 self._sockets[socket](socket)
             else:
-                print('Not dispatching state {0} because it is not {1}'.format(state, zmq.POLLIN))
-
-        self._task_schedule.execute()
+                log.warning('Not dispatching state %s because it is not %s', state, zmq.POLLIN)
 
     def _handle_response(self, socket):
         ''' Handle response from a request '''
-        msg_id, reply_str = socket.recv_multipart()
+        frames = socket.recv_multipart(copy=False)
+        if self._socket_types[socket] == zmq.DEALER:
+            # Drop the empty delimiter frame
+            frames = frames[1:]
+        msg_id = frames[0].bytes
         if msg_id not in self._requests:
-            print('msg_id {0} not in requests'.format(msg_id))
+            # Most likely the reply to a request that timed out
+            log.debug('msg_id %s not in requests', msg_id)
             return
         
-        print('RCV: {0}'.format(reply_str))
-        reply = filter_json(reply_str)
-        self._requests.pop(msg_id).callback(reply)
+        started = clock()
+        try:
+            reply, codec_name = codec.decode_message(frames[1:])
+        except Exception as e:
+            self._request_failed(e, msg_id)
+            return
+        finished = clock()
+        self.metrics.observe('decode_time', codec_name, finished - started)
+
+        on_partial = self._partial_replies.get(msg_id)
+        if on_partial is not None and on_partial(reply):
+            # More replies to come; the request stays outstanding
+            return
+
+        sent_on = self._request_sockets.pop(msg_id, None)
+        if sent_on is not None:
+            self._release_window(socket)
+        reply_received = self._pop_request(msg_id)
+        key, sent = self._request_started.pop(msg_id)
+        self.metrics.observe('request_latency', key, finished - sent)
+        span = self._spans.pop(msg_id, None)
+        if span is not None:
+            self._end_client_span(span, frames[1:], finished - started, reply)
+        if sent_on is not None:
+            self._latency[socket] = 0.8 * self._latency.get(socket, finished - sent) + 0.2 * (finished - sent)
+        log.debug('RCV %s: %s', msg_id, reply)
+        reply_received.callback(reply)
+
+    def _end_client_span(self, span, frames, decode_time, reply):
+        ''' Finish the span of a request that has been answered.  The
+            container reports the time it spent on the request before
+            encoding the reply, and the rest, besides resolving the service
+            and decoding the reply, is taken as the time on the network.
+            frames is None for requests a container handled itself.
+        '''
+        span.timings['decode'] = decode_time
+        server = None
+        if frames is not None:
+            try:
+                server = float(codec.message_params(frames).get('elapsed'))
+            except (TypeError, ValueError):
+                pass
+        if server is not None:
+            span.timings['server'] = server
+            span.timings['network'] = max(0.0, span.elapsed() - span.timings.get('resolve', 0.0)
+                                               - decode_time - server)
+        error = reply.get('error', 'error') if isinstance(reply, dict) and reply.get('status') == 'error' else None
+        self._end_span(span, error)
+
+    def _release_window(self, socket):
+        ''' A reply has been received on a request connection; send the next
+            queued request, if any, in its place.
+        '''
+        if socket not in self._in_flight:
+            return
+        backlog = self._backlog[socket]
+        if backlog:
+            socket.send_multipart(backlog.popleft()[1], copy=False)
+        else:
+            self._in_flight[socket] -= 1
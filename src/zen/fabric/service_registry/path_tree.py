@@ -0,0 +1,78 @@
+''' path_tree.py
+
+    Service paths indexed by '/' separated segment, so the paths below a
+    prefix can be found without looking at every registered path.
+
+    A path registered as a subtree also serves every path below it that has
+    no registration of its own; the nearest such ancestor wins.
+'''
+
+
+def ancestors(path):
+    ''' The paths above path, nearest first, e.g. '/a/b', '/a' and '/' for
+        '/a/b/c'
+    '''
+    path = path.rstrip('/')
+    while path:
+        path = path[:path.rfind('/')]
+        yield path or '/'
+
+
+def is_under(path, prefix):
+    ''' True if path is prefix or one of the paths below it '''
+    prefix = prefix.rstrip('/')
+    return path == prefix or path.startswith(prefix + '/') or not prefix
+
+
+def _segments(path):
+    return [segment for segment in path.split('/') if segment]
+
+
+class PathTree(object):
+    ''' Path Tree
+
+        Set of paths, as a tree of segments.
+    '''
+    def __init__(self):
+        # segment : node, where each node is a dictionary of the same kind;
+        # the None key marks a node that is a path in the set
+        self._root = {}
+
+    def add(self, path):
+        node = self._root
+        for segment in _segments(path):
+            node = node.setdefault(segment, {})
+        node[None] = path
+
+    def discard(self, path):
+        # Remove the path, then the nodes left without paths below them
+        segments = _segments(path)
+        nodes = [self._root]
+        for segment in segments:
+            node = nodes[-1].get(segment)
+            if node is None:
+                return
+            nodes.append(node)
+        nodes[-1].pop(None, None)
+        for index in range(len(segments), 0, -1):
+            if nodes[index]:
+                break
+            del nodes[index - 1][segments[index - 1]]
+
+    def under(self, prefix):
+        ''' The paths in the set that are prefix or below it '''
+        node = self._root
+        for segment in _segments(prefix):
+            node = node.get(segment)
+            if node is None:
+                return []
+        paths = []
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            for segment, child in node.items():
+                if segment is None:
+                    paths.append(child)
+                else:
+                    pending.append(child)
+        return paths
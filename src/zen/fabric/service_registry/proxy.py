@@ -1,14 +1,59 @@
-import json
-from twisted.internet   import defer
+import logging
 import zmq
 
+from zen.fabric import load_balancer
+from zen.fabric.errors import RequestTimeoutError
 from zen.fabric.service_proxy import ServiceProxy
 from zen.fabric import service_registry
-from zen.fabric.json_util import filter_json
+from zen.fabric.codec import decode_message
+from zen.fabric.service_registry.path_tree import ancestors, is_under
+from zen.fabric.task_schedule import clock
+from zen.fabric.transport import endpoint_url, request_address, select_address, transport_of
+
+log = logging.getLogger(__name__)
 
 class ServiceRegistryProxy(ServiceProxy):
-    
-    def __init__(self, container, srap):
+    ''' Service Registry Proxy
+
+        Resolves service paths to request connections.  On connecting, the
+        proxy loads a snapshot of every registered path and, if the service
+        registry publishes changes, subscribes to them, so known paths are
+        resolved without a round-trip and the cache follows instances as
+        they come and go; the paths followed are reloaded every
+        RESYNC_INTERVAL in case changes were missed.  Otherwise paths are
+        looked up on first use and refreshed periodically, all in one
+        request.
+
+        Given prefetch prefixes, the proxy loads only the paths under them
+        (with get_many) instead of the whole snapshot, then subscribes to
+        changes the same way, or refreshes them periodically.  Either way,
+        lookups made before the first reply arrives wait for it rather than
+        each making a round-trip of their own.  Paths served by a subtree
+        registration are resolved from the known instances of the path
+        above them.
+
+        Request connections are pooled by address, so every path hosted by
+        the same container shares one connection.  Connections with no
+        outstanding requests are closed once they have been idle for
+        CONNECTION_IDLE_TIMEOUT, or to make room when the pool reaches
+        MAX_CONNECTIONS, and reopened when next needed.
+    '''
+    # Seconds to wait for the service registry to resolve a path
+    LOOKUP_TIMEOUT = 10
+    # Seconds between refreshes of the cached paths, which pick up new
+    # instances and drop expired ones, when not subscribed to changes
+    CACHE_TTL = 10
+    # Seconds between reloads of the paths followed while subscribed to
+    # changes, which catch up on changes the subscription missed without
+    # noticing, e.g. those published while it was connecting
+    RESYNC_INTERVAL = 60
+    # Maximum number of request connections kept open; exceeded only while
+    # every connection has requests outstanding
+    MAX_CONNECTIONS = 256
+    # Seconds a request connection can go unused before it is closed
+    CONNECTION_IDLE_TIMEOUT = 300
+
+    def __init__(self, container, srap, prefetch=None):
         ''' Initialize the service registry proxy
         
             Params
@@ -17,74 +62,414 @@ class ServiceRegistryProxy(ServiceProxy):
                 Service Container or Service Endpoint
             srap : string
                 Service registry address:port.
+            prefetch : list, optional
+                Paths or prefixes (e.g. '/orders') to resolve up front,
+                instead of loading every registered path.
         '''
         super(ServiceRegistryProxy, self).__init__(container)
-        self._socket = self._container.socket(zmq.REQ, self._handle_response)
+        # DEALER so that several lookups can be outstanding at once
+        self._socket = self._container.socket(zmq.DEALER, self._handle_response)
         if srap:
-            #TODO Log
-            print('Connecting to service registry {0}'.format(srap))
-            self._socket.connect('tcp://{0}'.format(srap))
+            log.info('Connecting to service registry %s', srap)
+            self._socket.connect(endpoint_url(srap))
         #TODO What was the purpose of address_handler?
         #self._address_handler = address_handler
-        # { service path : { 'REQ' : service socket, } }
+        # { service path : [service socket, ...] }
         self._remote_services = {}
-        # service path : deferred; this has the deferred objects for all pending 
-        # service resolutions
+        self._refresh = None
+        self._resync = None
+        # { service path : [{ 'addresses' : ..., 'codecs' : ... }, ...] }
+        # from the snapshot and published changes; connected on first use
+        self._known_services = {}
+        # (epoch, version) of the service registry state applied
+        self._epoch = None
+        self._version = None
+        self._subscriber = None
+        # { address connected to : service socket }
+        self._connections = {}
+        # { service socket : time it was last chosen for a request }
+        self._last_used = {}
+        self._eviction = None
+        self._container.metrics.gauge('connections', lambda: len(self._connections))
+        self._load_balancer = load_balancer.create(self._container.LOAD_BALANCER, self._container)
+        # service path : [deferred, ...]; this has the deferred objects for all 
+        # pending service resolutions, one for each caller
         self._remote_socket_requests = {}
+        # service path : ScheduledTask that times out the pending resolution
+        self._lookup_timers = {}
+        # Prefixes loaded instead of the whole snapshot
+        self._prefetch = list(prefetch) if prefetch else None
+        # Prefixes whose first load is in flight ('/' for the snapshot),
+        # and the lookups waiting for it: service path : [deferred, ...]
+        self._loading = []
+        self._load_waiters = {}
+        self._load_timer = None
+        if srap:
+            self._loading = self._prefetch or ['/']
+            self._load_timer = self._container.call_later(self.LOOKUP_TIMEOUT, self._load_timed_out)
+            if self._prefetch:
+                self._request_many(self._prefetch)
+            else:
+                self._request_snapshot()
     
-    def register_service(self, path, address, port):
+    def register_service(self, path, address, port, codecs=None, ttl=None, subtree=False, addresses=None,
+                         compressions=None):
+        ''' Register an instance of a service with the service registry.
+            With a ttl the registration expires unless it is renewed by
+            registering again.  With subtree, the instance also serves the
+            paths below path that aren't registered themselves.  addresses
+            are the container's other addresses, see zen.fabric.transport.
+        '''
         new_request = {
             'path': service_registry.PATH,
             'command': 'put', 
             'args': { 'path': path, 
-                            'addresses': { 'REQ': '{0}:{1}'.format(address, port), },
+                            'addresses': dict(addresses or {}, REQ=request_address(address, port)),
                          }
         }
+        if codecs:
+            new_request['args']['codecs'] = codecs
+        if compressions:
+            new_request['args']['compressions'] = compressions
+        if ttl:
+            new_request['args']['ttl'] = ttl
+        if subtree:
+            new_request['args']['subtree'] = True
         # Should this be 
         self._container.send_message_to_socket(self._socket, new_request)
 
+    def unregister_service(self, path, address, port):
+        ''' Remove an instance of a service from the service registry '''
+        new_request = {
+            'path': service_registry.PATH,
+            'command': 'remove',
+            'args': { 'path': path,
+                      'addresses': { 'REQ': request_address(address, port), },
+                    }
+        }
+        self._container.send_message_to_socket(self._socket, new_request)
+
     def get_remote_socket(self, request):
         ''' Gets the socket that is connected to the server that can handle 
-            the specified request.
+            the specified request.  When several instances of the service
+            are registered, the endpoint's load balancer picks one for each
+            request.
 
             Returns
             =======
-            got_remote_service : defer.Deferred
+            got_remote_service : Deferred
                 This is an asynchronous call, so it returns a Deferred object
                 that will signal when the socket is known.
         '''
         path = request['path']
 
         # First check the cache
-        if path in self._remote_services:
-            socket = self._remote_services[path]['REQ']
-            print('Already got socket for {0} - {1}'.format(path, socket))
-            got_remote_socket = defer.Deferred()
-            got_remote_socket.callback(socket)
+        sockets = self._remote_services.get(path)
+        if sockets is None:
+            instances = self._known_instances(path)
+            if instances:
+                # Known from the snapshot or a published change; connect now
+                sockets = self._remote_services[path] = [self._connect(instance) for instance in instances]
+        if sockets is not None:
+            self._container.metrics.increment('registry_lookups', 'hit')
+            got_remote_socket = self._container._new_deferred()
+            got_remote_socket.callback(self._choose(sockets))
+            return got_remote_socket
+        # Wait for the snapshot or prefetch being loaded, if it covers path
+        elif any(is_under(path, prefix) for prefix in self._loading):
+            self._container.metrics.increment('registry_lookups', 'coalesced')
+            got_remote_socket = self._container._new_deferred()
+            self._load_waiters.setdefault(path, []).append(got_remote_socket)
             return got_remote_socket
         # Next check to see if a request for this socket has already been sent
         elif path in self._remote_socket_requests:
-            # Duplicate request, send the original deferred
-            print('Duplicate request, returning same deferred')
-            return self._remote_socket_requests[path]
+            # Duplicate request; each caller gets its own deferred, because
+            # callbacks added to a shared deferred would see each other's
+            # results instead of the socket.
+            self._container.metrics.increment('registry_lookups', 'coalesced')
+            got_remote_socket = self._container._new_deferred()
+            self._remote_socket_requests[path].append(got_remote_socket)
+            return got_remote_socket
         # Send the request to the service registry
         else:
-            got_remote_socket = defer.Deferred()
-            new_request = {
-                'path': service_registry.PATH,
-                'command': 'get',
-                'args': { 'path': path, },
-            }
-            self._remote_socket_requests[path] = got_remote_socket
-            self._container.send_message_to_socket(self._socket, new_request)
+            self._container.metrics.increment('registry_lookups', 'miss')
+            got_remote_socket = self._container._new_deferred()
+            self._lookup(path)
+            self._remote_socket_requests[path].append(got_remote_socket)
             return got_remote_socket
 
+    def _lookup(self, path):
+        ''' Ask the service registry for the instances of path '''
+        new_request = {
+            'path': service_registry.PATH,
+            'command': 'get',
+            'args': { 'path': path, },
+        }
+        self._remote_socket_requests[path] = []
+        self._lookup_timers[path] = self._container.call_later(
+                self.LOOKUP_TIMEOUT, self._lookup_timed_out, path)
+        self._container.send_message_to_socket(self._socket, new_request)
+
+    def _known_instances(self, path):
+        ''' Known instances serving path: its own, or those of the nearest
+            subtree registration above it; None if there are none.
+        '''
+        instances = self._known_services.get(path)
+        if instances:
+            return instances
+        for prefix in ancestors(path):
+            instances = [instance for instance in self._known_services.get(prefix, ())
+                         if instance.get('subtree')]
+            if instances:
+                return instances
+        return None
+
+    def _request_many(self, paths):
+        new_request = {
+            'path': service_registry.PATH,
+            'command': 'get_many',
+            'args': { 'paths': paths },
+        }
+        self._container.send_message_to_socket(self._socket, new_request)
+
+    def _loaded(self):
+        ''' Resolve the lookups that waited for the first snapshot or
+            prefetch
+        '''
+        if self._load_timer is not None:
+            self._load_timer.cancel()
+            self._load_timer = None
+        self._loading = []
+        waiters, self._load_waiters = self._load_waiters, {}
+        for path, deferreds in waiters.items():
+            instances = self._known_instances(path)
+            if instances:
+                sockets = self._remote_services[path] = [self._connect(instance) for instance in instances]
+            for got_remote_socket in deferreds:
+                got_remote_socket.callback(self._choose(sockets) if instances else None)
+
+    def _load_timed_out(self):
+        ''' Look the waiting paths up one by one instead '''
+        log.warning('Service registry did not answer the initial load; looking paths up individually')
+        self._load_timer = None
+        self._loading = []
+        waiters, self._load_waiters = self._load_waiters, {}
+        for path, deferreds in waiters.items():
+            if path not in self._remote_socket_requests:
+                self._lookup(path)
+            self._remote_socket_requests[path].extend(deferreds)
+
+    def _request_snapshot(self):
+        new_request = {
+            'path': service_registry.PATH,
+            'command': 'snapshot',
+            'args': {},
+        }
+        self._container.send_message_to_socket(self._socket, new_request)
+
+    def _apply_snapshot(self, snapshot):
+        if not self._is_behind(snapshot):
+            self._epoch = snapshot['epoch']
+            self._version = snapshot['version']
+            services = snapshot['services']
+            for path in list(self._known_services):
+                if path not in services:
+                    self._set_instances(path, [])
+            for path, instances in services.items():
+                self._set_instances(path, instances)
+            log.debug('Loaded service registry snapshot version %s', self._version)
+        self._loaded()
+        self._follow_changes(snapshot.get('publisher'))
+
+    def _follow_changes(self, publisher):
+        ''' Subscribe to the changes published by the service registry, or
+            if nothing is published, refresh the paths in use instead
+        '''
+        if publisher and self._subscriber is None:
+            self._subscriber = self._container.socket(zmq.SUB, self._handle_change)
+            self._subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+            self._subscriber.connect(endpoint_url(publisher))
+            if self._refresh is not None:
+                self._refresh.cancel()
+                self._refresh = None
+            # Changes published since the state just applied was read are
+            # missed; load it again now that the subscription is connecting,
+            # and now and then after that
+            self._reload()
+            self._resync = self._container.call_later(self.RESYNC_INTERVAL, self._resync_cache)
+        elif self._subscriber is None and self._refresh is None:
+            self._refresh = self._container.call_later(self.CACHE_TTL, self._refresh_cache)
+
+    def _reload(self):
+        ''' Load the paths followed again: the prefetched prefixes and the
+            paths in use, or the whole snapshot
+        '''
+        if self._prefetch:
+            paths = set(self._remote_services)
+            paths.update(self._prefetch)
+            self._request_many(sorted(paths))
+        else:
+            self._request_snapshot()
+
+    def _is_behind(self, reply):
+        ''' True if a snapshot or get_many reply is older than the changes
+            already applied, which then have everything it has
+        '''
+        return (self._version is not None and reply.get('epoch') == self._epoch
+                and reply.get('version', self._version) < self._version)
+
+    def _handle_change(self, socket):
+        # The first frame is the topic (the path)
+        frames = socket.recv_multipart(copy=False)
+        change, _ = decode_message(frames[1:])
+        if self._version is None:
+            # Still waiting for the snapshot, which includes this change
+            return
+        if change['epoch'] == self._epoch and change['version'] <= self._version:
+            # Already in the snapshot
+            return
+        self._set_instances(change['path'], change['instances'])
+        if change['epoch'] != self._epoch or change['version'] != self._version + 1:
+            # Missed changes, or the service registry restarted; start over
+            # from a new snapshot (or the prefetched paths)
+            log.info('Service registry changes out of sequence; reloading')
+            self._version = None
+            self._reload()
+        else:
+            self._version = change['version']
+
+    def _apply_many(self, reply):
+        ''' Apply the reply to get_many: the known paths under its prefixes
+            are replaced by those in the reply.
+        '''
+        if not self._is_behind(reply):
+            services = reply['services']
+            for path in list(self._known_services):
+                if path not in services and any(is_under(path, prefix) for prefix in reply['prefixes']):
+                    self._set_instances(path, [])
+            for path, instances in services.items():
+                self._set_instances(path, instances)
+            if 'version' in reply:
+                self._epoch = reply['epoch']
+                self._version = reply['version']
+        self._loaded()
+        self._follow_changes(reply.get('publisher'))
+
+    def _set_instances(self, path, instances):
+        ''' Update the known instances of path, and the connections used
+            for it if it is in use.
+        '''
+        # Paths below path served by its subtree registration resolve
+        # again on next use
+        for served in [served for served in self._remote_services
+                       if served not in self._known_services and served != path and is_under(served, path)]:
+            del self._remote_services[served]
+        if not instances:
+            self._known_services.pop(path, None)
+            self._remote_services.pop(path, None)
+            return
+        self._known_services[path] = instances
+        if path in self._remote_services:
+            self._remote_services[path] = [self._connect(instance) for instance in instances]
+
+    def _refresh_cache(self):
+        ''' Look up every cached path again (and the prefetched prefixes),
+            in the background, in one request; requests keep using the
+            cached instances until the reply arrives.
+        '''
+        paths = set(self._remote_services)
+        paths.update(self._prefetch or ())
+        if paths:
+            self._request_many(sorted(paths))
+        self._refresh = self._container.call_later(self.CACHE_TTL, self._refresh_cache)
+
+    def _resync_cache(self):
+        self._reload()
+        self._resync = self._container.call_later(self.RESYNC_INTERVAL, self._resync_cache)
+
+    def _lookup_timed_out(self, path):
+        log.warning('Lookup of %s timed out', path)
+        del self._lookup_timers[path]
+        error = RequestTimeoutError('Service registry did not resolve {0}'.format(path))
+        for got_remote_socket in self._remote_socket_requests.pop(path):
+            got_remote_socket.errback(error)
+
+    def _pending_lookups(self, path):
+        ''' Remove and return the Deferreds waiting for path to resolve '''
+        timer = self._lookup_timers.pop(path, None)
+        if timer is not None:
+            timer.cancel()
+        return self._remote_socket_requests.pop(path, [])
+
+    def _connect(self, instance):
+        ''' Returns the socket connected to an instance of a service '''
+        address = select_address(instance['addresses'], self._container._context)
+        socket = self._connections.get(address)
+        if socket is None:
+            if len(self._connections) >= self.MAX_CONNECTIONS:
+                self._evict(self._idle_connections()[:1])
+            socket = self._container.connect_request(address, instance.get('codecs'), instance.get('compressions'))
+            log.debug('Connected %s to %s', socket, address)
+            self._container.metrics.increment('connections_opened', transport_of(address))
+            self._connections[address] = socket
+            self._last_used[socket] = clock()
+            if self._eviction is None:
+                self._eviction = self._container.call_later(
+                        self.CONNECTION_IDLE_TIMEOUT / 2.0, self._evict_idle)
+        return socket
+
+    def _choose(self, sockets):
+        ''' Returns the socket the load balancer picks for a request '''
+        socket = self._load_balancer.choose(sockets)
+        self._last_used[socket] = clock()
+        return socket
+
+    def _idle_connections(self):
+        ''' Addresses of the connections without outstanding requests,
+            least recently used first
+        '''
+        idle = [(self._last_used[socket], address) for address, socket in self._connections.items()
+                if not self._container.outstanding(socket)]
+        return [address for last_used, address in sorted(idle)]
+
+    def _evict_idle(self):
+        expired = clock() - self.CONNECTION_IDLE_TIMEOUT
+        self._evict([address for address in self._idle_connections()
+                     if self._last_used[self._connections[address]] < expired])
+        if self._connections:
+            self._eviction = self._container.call_later(
+                    self.CONNECTION_IDLE_TIMEOUT / 2.0, self._evict_idle)
+        else:
+            self._eviction = None
+
+    def _evict(self, addresses):
+        ''' Close the connections to addresses; the paths using them
+            reconnect when next requested.
+        '''
+        for address in addresses:
+            socket = self._connections.pop(address)
+            del self._last_used[socket]
+            for path, sockets in list(self._remote_services.items()):
+                if socket in sockets:
+                    del self._remote_services[path]
+            self._container.disconnect_request(socket)
+            self._container.metrics.increment('connection_evictions')
+            log.debug('Closed idle connection to %s', address)
+
     def _handle_response(self, socket):
-        _, reply_str = socket.recv_multipart()
+        # Skip the empty delimiter and the message id
+        frames = socket.recv_multipart(copy=False)[2:]
         #TODO I don't like this decoding here; maybe the decoding should be in 
         # the container?
-        print('RCV: {0}'.format(reply_str))
-        reply = filter_json(json.loads(reply_str))
+        reply, _ = decode_message(frames)
+        log.debug('RCV from service registry: %s', reply)
+
+        if 'prefixes' in reply:
+            self._apply_many(reply)
+            return
+        if 'services' in reply:
+            self._apply_snapshot(reply)
+            return
 
         if 'path' not in reply:
             # This is a response from  a put; nothing to do
@@ -93,22 +478,25 @@ class ServiceRegistryProxy(ServiceProxy):
         service_path = reply['path']
 
         if 'addresses' not in reply:
-            # Either the service registry doesn't know about the service, or
-            # this is a response to a 'put' request.
+            # The service registry doesn't know about the service (any more)
             #TODO Handle unknown services?  Errback instead of callback?
-            self._remote_socket_requests.pop(service_path).callback(None)
+            self._set_instances(service_path, [])
+            for got_remote_socket in self._pending_lookups(service_path):
+                got_remote_socket.callback(None)
             return
 
-        addresses = reply['addresses']
-        
-        #TODO Handle other connection types
-        socket = self._container.connect_request(addresses['REQ'])
-        print('Connected {2} to service {0} at {1}'.format(service_path, addresses['REQ'], socket))
-        service = { 'REQ' : socket, }
+        instances = reply.get('instances')
+        if instances is None:
+            # A service registry that only knows one instance per path
+            instances = [{ 'addresses': reply['addresses'], 'codecs': reply.get('codecs') }]
+        sockets = [self._connect(instance) for instance in instances]
 
         # Index this service by the service path
-        self._remote_services[service_path] = service
+        self._known_services[service_path] = instances
+        self._remote_services[service_path] = sockets
+        if self._refresh is None and self._subscriber is None:
+            self._refresh = self._container.call_later(self.CACHE_TTL, self._refresh_cache)
 
         # Execute the deferred for the pending requests (and remove it)
-        print('Calling back with socket')
-        self._remote_socket_requests.pop(service_path).callback(socket)
+        for got_remote_socket in self._pending_lookups(service_path):
+            got_remote_socket.callback(self._choose(sockets))
@@ -1,26 +1,254 @@
-from zen.fabric.service import Service
+import logging
+import uuid
+import zmq
+
+from zen.fabric.codec import encode_message
+from zen.fabric.service import Service, internal
+from zen.fabric.service_registry.path_tree import PathTree, ancestors
+from zen.fabric.task_schedule import clock
+
+log = logging.getLogger(__name__)
 
 class ServiceRegistry(Service):
     ''' Service Registry
-    
+
         Services register themselves with the service registry.  Clients query
         the service registry to determine the location of services.
+
+        Any number of containers can register the same path; each one is an
+        instance of the service.  A registration made with a ttl is a lease
+        that expires unless the container renews it by registering again,
+        so instances hosted by containers that died drop out on their own.
+
+        A registration can be for a whole subtree, in which case it also
+        serves the paths below it that have no registration of their own.
+        Paths are indexed in a PathTree, so get_many can resolve every path
+        under a prefix in one request.
+
+        Once bind_publisher() has been called, every change to the instances
+        of a path is published on a PUB socket as a numbered version, so
+        proxies can keep their caches up to date from a snapshot plus the
+        changes that follow it.
     '''
+    # Seconds between checks for expired leases while publishing
+    EXPIRY_INTERVAL = 1.0
 
     def __init__(self):
+        # path : { instance key : instance }, where an instance is
+        #   { 'addresses' : addresses, 'codecs' : codecs,
+        #     'compressions' : compressions, 'subtree' : bool, 'expires' : time }
+        # and expires is None for registrations without a lease
         self._services = {}
+        # The paths of _services
+        self._tree = PathTree()
+        # Incremented on every change to the registered instances; the epoch
+        # tells proxies when the numbering restarted with a new registry
+        self._version = 0
+        self._epoch = uuid.uuid4().hex
+        self._publisher = None
+        self._publisher_address = None
+
+    @internal
+    def bind_publisher(self, address='*', port=None):
+        ''' Publish changes on a PUB socket.  The service must already be
+            registered with its container.
+
+            Params
+            ======
+            address : string, optional
+                Address to bind to; '*' binds to all addresses.  An ipc://
+                or inproc:// address is bound (and advertised) as it is,
+                for proxies on the same host or using the same zmq.Context.
+            port : int, optional
+                Port to bind to; a random port when omitted.
+        '''
+        self._publisher = self._container.socket(zmq.PUB, None)
+        if '://' in address:
+            self._publisher.bind(address)
+            self._publisher_address = address
+        else:
+            if port:
+                self._publisher.bind('tcp://{0}:{1}'.format(address, port))
+            else:
+                port = self._publisher.bind_to_random_port('tcp://{0}'.format(address))
+            host = 'localhost' if address == '*' else address
+            self._publisher_address = '{0}:{1}'.format(host, port)
+        log.info('Publishing service registry changes on %s', self._publisher_address)
+        self._container.call_later(self.EXPIRY_INTERVAL, self._expire)
 
     def get(self, path):
-        if path in self._services:
+        instances = self._live_instances(path)
+        prefix = None
+        if not instances:
+            prefix, instances = self._subtree_instances(path)
+        if instances:
             response = {
                     'path': path,
-                    'addresses': self._services[path],
+                    # The first instance, for clients that only use one
+                    'addresses': instances[0]['addresses'],
+                    'instances': [self._describe(instance) for instance in instances],
                 }
+            if instances[0]['codecs']:
+                response['codecs'] = instances[0]['codecs']
+            if prefix is not None:
+                # Served by a subtree registration
+                response['prefix'] = prefix
         else:
             #TODO Error or just return an empty dict?
             response = {'path': path}
         return response
-    
-    def put(self, path, addresses):
-        self._services[path] = addresses
+
+    def get_many(self, paths):
+        ''' Resolve several paths in one request.  Each of paths is taken as
+            a prefix: the result has every registered path at or below it,
+            and the subtree registration serving it if it isn't registered
+            itself.
+
+            Returns
+            =======
+            { 'prefixes' : paths, 'services' : { path : [instance, ...] },
+              'epoch' : ..., 'version' : ..., 'publisher' : ... }, like a
+            snapshot limited to paths.
+        '''
+        services = {}
+        for prefix in paths:
+            for path in self._tree.under(prefix):
+                instances = self._live_instances(path)
+                if instances:
+                    services[path] = [self._describe(instance) for instance in instances]
+            if prefix not in services:
+                owner, instances = self._subtree_instances(prefix)
+                if owner is not None:
+                    services[owner] = [self._describe(instance) for instance in self._live_instances(owner)]
+        return {
+            'prefixes': paths,
+            'services': services,
+            'epoch': self._epoch,
+            'version': self._version,
+            'publisher': self._publisher_address,
+        }
+
+    def snapshot(self):
+        ''' Every registered path with its instances, the version they
+            correspond to and the address changes are published on.
+        '''
+        services = {}
+        for path in list(self._services):
+            instances = self._live_instances(path)
+            if instances:
+                services[path] = [self._describe(instance) for instance in instances]
+        return {
+            'epoch': self._epoch,
+            'version': self._version,
+            'services': services,
+            'publisher': self._publisher_address,
+        }
+
+    def put(self, path, addresses, codecs=None, ttl=None, subtree=False, compressions=None):
+        ''' Register (or renew) an instance of a service
+
+            Params
+            ======
+            path : string
+                Path of the service
+            addresses : dictionary
+                Addresses of the container hosting the instance, e.g.
+                { 'REQ' : 'host:port' }
+            codecs : list, optional
+                Codecs supported by the container
+            ttl : float, optional
+                Seconds until the registration expires unless renewed; no
+                expiry when omitted.
+            subtree : bool, optional
+                True if the instance also serves the paths below path that
+                aren't registered themselves.
+            compressions : list, optional
+                Compressions supported by the container
+        '''
+        if path not in self._services:
+            self._services[path] = {}
+            self._tree.add(path)
+        instances = self._services[path]
+        key = self._instance_key(addresses)
+        previous = instances.get(key)
+        instances[key] = {
+                'addresses': addresses,
+                'codecs': codecs,
+                'compressions': compressions,
+                'subtree': bool(subtree),
+                'expires': clock() + ttl if ttl else None,
+            }
+        if (previous is None or previous['addresses'] != addresses or previous['codecs'] != codecs
+                or previous['compressions'] != compressions or previous['subtree'] != bool(subtree)):
+            self._publish(path)
+        return {'status' : 'ok'}
+
+    def remove(self, path, addresses):
+        ''' Remove an instance of a service '''
+        instances = self._services.get(path, {})
+        if instances.pop(self._instance_key(addresses), None) is not None:
+            if not instances:
+                del self._services[path]
+                self._tree.discard(path)
+            self._publish(path)
         return {'status' : 'ok'}
+
+    def _instance_key(self, addresses):
+        return addresses.get('REQ') or str(sorted(addresses.items()))
+
+    def _describe(self, instance):
+        return { 'addresses': instance['addresses'], 'codecs': instance['codecs'],
+                 'compressions': instance['compressions'], 'subtree': instance['subtree'] }
+
+    def _subtree_instances(self, path):
+        ''' Returns (prefix, instances) of the nearest subtree registration
+            above path, or (None, []) if there is none.
+        '''
+        for prefix in ancestors(path):
+            if prefix in self._services:
+                instances = [instance for instance in self._live_instances(prefix) if instance['subtree']]
+                if instances:
+                    return prefix, instances
+        return None, []
+
+    def _live_instances(self, path):
+        ''' Instances of path whose lease hasn't expired; expired instances
+            are dropped.
+        '''
+        instances = self._services.get(path)
+        if not instances:
+            return []
+        now = clock()
+        expired = [key for key, instance in instances.items()
+                   if instance['expires'] is not None and instance['expires'] < now]
+        for key in expired:
+            del instances[key]
+        if not instances:
+            del self._services[path]
+            self._tree.discard(path)
+        if expired:
+            self._publish(path)
+        return self._sorted(instances)
+
+    def _sorted(self, instances):
+        return sorted(instances.values(), key=lambda instance: self._instance_key(instance['addresses']))
+
+    def _expire(self):
+        for path in list(self._services):
+            self._live_instances(path)
+        self._container.call_later(self.EXPIRY_INTERVAL, self._expire)
+
+    def _publish(self, path):
+        ''' Record a change to the instances of path and publish it '''
+        self._version += 1
+        if self._publisher is None:
+            return
+        instances = self._services.get(path, {})
+        change = {
+            'epoch': self._epoch,
+            'version': self._version,
+            'path': path,
+            'instances': [self._describe(instance) for instance in self._sorted(instances)],
+        }
+        # The path is the topic, so subscribers can filter on it
+        self._publisher.send_multipart([path.encode('utf-8')] + encode_message(change))
@@ -0,0 +1,188 @@
+''' stream.py
+
+    Streamed responses.
+
+    A service method can return an iterator (typically a generator) instead
+    of a dict.  When the request was sent with
+    ServiceEndpoint.stream_request, the container sends each item as a
+    message of its own,
+
+        { 'stream' : { 'items' : [item] } }
+
+    as the iterator produces it, and { 'stream' : { 'items' : [], 'end' : True } }
+    once the iterator is exhausted.  A response that isn't an iterator
+    (including errors) is sent as usual and ends the stream.
+
+    Flow control is credit based.  The request carries the number of
+    messages the client is prepared to buffer (the 'stream' header
+    parameter) and the container stops pulling items from the iterator once
+    it has sent that many.  As items are consumed, the client returns credit
+    with 'credit' control messages, so at most a window of items is in
+    memory or in transit at any time, however long the stream.  A 'cancel'
+    control message stops the stream.
+
+    Only containers with a thread pool stream items as they are produced;
+    others collect the whole iterator and send it as a single message.
+'''
+import itertools
+import logging
+import sys
+import traceback
+
+from zen.fabric.codec import encode_message
+
+log = logging.getLogger(__name__)
+
+
+def is_iterator(response):
+    ''' True if a service response is an iterator to be streamed '''
+    return hasattr(response, '__next__') or hasattr(response, 'next')
+
+
+class OutputStream(object):
+    ''' Output Stream
+
+        Container side of a streamed response: the iterator returned by the
+        service and the credit the client has granted.
+    '''
+    def __init__(self, socket, envelope, msg_id, iterator, codec_name, credit):
+        self.socket = socket
+        self.envelope = envelope
+        self.msg_id = msg_id
+        self.iterator = iterator
+        self.codec_name = codec_name
+        # Number of messages that can be sent before the client returns
+        # credit
+        self.credit = credit
+        # True while a worker is pulling items from the iterator
+        self.busy = False
+        self.finished = False
+        self.cancelled = False
+        # ScheduledTask that abandons the stream if the client goes quiet
+        self.timer = None
+
+    def produce(self, count):
+        ''' Pull up to count items from the iterator and return the frames of
+            their messages, followed by the end of the stream once the
+            iterator is exhausted.  Runs on a worker thread.
+        '''
+        messages = []
+        try:
+            for item in itertools.islice(self.iterator, count):
+                messages.append(encode_message({ 'stream' : { 'items' : [item] } }, self.codec_name))
+            if len(messages) < count:
+                messages.append(encode_message({ 'stream' : { 'items' : [], 'end' : True } }, self.codec_name))
+                self.finished = True
+        except Exception:
+            log.exception('Stream %s failed', self.msg_id)
+            messages.append(encode_message({ 'status' : 'error', 'message' : traceback.format_exc() },
+                                           self.codec_name))
+            self.finished = True
+        return messages
+
+    def close(self):
+        ''' Release the iterator; must not be called while busy '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        close = getattr(self.iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+class ResponseStream(object):
+    ''' Response Stream
+
+        Client side of a streamed response, returned by
+        ServiceEndpoint.stream_request.  finished is a Deferred that fires
+        with the number of items received once the stream ends, or errbacks
+        if it fails or times out.
+    '''
+    def __init__(self, endpoint, msg_id, on_item, window, timeout):
+        self.msg_id = msg_id
+        self.count = 0
+        self.finished = None
+        self._endpoint = endpoint
+        self._on_item = on_item
+        self._window = window
+        self._timeout = timeout
+        # Messages consumed since credit was last returned
+        self._consumed = 0
+        # Items whose consumption (a Deferred returned by on_item) hasn't
+        # completed yet
+        self._consuming = 0
+        # Fired once they have, after the stream has ended
+        self._drained = None
+        self._done = False
+
+    def cancel(self):
+        ''' Stop the stream; finished fires with the number of items
+            received so far.
+        '''
+        if self._done:
+            return
+        self._done = True
+        self._endpoint._send_control(self.msg_id, { 'cancel' : 1 })
+        self._endpoint._cancel_request(self.msg_id)
+
+    def _on_message(self, reply):
+        ''' Called with each message of the stream; returns True while more
+            are expected.
+        '''
+        body = reply.get('stream') if isinstance(reply, dict) else None
+        items = [reply] if body is None else body['items']
+        consumed = []
+        try:
+            for item in items:
+                if self._done:
+                    break
+                self.count += 1
+                consumed.append(self._on_item(item))
+        except Exception:
+            self._done = True
+            self._endpoint._send_control(self.msg_id, { 'cancel' : 1 })
+            self._endpoint._request_failed(sys.exc_info()[1], self.msg_id)
+            # The request is gone, so there is nothing more to do
+            return True
+        if self._done:
+            # Cancelled by on_item
+            return True
+        ended = body is None or body.get('end')
+        if not ended:
+            self._endpoint._extend_request(self.msg_id, self._timeout)
+
+        pending = [result for result in consumed if hasattr(result, 'addBoth')]
+        # The message is consumed once all of its items are
+        remaining = [len(pending)]
+        def item_consumed(result):
+            self._consuming -= 1
+            remaining[0] -= 1
+            if not remaining[0] and not ended:
+                self._message_consumed()
+            if not self._consuming and self._drained is not None:
+                self._drained.callback(self.count)
+            return result
+        self._consuming += len(pending)
+        for result in pending:
+            result.addBoth(item_consumed)
+        if ended:
+            self._done = True
+            return False
+        if not pending:
+            self._message_consumed()
+        return True
+
+    def _message_consumed(self):
+        # Return credit in batches rather than for every message
+        self._consumed += 1
+        if self._consumed >= max(1, self._window // 2) and not self._done:
+            self._endpoint._send_control(self.msg_id, { 'credit' : self._consumed })
+            self._consumed = 0
+
+    def _ended(self, reply):
+        self._done = True
+        if self._consuming:
+            # Finish once the last items have been consumed
+            self._drained = self._endpoint._new_deferred()
+            return self._drained
+        return self.count
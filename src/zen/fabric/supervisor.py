@@ -0,0 +1,172 @@
+''' supervisor.py
+
+    Runs a container's services in several processes behind a single
+    request port, so CPU bound services can use more than one core.
+
+    The supervising container binds the public ROUTER socket and forks the
+    worker processes, each of which hosts every service registered with the
+    supervisor and binds its own ipc:// request socket.  The supervisor
+    forwards each request over a DEALER socket to one of the processes,
+    chosen by the request's message id, so all of the messages about one
+    request (e.g. stream credit) reach the same process, and forwards the
+    replies back to the clients.  Only the public address is registered
+    with the service registry.
+'''
+import logging
+import os
+import signal
+import tempfile
+import uuid
+import zlib
+import zmq
+
+from zen.fabric.worker_pool import THREAD
+
+log = logging.getLogger(__name__)
+
+
+def _watch_parent(container, parent, interval):
+    ''' Shut a worker process's container down once its supervisor is gone '''
+    if os.getppid() != parent:
+        log.error('Supervisor %s exited; shutting down', parent)
+        container.shutdown()
+        return
+    container.call_later(interval, _watch_parent, container, parent, interval)
+
+
+class Supervisor(object):
+    ''' Supervisor
+
+        Forks the worker processes of a container, brokers its request
+        socket to them and restarts any that exit.
+    '''
+    # Seconds between checks for worker processes that have exited
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, container, processes, srap=None, workers=0, worker_type=THREAD):
+        ''' Initialize the supervisor
+
+            Params
+            ======
+            container : ServiceContainer
+                Container whose services the worker processes host
+            processes : int
+                Number of worker processes
+            srap : string, optional
+                address:port of the service registry, for the worker
+                processes' own requests
+            workers, worker_type : optional
+                Worker pool of each worker process; see ServiceContainer.init
+        '''
+        self._container = container
+        self._srap = srap
+        self._workers = workers
+        self._worker_type = worker_type
+        prefix = os.path.join(tempfile.gettempdir(), 'zen-{0}'.format(uuid.uuid4().hex))
+        self._addresses = ['ipc://{0}-{1}.ipc'.format(prefix, index) for index in range(processes)]
+        # Worker process ids, by index; None until started
+        self._pids = [None] * processes
+        self._frontend = container.socket(zmq.ROUTER, self._forward_request)
+        # DEALER sockets keep queueing requests for a process while it is
+        # being restarted, and reconnect once it is back.
+        self._backends = []
+        for address in self._addresses:
+            backend = container.socket(zmq.DEALER, self._forward_reply)
+            backend.connect(address)
+            self._backends.append(backend)
+        self._check_timer = None
+        container.metrics.gauge('processes', lambda: len([pid for pid in self._pids if pid]))
+
+    @property
+    def frontend(self):
+        ''' The public request socket, to be bound by the container '''
+        return self._frontend
+
+    def start(self):
+        ''' Fork the worker processes, unless they have been already.  The
+            services must be registered with the container first.
+        '''
+        if self._check_timer is not None:
+            return
+        for index in range(len(self._pids)):
+            self._spawn(index)
+        self._check_timer = self._container.call_later(self.CHECK_INTERVAL, self._check)
+
+    def close(self):
+        ''' Stop the worker processes and remove their socket files '''
+        if self._check_timer is not None:
+            self._check_timer.cancel()
+            self._check_timer = None
+        pids = [pid for pid in self._pids if pid]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._pids = [None] * len(self._pids)
+        for address in self._addresses:
+            try:
+                os.remove(address[len('ipc://'):])
+            except OSError:
+                pass
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self._pids[index] = pid
+            log.info('Started worker process %s: %s', index, pid)
+            return
+
+        # In the worker process; the parent's sockets and context must not
+        # be used here, so the services move to a new container.
+        status = 0
+        try:
+            container = type(self._container)()
+            container.MAX_CONCURRENT_REQUESTS = self._container.MAX_CONCURRENT_REQUESTS
+            container.MAX_QUEUED_REQUESTS = self._container.MAX_QUEUED_REQUESTS
+            container._init_worker_process(self._addresses[index], self._srap,
+                                           self._workers, self._worker_type)
+            for path, service in self._container._services.items():
+                max_concurrent, max_queued = self._container._admission.path_limits(path)
+                container.register_service(service, path, localOnly=True,
+                                           max_concurrent=max_concurrent, max_queued=max_queued,
+                                           subtree=path in self._container._subtrees)
+            container.call_later(self.CHECK_INTERVAL, _watch_parent,
+                                 container, os.getppid(), self.CHECK_INTERVAL)
+            container.run()
+        except BaseException:
+            log.exception('Worker process %s failed', index)
+            status = 1
+        finally:
+            # Skip the parent's exit handlers and zmq context clean-up
+            os._exit(status)
+
+    def _check(self):
+        for index, pid in enumerate(self._pids):
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                exited, status = pid, None
+            if exited:
+                log.error('Worker process %s (%s) exited with status %s; restarting', index, pid, status)
+                self._container.metrics.increment('process_restarts')
+                self._spawn(index)
+        self._check_timer = self._container.call_later(self.CHECK_INTERVAL, self._check)
+
+    def _forward_request(self, socket):
+        frames = socket.recv_multipart(copy=False)
+        # The message id follows the routing envelope
+        delimiter = 0
+        while len(frames[delimiter]):
+            delimiter += 1
+        msg_id = frames[delimiter + 1].bytes
+        backend = self._backends[(zlib.crc32(msg_id) & 0xffffffff) % len(self._backends)]
+        backend.send_multipart(frames, copy=False)
+
+    def _forward_reply(self, socket):
+        self._frontend.send_multipart(socket.recv_multipart(copy=False), copy=False)
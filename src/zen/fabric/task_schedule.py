@@ -1,45 +1,136 @@
-from bisect import bisect_right
-from datetime import timedelta, datetime
+import heapq
+import itertools
+import time
+from datetime import datetime
+
+# Monotonic clock used for all scheduling; wall clock adjustments must not
+# make timers fire early or late.  (time.monotonic is not available before
+# Python 3.3.)
+clock = getattr(time, 'monotonic', time.time)
+
+
+class ScheduledTask(object):
+    ''' Scheduled Task
+
+        Handle returned when a task is queued.  It remains valid until the
+        task fires and can be used to cancel the task.
+    '''
+    __slots__ = ('time', 'task', 'cancelled', '_schedule')
+
+    def __init__(self, schedule, time, task):
+        self._schedule = schedule
+        # Monotonic time (see clock) at which the task is due
+        self.time = time
+        self.task = task
+        self.cancelled = False
+
+    def cancel(self):
+        ''' Cancel the task.  Cancelling a task that already fired or was
+            already cancelled does nothing.
+        '''
+        if self.cancelled or self._schedule is None:
+            return
+        self.cancelled = True
+        self._schedule._task_cancelled()
+        self._schedule = None
+        self.task = None
+
 
 class TaskSchedule():
     ''' Task Schedule
-    
+
         Keeps track of tasks that need to be performed at a specific
         time, and then executes the task at the appropriate time.
+
+        Tasks are kept in a heap ordered by due time, so queueing and firing
+        a task are O(log n).  Cancelled tasks are left in the heap and
+        skipped when they reach the top, until they make up more than half
+        of it, at which point the heap is rebuilt without them.
     '''
     def __init__(self):
-        # Ordered list of times when tasks are scheduled to execute
-        self._task_times = []
-        # Ordered list of tasks, associated with the _task_times array
-        self._tasks =[]
-    
+        # Heap of [time, sequence, ScheduledTask]; the sequence keeps tasks
+        # due at the same time in the order they were queued.
+        self._heap = []
+        self._sequence = itertools.count()
+        # Number of cancelled tasks still in the heap
+        self._cancelled = 0
+
+    def __len__(self):
+        ''' Number of tasks waiting to be executed '''
+        return len(self._heap) - self._cancelled
+
     def queue_relative_task(self, seconds, task):
-        ''' Queue a task to be executed in the specified number of 
+        ''' Queue a task to be executed in the specified number of
             seconds.
-            
+
             task - must be an object with "callback" as a function;
-                e.g. twisted Deferred
+                e.g. twisted Deferred, or a function taking no arguments
+
+            Returns a ScheduledTask that can be used to cancel the task.
         '''
-        k = datetime.now() + timedelta(seconds=seconds)
-        return self.queue_absolute_task(k, task)
+        return self._queue(clock() + seconds, task)
 
     def queue_absolute_task(self, time, task):
         ''' Queue a task to be executed at the specified time
-        
-            time - datetime object (or something that can be compared
-                with datetime.now())
+
+            time - datetime object (or something that can be subtracted
+                from datetime.now() to give a timedelta)
             task - must be an object with "callback" as a function;
-                e.g. twisted Deferred
+                e.g. twisted Deferred, or a function taking no arguments
+
+            Returns a ScheduledTask that can be used to cancel the task.
+        '''
+        delay = (time - datetime.now()).total_seconds()
+        return self._queue(clock() + delay, task)
+
+    def call_later(self, seconds, func, *args):
+        ''' Call func(*args) in the specified number of seconds.
+
+            Returns a ScheduledTask that can be used to cancel the call.
+        '''
+        if args:
+            return self._queue(clock() + seconds, lambda: func(*args))
+        return self._queue(clock() + seconds, func)
+
+    def next_timeout(self):
+        ''' Number of seconds until the next task is due (0 if one is
+            already due), or None if no tasks are queued.
         '''
-        i = bisect_right(self._task_times, time)
-        self._task_times.insert(i, time)
-        self._tasks.insert(i, task)
-        return i
-    
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if not heap:
+            return None
+        return max(0.0, heap[0][0] - clock())
+
     def execute(self):
         ''' Executes all of the tasks that need to be executed.
         '''
-        while self._task_times and self._task_times[0] <= datetime.now():
-            deferred = self._tasks.pop(0)
-            deferred.callback(None)
-            self._task_times.pop(0)
+        heap = self._heap
+        now = clock()
+        while heap and heap[0][0] <= now:
+            handle = heapq.heappop(heap)[2]
+            if handle.cancelled:
+                self._cancelled -= 1
+                continue
+            task = handle.task
+            handle._schedule = None
+            handle.task = None
+            if hasattr(task, 'callback'):
+                task.callback(None)
+            else:
+                task()
+
+    def _queue(self, time, task):
+        handle = ScheduledTask(self, time, task)
+        heapq.heappush(self._heap, [time, next(self._sequence), handle])
+        return handle
+
+    def _task_cancelled(self):
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+            # Rebuild in place; execute() may be iterating over the heap
+            self._heap[:] = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
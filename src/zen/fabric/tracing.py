@@ -0,0 +1,247 @@
+''' tracing.py
+
+    Request tracing and profiling hooks.
+
+    A traced request carries its trace id and the id of the span that sent
+    it in the 'trace' header parameter, as 'trace id:span id'.  Every hop
+    records a Span: the client's covers the whole request, split into the
+    time to resolve the service, decode the reply and, roughly, the time
+    on the network; the container's is split into the time the request
+    waited to be handled (queue), decode, dispatch and encode.  Requests
+    sent while handling a traced request belong to the same trace, so a
+    trace follows a request through every container it passes through.
+
+    Clients start traces for a sample of their requests; see
+    ServiceEndpoint.TRACE_SAMPLE_RATE.  Finished spans are handed to the
+    end-point's exporters (see ServiceEndpoint.add_span_exporter), e.g. a
+    FileSpanExporter, or an exporter of your own sending them to a
+    collector.
+
+    A SamplingProfiler set on a container (see
+    ServiceContainer.set_profiler) profiles a sample of the calls to its
+    services' handle_request.
+'''
+import cProfile
+import json
+import os
+import pstats
+import random
+import socket as sys_socket
+import threading
+import time
+import uuid
+
+from zen.fabric.task_schedule import clock
+
+# The span being handled by each thread
+_current = threading.local()
+
+_process_name = None
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def new_span_id():
+    return uuid.uuid4().hex[:16]
+
+
+def parse_context(value):
+    ''' Returns (trace id, parent span id) from a 'trace' header parameter,
+        or None if it is malformed.
+    '''
+    parts = value.split(':')
+    if len(parts) != 2 or not all(parts):
+        return None
+    return parts[0], parts[1]
+
+
+def process_name():
+    ''' Identifies this process in spans: host/pid '''
+    global _process_name
+    if _process_name is None or not _process_name.endswith('/{0}'.format(os.getpid())):
+        _process_name = '{0}/{1}'.format(sys_socket.gethostname(), os.getpid())
+    return _process_name
+
+
+def current_span():
+    ''' The span of the request being handled by the current thread, or
+        None.  End-points read it on the thread send_request is called
+        from and send the request as its child, whichever thread then sends
+        it.  Commands that are coroutine functions run outside of it, so
+        requests they send start traces of their own.
+    '''
+    return getattr(_current, 'span', None)
+
+
+def activate(span):
+    ''' Make span the current thread's span; returns the previous one '''
+    previous = getattr(_current, 'span', None)
+    _current.span = span
+    return previous
+
+
+class Span(object):
+    ''' Span
+
+        One hop of a traced request.  timings has the seconds spent in
+        each part of the hop, recorded with lap().
+    '''
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'kind', 'name', 'process', 'start', 'duration',
+                 'timings', 'error', '_started', '_lap')
+
+    def __init__(self, trace_id, parent_id, kind, name=None, started=None):
+        ''' Params
+            ======
+            trace_id : string
+                Trace the span belongs to
+            parent_id : string
+                Span of the hop that sent the request; None for the first
+            kind : string
+                'client' or 'server'
+            name : string, optional
+                'path command' of the request
+            started : float, optional
+                clock() time at which the hop started; now when omitted.
+        '''
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.name = name
+        self.process = process_name()
+        now = clock()
+        self._started = self._lap = now if started is None else started
+        # Wall clock time, comparable across hosts (as far as their clocks
+        # agree)
+        self.start = time.time() - (now - self._started)
+        self.duration = None
+        self.timings = {}
+        self.error = None
+
+    @property
+    def context(self):
+        ''' The 'trace' header parameter of requests sent by this span '''
+        return '{0}:{1}'.format(self.trace_id, self.span_id)
+
+    def elapsed(self):
+        return clock() - self._started
+
+    def lap(self, name):
+        ''' Record the time since the previous lap (or the start) as the
+            named timing
+        '''
+        now = clock()
+        self.timings[name] = now - self._lap
+        self._lap = now
+
+    def end(self, error=None):
+        self.duration = clock() - self._started
+        self.error = error
+
+    def to_dict(self):
+        return {
+            'trace_id' : self.trace_id,
+            'span_id' : self.span_id,
+            'parent_id' : self.parent_id,
+            'kind' : self.kind,
+            'name' : self.name,
+            'process' : self.process,
+            'start' : self.start,
+            'duration' : self.duration,
+            'timings' : dict(self.timings),
+            'error' : self.error,
+        }
+
+
+class SpanExporter(object):
+    ''' Span Exporter
+
+        Receives the spans finished by an end-point.  export() is called on
+        whichever thread finished the span, including worker threads, so
+        it must be thread-safe and should not block for long.
+    '''
+    def export(self, span):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class FileSpanExporter(SpanExporter):
+    ''' Appends each span to a file, as a line of JSON '''
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), sort_keys=True) + '\n'
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class SamplingProfiler(object):
+    ''' Sampling Profiler
+
+        Runs a sample of the calls it is given under cProfile and adds up
+        the statistics of each kind of call (for a container, each 'path
+        command').  One call is profiled at a time; calls made meanwhile
+        run unprofiled.
+    '''
+    def __init__(self, sample_rate=0.01):
+        ''' Params
+            ======
+            sample_rate : float, optional
+                Fraction of the calls to profile
+        '''
+        self.sample_rate = sample_rate
+        self._profiling = threading.Lock()
+        self._lock = threading.Lock()
+        # key : pstats.Stats
+        self._stats = {}
+        # key : number of calls profiled
+        self._calls = {}
+
+    def call(self, key, func, *args):
+        ''' Returns func(*args), profiling the call if it is sampled '''
+        if random.random() >= self.sample_rate or not self._profiling.acquire(False):
+            return func(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self._profiling.release()
+            with self._lock:
+                if key in self._stats:
+                    self._stats[key].add(profile)
+                else:
+                    self._stats[key] = pstats.Stats(profile)
+                self._calls[key] = self._calls.get(key, 0) + 1
+
+    def calls(self):
+        ''' Number of calls profiled so far, by key '''
+        with self._lock:
+            return dict(self._calls)
+
+    def stats(self, key):
+        ''' pstats.Stats of the calls profiled for key, or None '''
+        with self._lock:
+            return self._stats.get(key)
+
+    def dump(self, directory):
+        ''' Write the statistics of each key to a .prof file in directory,
+            for pstats or a profile viewer
+        '''
+        with self._lock:
+            for key, stats in self._stats.items():
+                name = ''.join(c if c.isalnum() else '_' for c in key).strip('_') or 'root'
+                stats.dump_stats(os.path.join(directory, name + '.prof'))
@@ -0,0 +1,114 @@
+''' transport.py
+
+    Addresses of request sockets.
+
+    Services are usually reached over tcp, at 'host:port'.  Containers can
+    instead bind an ipc:// or inproc:// address, which is registered and
+    connected to as it is.  inproc:// addresses are only reachable from
+    end-points created with the same zmq.Context (see ServiceEndpoint).
+
+    A container can also accept requests on ipc and inproc alongside its
+    main address (see ServiceContainer.LOCAL_TRANSPORTS).  It registers
+    them with the service registry next to its 'REQ' address, along with
+    the host and zmq.Context they can be reached from,
+
+        { 'REQ' : 'host:port', 'IPC' : 'ipc://...', 'HOST' : host id,
+          'INPROC' : 'inproc://...', 'CONTEXT' : context id }
+
+    and clients connect to the cheapest one they can reach.
+'''
+import os
+import socket as sys_socket
+import uuid
+
+IPC = 'ipc'
+INPROC = 'inproc'
+
+_host_id = None
+
+
+def endpoint_url(address):
+    ''' The zmq endpoint of an address: tcp for 'host:port', or the address
+        itself if it names its transport.
+    '''
+    if '://' in address:
+        return address
+    return 'tcp://{0}'.format(address)
+
+
+def transport_of(address):
+    ''' 'tcp', 'ipc' or 'inproc' '''
+    return address.split('://', 1)[0] if '://' in address else 'tcp'
+
+
+def request_address(address, port=None):
+    ''' The address clients connect to for a container bound to address
+        and port; port is None for ipc:// and inproc:// addresses.
+    '''
+    if port is None:
+        return address
+    return '{0}:{1}'.format(address, port)
+
+
+def host_id():
+    ''' Identifies this host, as far as ipc:// addresses are concerned:
+        the host name, and the machine id where there is one (containers
+        can share a host name without sharing a file system).
+    '''
+    global _host_id
+    if _host_id is None:
+        machine_id = ''
+        for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+            try:
+                with open(path) as machine_id_file:
+                    machine_id = machine_id_file.read().strip()
+                break
+            except (IOError, OSError):
+                continue
+        _host_id = '{0}/{1}'.format(sys_socket.gethostname(), machine_id)
+    return _host_id
+
+
+def context_id(context):
+    ''' Identifies a zmq.Context, as far as inproc:// addresses are
+        concerned
+    '''
+    return '{0}/{1}/{2}'.format(host_id(), os.getpid(), id(context))
+
+
+def local_address(transport, directory):
+    ''' A new address for a request socket on an ipc or inproc transport;
+        ipc socket files are created in directory.
+    '''
+    name = 'zen-{0}'.format(uuid.uuid4().hex)
+    if transport == IPC:
+        return 'ipc://{0}'.format(os.path.join(directory, name + '.ipc'))
+    if transport == INPROC:
+        return 'inproc://{0}'.format(name)
+    raise ValueError('Unknown local transport {0}'.format(transport))
+
+
+def local_addresses(bound, context):
+    ''' Registration entries for the local addresses a container has
+        bound: transport : address
+    '''
+    addresses = {}
+    if IPC in bound:
+        addresses['IPC'] = bound[IPC]
+        addresses['HOST'] = host_id()
+    if INPROC in bound:
+        addresses['INPROC'] = bound[INPROC]
+        addresses['CONTEXT'] = context_id(context)
+    return addresses
+
+
+def select_address(addresses, context):
+    ''' The cheapest of a container's registered addresses that can be
+        reached from an end-point using context: inproc from the same
+        context, ipc from the same host, else its 'REQ' address.
+    '''
+    if 'INPROC' in addresses and addresses.get('CONTEXT') == context_id(context):
+        return addresses['INPROC']
+    if 'IPC' in addresses and addresses.get('HOST') == host_id():
+        return addresses['IPC']
+    return addresses['REQ']
@@ -0,0 +1,118 @@
+''' worker_pool.py
+
+    Pool of worker threads or processes used by a ServiceContainer to execute
+    requests concurrently.
+
+    Work is submitted from the thread running the endpoint's poll loop, and
+    completions are handed back to that same thread (zmq sockets are not
+    thread-safe) with ServiceEndpoint.call_soon_threadsafe, which wakes the
+    poll loop through an inproc socket polled alongside its other sockets.
+'''
+import multiprocessing
+import multiprocessing.pool
+import traceback
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+def _run_task(func, args):
+    ''' Execute func(*args) in a worker, capturing any exception so that it
+        can be reported back to the poll loop.
+    '''
+    try:
+        return (True, func(*args))
+    except:
+        return (False, traceback.format_exc())
+
+
+class WorkerPool(object):
+    ''' Worker Pool
+
+        Runs tasks on a pool of threads or processes and calls the completion
+        handlers on the endpoint's poll loop thread.
+    '''
+    def __init__(self, endpoint, size, worker_type=THREAD):
+        ''' Initialize the worker pool
+
+            Params
+            ======
+            endpoint : ServiceEndpoint
+                End-point whose poll loop will receive the completions.
+            size : int
+                Number of worker threads or processes.
+            worker_type : string, optional
+                'thread' or 'process'.  Process workers are forked when the
+                first task is submitted, so they see every service
+                registered up to that point.  Tasks submitted to a process
+                pool must be picklable (module level functions), and cannot
+                use the end-point, whose sockets belong to the parent.
+        '''
+        if worker_type not in (THREAD, PROCESS):
+            raise ValueError('Unknown worker type {0}'.format(worker_type))
+        self._endpoint = endpoint
+        self._size = size
+        self._worker_type = worker_type
+        self._pool = None
+        # Number of tasks submitted and not yet completed
+        self._pending = 0
+        # Completions wake the poll loop straight away, even before it runs
+        endpoint._open_wake()
+
+    @property
+    def worker_type(self):
+        return self._worker_type
+
+    @property
+    def size(self):
+        ''' Number of workers '''
+        return self._size
+
+    @property
+    def pending(self):
+        ''' Number of tasks that have been submitted and not yet completed '''
+        return self._pending
+
+    def submit(self, func, args, on_done):
+        ''' Submit a task to the pool
+
+            Params
+            ======
+            func : function
+                Function to execute in a worker
+            args : tuple
+                Arguments passed to func
+            on_done : function
+                Called on the poll loop thread as on_done(succeeded, result),
+                where result is the return value of func, or the formatted
+                traceback if it raised.
+        '''
+        if self._pool is None:
+            self._pool = self._create_pool()
+        self._pending += 1
+        self._pool.apply_async(_run_task, (func, args),
+                               callback=lambda outcome: self._complete(on_done, outcome))
+
+    def close(self):
+        ''' Stop accepting work and wait for the workers to exit '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _create_pool(self):
+        if self._worker_type == THREAD:
+            return multiprocessing.pool.ThreadPool(self._size)
+        # Services live in the parent's memory, so the workers must be forked
+        # rather than spawned.
+        if hasattr(multiprocessing, 'get_context'):
+            return multiprocessing.get_context('fork').Pool(self._size)
+        return multiprocessing.Pool(self._size)
+
+    def _complete(self, on_done, outcome):
+        # Runs on the pool's result handler thread
+        self._endpoint.call_soon_threadsafe(self._finish, on_done, outcome)
+
+    def _finish(self, on_done, outcome):
+        self._pending -= 1
+        on_done(*outcome)
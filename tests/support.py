@@ -0,0 +1,148 @@
+''' End-points running on threads of their own, for end to end tests.
+
+    Every end-point shares one zmq.Context and is reached over inproc://
+    addresses, so the tests need no ports or socket files.
+'''
+import threading
+import time
+import uuid
+import zmq
+
+from zen.fabric import service_registry
+from zen.fabric.service_client import ServiceClient
+from zen.fabric.service_container import ServiceContainer
+from zen.fabric.service_registry.service import ServiceRegistry
+
+# Seconds to wait for anything the tests expect to happen
+TIMEOUT = 10
+
+
+def start(endpoint):
+    ''' Run endpoint on a thread of its own; returns the thread once the
+        loop runs
+    '''
+    thread = threading.Thread(target=endpoint.run, args=(10,))
+    thread.daemon = True
+    thread.start()
+    call(endpoint, lambda: None)
+    return thread
+
+
+def call(endpoint, func, *args):
+    ''' Returns func(*args), called on the loop of endpoint '''
+    done = threading.Event()
+    outcome = []
+
+    def call():
+        try:
+            outcome.append((True, func(*args)))
+        except Exception as e:
+            outcome.append((False, e))
+        done.set()
+
+    endpoint.call_soon_threadsafe(call)
+    if not done.wait(TIMEOUT):
+        raise AssertionError('{0} was not called'.format(func))
+    succeeded, result = outcome[0]
+    if not succeeded:
+        raise result
+    return result
+
+
+class Fabric(object):
+    ''' A service registry, plus the containers and clients the test adds '''
+
+    def __init__(self):
+        self.context = zmq.Context()
+        self._endpoints = []
+        self._threads = []
+        self.registry_service = ServiceRegistry()
+        self.registry = ServiceContainer(self.context)
+        self.registry.LOCAL_TRANSPORTS = ()
+        self.srap = self.address('registry')
+        self.registry.init(self.srap)
+        self.registry.register_service(self.registry_service, service_registry.PATH, localOnly=True)
+        self.start(self.registry)
+
+    def address(self, name='endpoint'):
+        return 'inproc://test-{0}-{1}'.format(name, uuid.uuid4().hex)
+
+    def container(self, services=None, container_type=ServiceContainer, address=None, settings=None,
+                  **options):
+        ''' A running container connected to the registry, hosting
+            services (path : service); it is bound to address, a new
+            inproc:// address by default, settings (name : value) are set
+            on it before init() and options are passed to init()
+        '''
+        container = container_type(context=self.context)
+        container.LOCAL_TRANSPORTS = ()
+        for name, value in (settings or {}).items():
+            setattr(container, name, value)
+        container.init(address or self.address('container'), srap=self.srap, **options)
+        for path, service in (services or {}).items():
+            container.register_service(service, path)
+        for path in services or ():
+            self.wait_until(lambda: path in self.registry_service._services)
+        self.start(container)
+        return container
+
+    def client(self, client_type=ServiceClient, settings=None, **options):
+        ''' A running client of the registry; settings and options as for
+            container()
+        '''
+        client = client_type(context=self.context)
+        for name, value in (settings or {}).items():
+            setattr(client, name, value)
+        client.init(self.srap, **options)
+        self.start(client)
+        return client
+
+    def start(self, endpoint):
+        self._endpoints.append(endpoint)
+        self._threads.append(start(endpoint))
+
+    def call(self, endpoint, func, *args):
+        return call(endpoint, func, *args)
+
+    def result(self, endpoint, deferred):
+        ''' Returns what a Deferred fired on the loop of endpoint fires with,
+            raising the exception it fails with
+        '''
+        done = threading.Event()
+        outcome = []
+
+        def fired(result):
+            outcome.append(result)
+            done.set()
+
+        self.call(endpoint, deferred.addBoth, fired)
+        if not done.wait(TIMEOUT):
+            raise AssertionError('{0} did not fire'.format(deferred))
+        result = outcome[0]
+        if hasattr(result, 'value') and isinstance(result.value, Exception):
+            raise result.value
+        return result
+
+    def wait_until(self, condition):
+        deadline = time.time() + TIMEOUT
+        while not condition():
+            if time.time() > deadline:
+                raise AssertionError('Gave up waiting')
+            time.sleep(0.005)
+
+    def shutdown(self):
+        ''' Stop every end-point; can be called again '''
+        if not self._endpoints:
+            return
+        for endpoint in reversed(self._endpoints):
+            endpoint.shutdown()
+        for thread in self._threads:
+            thread.join(TIMEOUT)
+        for endpoint in self._endpoints:
+            # The event loops of asyncio end-points
+            loop = getattr(endpoint, '_loop', None)
+            if loop is not None:
+                loop.close()
+        self.context.destroy(linger=0)
+        self._endpoints = []
+        self._threads = []
@@ -0,0 +1,94 @@
+import unittest
+
+from zen.fabric.admission import HIGH, LOW, NORMAL, Admission, priority_of
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        admission = Admission()
+        for index in range(5):
+            self.assertIsNone(admission.add(None, NORMAL, index))
+        self.assertEqual([admission.next() for index in range(5)], [(None, index) for index in range(5)])
+        self.assertIsNone(admission.next())
+        self.assertEqual(admission.running, 5)
+
+    def test_max_concurrent(self):
+        admission = Admission(max_concurrent=2)
+        for index in range(3):
+            admission.add(None, NORMAL, index)
+        self.assertEqual(admission.next(), (None, 0))
+        self.assertEqual(admission.next(), (None, 1))
+        self.assertIsNone(admission.next())
+        self.assertEqual(admission.queued, 1)
+        admission.done(None)
+        self.assertEqual(admission.next(), (None, 2))
+        self.assertEqual(admission.queued, 0)
+
+    def test_highest_priority_first(self):
+        admission = Admission(max_concurrent=1)
+        admission.add(None, LOW, 'low')
+        admission.add(None, NORMAL, 'normal')
+        admission.add(None, HIGH, 'high')
+        admission.add(None, HIGH, 'high2')
+        started = []
+        while admission.queued:
+            path, request = admission.next()
+            started.append(request)
+            admission.done(path)
+        self.assertEqual(started, ['high', 'high2', 'normal', 'low'])
+
+    def test_full_queue_rejects(self):
+        admission = Admission(max_concurrent=1, max_queued=1)
+        admission.add(None, NORMAL, 'running')
+        admission.next()
+        self.assertIsNone(admission.add(None, NORMAL, 'queued'))
+        self.assertEqual(admission.add(None, NORMAL, 'rejected'), 'rejected')
+        self.assertEqual(admission.queued, 1)
+
+    def test_full_queue_displaces_lower_priority(self):
+        admission = Admission(max_concurrent=1, max_queued=2)
+        admission.add(None, NORMAL, 'running')
+        admission.next()
+        admission.add(None, LOW, 'low1')
+        admission.add(None, LOW, 'low2')
+        # The newest of the lowest priority goes
+        self.assertEqual(admission.add(None, HIGH, 'high'), 'low2')
+        self.assertEqual(admission.add(None, LOW, 'low3'), 'low3')
+        admission.done(None)
+        self.assertEqual(admission.next(), (None, 'high'))
+
+    def test_path_limits(self):
+        admission = Admission(max_concurrent=4)
+        admission.set_path_limits('/slow', max_concurrent=1, max_queued=1)
+        self.assertTrue(admission.has_path_limits)
+        admission.add('/slow', NORMAL, 'slow1')
+        self.assertEqual(admission.next(), ('/slow', 'slow1'))
+        admission.add('/slow', NORMAL, 'slow2')
+        self.assertEqual(admission.add('/slow', NORMAL, 'slow3'), 'slow3')
+        admission.add('/other', NORMAL, 'other')
+        # slow2 waits for slow1; the other path goes ahead of it
+        self.assertEqual(admission.next(), (None, 'other'))
+        self.assertIsNone(admission.next())
+        admission.done('/slow')
+        self.assertEqual(admission.next(), ('/slow', 'slow2'))
+
+    def test_removing_path_limits(self):
+        admission = Admission()
+        admission.set_path_limits('/a', max_concurrent=1)
+        self.assertEqual(admission.path_limits('/a'), (1, None))
+        admission.set_path_limits('/a')
+        self.assertFalse(admission.has_path_limits)
+        self.assertEqual(admission.path_limits('/a'), (None, None))
+
+
+class PriorityOfTest(unittest.TestCase):
+
+    def test_priority_of(self):
+        self.assertEqual(priority_of({}), NORMAL)
+        self.assertEqual(priority_of({ 'priority' : '-1' }), LOW)
+        self.assertEqual(priority_of({ 'priority' : 'bad' }), NORMAL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import threading
+import time
+import unittest
+import uuid
+
+try:
+    import asyncio
+    from zen.fabric.asyncio_endpoint import AsyncioServiceClient, AsyncioServiceContainer
+except ImportError:
+    # Python 2
+    asyncio = None
+
+from zen.fabric.service import Service
+from zen.fabric.service_client import ServiceClient
+
+from tests.support import TIMEOUT, Fabric, call, start
+
+
+class Echo(Service):
+
+    def echo(self, value):
+        return { 'value' : value }
+
+    def later(self, seconds):
+        # Awaited on the event loop, like the coroutine of an async def
+        return asyncio.sleep(seconds, { 'slept' : seconds })
+
+    def rows(self, count):
+        return ({ 'index' : index } for index in range(count))
+
+
+class Front(Service):
+
+    def call(self, value):
+        reply = self._container.send_request({ 'path' : '/echo', 'command' : 'echo',
+                                               'args' : { 'value' : value } }).result(TIMEOUT)
+        return { 'reply' : reply, 'thread' : threading.current_thread().name }
+
+
+def resolved(endpoint, future):
+    ''' What a future of the loop of endpoint is resolved with '''
+    done = threading.Event()
+    call(endpoint, future.add_done_callback, lambda future: done.set())
+    if not done.wait(TIMEOUT):
+        raise AssertionError('{0} was not resolved'.format(future))
+    return future.result()
+
+
+@unittest.skipIf(asyncio is None, 'asyncio needs Python 3')
+class AsyncioServiceContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.container = AsyncioServiceContainer(self.loop)
+        self.container.LOCAL_TRANSPORTS = ()
+        self.container.init('inproc://test-asyncio-{0}'.format(uuid.uuid4().hex), workers=2)
+        self.container.register_service(Front(), '/front', localOnly=True)
+        self.container.register_service(Echo(), '/echo', localOnly=True)
+        self.thread = start(self.container)
+
+    def tearDown(self):
+        self.container.shutdown()
+        self.thread.join(TIMEOUT)
+        self.loop.close()
+        self.container._context.destroy(linger=0)
+
+    def test_requests_from_the_thread_pool(self):
+        loop_thread = call(self.container, threading.current_thread).name
+        reply = self.container.send_request({ 'path' : '/front', 'command' : 'call',
+                                              'args' : { 'value' : 1 } }).result(TIMEOUT)
+        self.assertEqual(reply['reply'], { 'value' : 1 })
+        self.assertNotEqual(reply['thread'], loop_thread)
+
+    def test_requests_on_the_loop_return_asyncio_futures(self):
+        future = call(self.container, self.container.send_request,
+                      { 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertIsInstance(future, asyncio.Future)
+        self.assertEqual(resolved(self.container, future), { 'value' : 1 })
+
+
+@unittest.skipIf(asyncio is None, 'asyncio needs Python 3')
+class AsyncioFabricTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def test_asyncio_client(self):
+        self.fabric.container({ '/echo' : Echo() }, workers=2)
+        client = self.fabric.client(AsyncioServiceClient)
+        future = call(client, client.send_request, { 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertEqual(resolved(client, future), { 'value' : 1 })
+
+    def test_asyncio_container(self):
+        self.fabric.container({ '/echo' : Echo() }, AsyncioServiceContainer, workers=2)
+        client = self.fabric.client(ServiceClient)
+        reply = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertEqual(reply.wait(TIMEOUT), { 'value' : 1 })
+
+    def test_awaitables_run_at_once_on_the_loop(self):
+        self.fabric.container({ '/echo' : Echo() }, AsyncioServiceContainer)
+        client = self.fabric.client(ServiceClient)
+        started = time.time()
+        replies = [client.send_request({ 'path' : '/echo', 'command' : 'later', 'args' : { 'seconds' : 0.2 } })
+                   for index in range(5)]
+        self.assertEqual([reply.wait(TIMEOUT) for reply in replies], [{ 'slept' : 0.2 }] * 5)
+        self.assertLess(time.time() - started, 0.8)
+
+    def test_limits_apply_to_awaitables(self):
+        self.fabric.container({ '/echo' : Echo() }, AsyncioServiceContainer,
+                              settings={ 'MAX_CONCURRENT_REQUESTS' : 1, 'MAX_QUEUED_REQUESTS' : 1 })
+        client = self.fabric.client(ServiceClient)
+        replies = [client.send_request({ 'path' : '/echo', 'command' : 'later', 'args' : { 'seconds' : 0.2 } })
+                   for index in range(3)]
+        replies = [reply.wait(TIMEOUT) for reply in replies]
+        self.assertEqual(replies[:2], [{ 'slept' : 0.2 }] * 2)
+        self.assertEqual(replies[2]['error'], 'overloaded')
+
+    def test_asyncio_stream(self):
+        self.fabric.container({ '/echo' : Echo() }, workers=2)
+        client = self.fabric.client(AsyncioServiceClient)
+        items = []
+
+        def on_item(item):
+            items.append(item)
+            # Consumed once awaited
+            return asyncio.sleep(0)
+
+        stream = call(client, client.stream_request, { 'path' : '/echo', 'command' : 'rows',
+                                                       'args' : { 'count' : 20 } }, on_item, 4)
+        self.assertEqual(resolved(client, stream.finished), 20)
+        self.assertEqual(items, [{ 'index' : index } for index in range(20)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import time
+import unittest
+
+from zen.fabric.batch_service_client import BatchServiceClient
+from zen.fabric.batch_service_container import BatchServiceContainer
+from zen.fabric.service import Service
+
+from tests.support import TIMEOUT, Fabric
+
+
+class Sleeper(Service):
+
+    def __init__(self):
+        super(Sleeper, self).__init__()
+        self.running = 0
+        self.most_running = 0
+        self._lock = threading.Lock()
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(seconds)
+        with self._lock:
+            self.running -= 1
+        return { 'slept' : seconds }
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+        self.sleeper = Sleeper()
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def batch(self, seconds, count, **options):
+        ''' Send count calls of sleep(seconds) as a batch; returns the
+            results, and the times at which they arrived
+        '''
+        client = self.fabric.client(BatchServiceClient)
+        calls = [{ 'command' : 'sleep', 'args' : { 'seconds' : seconds } }] * count
+        arrived = []
+        done = threading.Event()
+
+        def send():
+            results = client.send_batch('/sleep', calls, **options)
+            for index, result in enumerate(results):
+                result.addBoth(arrive, index)
+
+        def arrive(result, index):
+            arrived.append((index, result, time.time()))
+            if len(arrived) == count:
+                done.set()
+
+        self.fabric.call(client, send)
+        self.assertTrue(done.wait(TIMEOUT))
+        arrived.sort(key=lambda arrival: arrival[0])
+        return [result for index, result, at in arrived], [at for index, result, at in arrived]
+
+    def test_results_arrive_in_chunks(self):
+        self.fabric.container({ '/sleep' : self.sleeper }, BatchServiceContainer, workers=1)
+        results, times = self.batch(0.1, 5, chunk_size=2)
+        self.assertEqual(results, [{ 'slept' : 0.1 }] * 5)
+        # Each chunk as soon as it completes
+        self.assertTrue(times[1] - times[0] < 0.05)
+        self.assertTrue(times[2] - times[1] >= 0.15)
+        self.assertTrue(times[4] - times[3] >= 0.05)
+
+    def test_each_chunk_has_its_own_deadline(self):
+        # The batch takes longer than the timeout; each chunk doesn't
+        self.fabric.container({ '/sleep' : self.sleeper }, BatchServiceContainer, workers=1)
+        results, times = self.batch(0.1, 6, chunk_size=2, timeout=0.5)
+        self.assertEqual(results, [{ 'slept' : 0.1 }] * 6)
+
+    def test_a_chunk_past_its_deadline_fails(self):
+        self.fabric.container({ '/sleep' : self.sleeper }, BatchServiceContainer, workers=1)
+        results, times = self.batch(0.3, 2, chunk_size=2, timeout=0.1)
+        self.assertEqual([type(result.value).__name__ for result in results], ['RequestTimeoutError'] * 2)
+
+    def test_parallel_chunks(self):
+        self.fabric.container({ '/sleep' : self.sleeper }, BatchServiceContainer, workers=2)
+        results, times = self.batch(0.1, 4, chunk_size=1, parallel=True)
+        self.assertEqual(results, [{ 'slept' : 0.1 }] * 4)
+        self.assertEqual(self.sleeper.most_running, 2)
+
+    def test_without_workers(self):
+        self.fabric.container({ '/sleep' : self.sleeper }, BatchServiceContainer)
+        results, times = self.batch(0, 3, chunk_size=1)
+        self.assertEqual(results, [{ 'slept' : 0 }] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
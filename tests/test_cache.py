@@ -0,0 +1,88 @@
+import time
+import unittest
+
+from zen.fabric.cache import ResponseCache, cached, request_key
+from zen.fabric.codec import Buffer
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def key(self, path='/a', command='get', args=None):
+        return request_key({ 'path' : path, 'command' : command, 'args' : args or {} })
+
+    def test_get_and_put(self):
+        cache = ResponseCache(10)
+        self.assertEqual(cache.get(self.key()), (False, None))
+        cache.put(self.key(), { 'value' : 1 }, 60)
+        self.assertEqual(cache.get(self.key()), (True, { 'value' : 1 }))
+        self.assertEqual(len(cache), 1)
+
+    def test_ttl(self):
+        cache = ResponseCache(10)
+        cache.put(self.key(), 'response', 0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get(self.key()), (False, None))
+
+    def test_max_age(self):
+        cache = ResponseCache(10)
+        cache.put(self.key(), 'response', 60)
+        time.sleep(0.02)
+        self.assertEqual(cache.get(self.key(), max_age=0.01), (False, None))
+        self.assertEqual(cache.get(self.key(), max_age=60), (True, 'response'))
+
+    def test_least_recently_used_go_first(self):
+        cache = ResponseCache(2)
+        cache.put(self.key('/a'), 'a', 60)
+        cache.put(self.key('/b'), 'b', 60)
+        cache.get(self.key('/a'))
+        cache.put(self.key('/c'), 'c', 60)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get(self.key('/a'))[0])
+        self.assertFalse(cache.get(self.key('/b'))[0])
+        self.assertTrue(cache.get(self.key('/c'))[0])
+
+    def test_invalidate(self):
+        cache = ResponseCache(10)
+        cache.put(self.key('/a', 'get', { 'x' : 1 }), 1, 60)
+        cache.put(self.key('/a', 'get', { 'x' : 2 }), 2, 60)
+        cache.put(self.key('/a', 'list'), 3, 60)
+        cache.put(self.key('/b', 'get', { 'x' : 1 }), 4, 60)
+        cache.invalidate('/a', 'get', { 'x' : 1 })
+        self.assertEqual(len(cache), 3)
+        cache.invalidate('/a', 'get')
+        self.assertEqual(len(cache), 2)
+        cache.invalidate('/a')
+        self.assertEqual(len(cache), 1)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_subtree_responses(self):
+        # Responses of a subtree service are keyed by its path, followed by
+        # the path requested
+        cache = ResponseCache(10)
+        cache.put(self.key('/orders') + ('/orders/1',), 1, 60)
+        cache.put(self.key('/orders') + ('/orders/2',), 2, 60)
+        cache.invalidate('/orders/1')
+        self.assertEqual(len(cache), 1)
+        cache.invalidate('/orders')
+        self.assertEqual(len(cache), 0)
+
+
+class RequestKeyTest(unittest.TestCase):
+
+    def test_args_order_does_not_matter(self):
+        self.assertEqual(request_key({ 'path' : '/a', 'command' : 'get', 'args' : { 'x' : 1, 'y' : 2 } }),
+                         request_key({ 'path' : '/a', 'command' : 'get', 'args' : { 'y' : 2, 'x' : 1 } }))
+
+    def test_buffers_cannot_be_keyed(self):
+        self.assertIsNone(request_key({ 'path' : '/a', 'command' : 'put', 'args' : { 'data' : Buffer(b'x') } }))
+
+    def test_cached(self):
+        @cached(5)
+        def command(self):
+            pass
+        self.assertEqual(command.cache_ttl, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from zen.fabric.codec import (Buffer, DEFAULT_CODEC, compress_message, decode_message, encode_message,
+                              message_params, negotiate, to_bytes)
+from zen.fabric.errors import UnsupportedCodecError
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_plain_json_is_body_alone(self):
+        frames = encode_message({ 'path' : '/a', 'args' : { 'x' : 1 } })
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(decode_message(frames), ({ 'path' : '/a', 'args' : { 'x' : 1 } }, DEFAULT_CODEC))
+
+    def test_params_in_header(self):
+        frames = encode_message({ 'a' : 1 }, params={ 'batch' : 1, 'priority' : 2 })
+        self.assertEqual(frames[0], b'json;batch=1;priority=2')
+        self.assertEqual(message_params(frames), { 'batch' : '1', 'priority' : '2' })
+        self.assertEqual(decode_message(frames), ({ 'a' : 1 }, 'json'))
+
+    def test_buffer_of_bytes_is_a_frame(self):
+        frames = encode_message({ 'data' : Buffer(b'\x00\x01binary'), 'n' : 1 })
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(frames[2], b'\x00\x01binary')
+        message, codec_name = decode_message(frames)
+        self.assertEqual(to_bytes(message['data']), b'\x00\x01binary')
+        self.assertEqual(message['n'], 1)
+
+    def test_buffers_keep_their_order(self):
+        frames = encode_message([Buffer(bytearray(b'one')), memoryview(b'two'), Buffer(b'three')])
+        message, codec_name = decode_message(frames)
+        self.assertEqual([to_bytes(buf) for buf in message], [b'one', b'two', b'three'])
+
+    def test_buffer_of_non_buffer_raises(self):
+        self.assertRaises(TypeError, encode_message, { 'data' : Buffer(42) })
+
+    def test_compressed_body(self):
+        message = { 'text' : 'abc' * 1000, 'data' : Buffer(b'raw') }
+        frames = compress_message(encode_message(message), 'zlib')
+        self.assertEqual(message_params(frames), { 'compressed' : 'zlib' })
+        self.assertEqual(frames[2], b'raw')
+        decoded, codec_name = decode_message(frames)
+        self.assertEqual(decoded['text'], message['text'])
+        self.assertEqual(to_bytes(decoded['data']), b'raw')
+
+    def test_compressed_plain_json(self):
+        frames = compress_message(encode_message({ 'a' : 'x' * 100 }), 'zlib')
+        self.assertEqual(decode_message(frames), ({ 'a' : 'x' * 100 }, 'json'))
+
+    def test_unsupported_codec(self):
+        self.assertRaises(UnsupportedCodecError, decode_message, [b'nope', b'{}'])
+
+    def test_negotiate_falls_back_to_default(self):
+        self.assertEqual(negotiate(['nope', 'json'], ['json']), 'json')
+        self.assertEqual(negotiate(['nope'], ['nope']), DEFAULT_CODEC)
+        self.assertEqual(negotiate(['json'], None), DEFAULT_CODEC)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+from zen.fabric.service_registry.path_tree import PathTree, ancestors, is_under
+
+
+class PathTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = PathTree()
+        for path in ['/', '/a', '/a/b', '/a/b/c', '/ab', '/x/y']:
+            self.tree.add(path)
+
+    def test_under(self):
+        self.assertEqual(sorted(self.tree.under('/a')), ['/a', '/a/b', '/a/b/c'])
+        self.assertEqual(sorted(self.tree.under('/a/b/c')), ['/a/b/c'])
+        self.assertEqual(sorted(self.tree.under('/x')), ['/x/y'])
+        self.assertEqual(self.tree.under('/q'), [])
+        self.assertEqual(len(self.tree.under('/')), 6)
+
+    def test_trailing_slash(self):
+        self.assertEqual(sorted(self.tree.under('/a/')), ['/a', '/a/b', '/a/b/c'])
+
+    def test_discard_keeps_paths_below(self):
+        self.tree.discard('/a')
+        self.assertEqual(sorted(self.tree.under('/a')), ['/a/b', '/a/b/c'])
+
+    def test_discard_prunes_empty_nodes(self):
+        self.tree.discard('/x/y')
+        self.assertEqual(self.tree.under('/x'), [])
+        self.assertNotIn('x', self.tree._root)
+
+    def test_discard_unknown_path(self):
+        self.tree.discard('/a/q/r')
+        self.tree.discard('/x')
+        self.assertEqual(len(self.tree.under('/')), 6)
+
+
+class PathFunctionsTest(unittest.TestCase):
+
+    def test_ancestors(self):
+        self.assertEqual(list(ancestors('/a/b/c')), ['/a/b', '/a', '/'])
+        self.assertEqual(list(ancestors('/a/')), ['/'])
+        self.assertEqual(list(ancestors('/')), [])
+
+    def test_is_under(self):
+        self.assertTrue(is_under('/a/b', '/a'))
+        self.assertTrue(is_under('/a', '/a'))
+        self.assertTrue(is_under('/a', '/a/'))
+        self.assertTrue(is_under('/a', '/'))
+        self.assertFalse(is_under('/ab', '/a'))
+        self.assertFalse(is_under('/a', '/a/b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
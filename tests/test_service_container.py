@@ -0,0 +1,212 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zmq
+
+from zen.fabric import tracing, transport
+from zen.fabric.service import Service
+from zen.fabric.service_container import ServiceContainer
+
+from tests.support import TIMEOUT, Fabric
+
+
+class Echo(Service):
+
+    def echo(self, value):
+        return { 'value' : value, 'thread' : threading.current_thread().name }
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return { 'slept' : seconds }
+
+
+class Store(Service):
+
+    def __init__(self):
+        super(Store, self).__init__()
+        self.value = { 'items' : [1, 2, 3] }
+
+    def get(self):
+        return self.value
+
+
+class Front(Service):
+    ''' Calls another service while handling its requests '''
+
+    def call(self, path, value):
+        reply = self._container.send_request({ 'path' : path, 'command' : 'echo',
+                                               'args' : { 'value' : value } }).wait(TIMEOUT)
+        return { 'reply' : reply, 'thread' : threading.current_thread().name }
+
+
+class Forked(Service):
+    ''' Tries to use its container from a process worker '''
+
+    def call(self):
+        return self._refused(self._container.send_request, { 'path' : '/echo', 'command' : 'echo' })
+
+    def invalidate_all(self):
+        return self._refused(self.invalidate)
+
+    def _refused(self, func, *args):
+        try:
+            func(*args)
+        except RuntimeError as e:
+            return { 'refused' : str(e) }
+        return { 'refused' : None }
+
+
+class Exporter(tracing.SpanExporter):
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class ServiceContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def test_round_trip(self):
+        self.fabric.container({ '/echo' : Echo() })
+        client = self.fabric.client()
+        reply = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 'hi' } })
+        self.assertEqual(reply.wait(TIMEOUT)['value'], 'hi')
+
+    def test_addresses_naming_their_transport_are_bound_and_registered_as_they_are(self):
+        address = self.fabric.address('echo')
+        self.fabric.container({ '/echo' : Echo() }, address=address)
+        instances = list(self.fabric.registry_service._services['/echo'].values())
+        self.assertEqual(instances[0]['addresses']['REQ'], address)
+
+    def test_round_trip_over_tcp(self):
+        container = self.fabric.container({ '/echo' : Echo() }, address='127.0.0.1')
+        self.assertTrue(container._request_port)
+        client = self.fabric.client()
+        reply = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 'tcp' } })
+        self.assertEqual(reply.wait(TIMEOUT)['value'], 'tcp')
+
+    @unittest.skipUnless(zmq.has('ipc'), 'ipc is not supported')
+    def test_round_trip_over_ipc(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        address = 'ipc://{0}'.format(os.path.join(directory, 'echo.ipc'))
+        self.fabric.container({ '/echo' : Echo() }, address=address)
+        client = self.fabric.client()
+        reply = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 'ipc' } })
+        self.assertEqual(reply.wait(TIMEOUT)['value'], 'ipc')
+
+    def test_local_transports(self):
+        # Reached over inproc by default, whatever request_address is
+        self.fabric.container({ '/echo' : Echo() }, address='127.0.0.1',
+                              settings={ 'LOCAL_TRANSPORTS' : ServiceContainer.LOCAL_TRANSPORTS })
+        addresses = list(self.fabric.registry_service._services['/echo'].values())[0]['addresses']
+        self.assertNotIn('IPC', addresses)
+        client = self.fabric.client()
+        reply = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertEqual(reply.wait(TIMEOUT)['value'], 1)
+        self.assertEqual(client.metrics.snapshot()['counters']['connections_opened'], { 'inproc' : 1 })
+
+    @unittest.skipUnless(zmq.has('ipc'), 'ipc is not supported')
+    def test_ipc_is_opt_in(self):
+        container = self.fabric.container({ '/echo' : Echo() }, address='127.0.0.1',
+                                          settings={ 'LOCAL_TRANSPORTS' : (transport.IPC,) })
+        path = container._local_addresses['IPC'][len('ipc://'):]
+        self.assertTrue(os.path.exists(path))
+        client = self.fabric.client()
+        reply = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertEqual(reply.wait(TIMEOUT)['value'], 1)
+        self.assertEqual(client.metrics.snapshot()['counters']['connections_opened'], { 'ipc' : 1 })
+        self.fabric.shutdown()
+        self.assertFalse(os.path.exists(path))
+
+    def test_context(self):
+        container = ServiceContainer(self.fabric.context)
+        self.assertIs(container._context, self.fabric.context)
+        own = ServiceContainer()
+        self.addCleanup(own._context.destroy, 0)
+        self.assertIsNot(own._context, self.fabric.context)
+
+    def test_requests_to_own_services_are_handed_to_them(self):
+        for workers in (0, 2):
+            store = Store()
+            container = self.fabric.container({ '/store' : store }, workers=workers)
+
+            def send():
+                sent = container.send_request({ 'path' : '/store', 'command' : 'get' })
+                # Still asynchronous, like a remote request
+                self.assertFalse(sent.called)
+                return sent
+
+            sent = self.fabric.call(container, send)
+            # The object the service returned, without a connection
+            self.assertIs(self.fabric.result(container, sent), store.value)
+            self.assertEqual(self.fabric.call(container, lambda: len(container._in_flight)), 0)
+
+    def test_workers_reply_as_requests_complete(self):
+        self.fabric.container({ '/echo' : Echo() }, workers=2)
+        client = self.fabric.client()
+        slow = client.send_request({ 'path' : '/echo', 'command' : 'sleep', 'args' : { 'seconds' : 0.5 } })
+        fast = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertEqual(fast.wait(TIMEOUT)['value'], 1)
+        self.assertFalse(slow.called)
+        self.assertEqual(slow.wait(TIMEOUT), { 'slept' : 0.5 })
+
+    def test_limits_set_on_the_instance(self):
+        container = self.fabric.container({ '/echo' : Echo() }, workers=2,
+                                          settings={ 'MAX_CONCURRENT_REQUESTS' : 1, 'MAX_QUEUED_REQUESTS' : 0 })
+        self.assertEqual(container.MAX_CONCURRENT_REQUESTS, 1)
+        client = self.fabric.client()
+        slow = client.send_request({ 'path' : '/echo', 'command' : 'sleep', 'args' : { 'seconds' : 0.2 } })
+        self.fabric.wait_until(lambda: container._admission.running == 1)
+        rejected = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertEqual(rejected.wait(TIMEOUT)['error'], 'overloaded')
+        self.assertEqual(slow.wait(TIMEOUT), { 'slept' : 0.2 })
+
+    def test_requests_from_workers(self):
+        # /front runs on a worker and calls /echo, in the same container and
+        # in another one, from there
+        container = self.fabric.container({ '/front' : Front(), '/echo' : Echo() }, workers=2)
+        self.fabric.container({ '/remote' : Echo() }, workers=1)
+        client = self.fabric.client()
+        loop_thread = self.fabric.call(container, threading.current_thread).name
+        for path in ('/echo', '/remote'):
+            reply = client.send_request({ 'path' : '/front', 'command' : 'call',
+                                          'args' : { 'path' : path, 'value' : path } }).wait(TIMEOUT)
+            self.assertEqual(reply['reply']['value'], path)
+            self.assertNotEqual(reply['thread'], loop_thread)
+        self.assertEqual(self.fabric.call(container, lambda: len(container._requests)), 0)
+
+    def test_process_workers_cannot_use_the_container(self):
+        self.fabric.container({ '/forked' : Forked(), '/echo' : Echo() }, workers=1, worker_type='process')
+        client = self.fabric.client()
+        for command in ('call', 'invalidate_all'):
+            reply = client.send_request({ 'path' : '/forked', 'command' : command }).wait(TIMEOUT)
+            self.assertIn('forked process', reply['refused'])
+
+    def test_requests_from_workers_keep_the_trace(self):
+        container = self.fabric.container({ '/front' : Front(), '/echo' : Echo() }, workers=2)
+        exporter = Exporter()
+        container.add_span_exporter(exporter)
+        client = self.fabric.client()
+        client.TRACE_SAMPLE_RATE = 1.0
+        client.send_request({ 'path' : '/front', 'command' : 'call',
+                              'args' : { 'path' : '/echo', 'value' : 1 } }).wait(TIMEOUT)
+        self.fabric.wait_until(lambda: len(exporter.spans) == 2)
+        spans = dict((span.kind, span) for span in exporter.spans)
+        self.assertEqual(spans['client'].name, '/echo echo')
+        self.assertEqual(spans['client'].trace_id, spans['server'].trace_id)
+        self.assertEqual(spans['client'].parent_id, spans['server'].span_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import threading
+import time
+import unittest
+
+from zen.fabric.service import Service
+
+from tests.support import TIMEOUT, Fabric
+
+
+class Sleeper(Service):
+
+    def __init__(self):
+        super(Sleeper, self).__init__()
+        self.running = 0
+        self.most_running = 0
+        self._lock = threading.Lock()
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(seconds)
+        with self._lock:
+            self.running -= 1
+        return { 'slept' : seconds }
+
+
+class RequestWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+        self.sleeper = Sleeper()
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def send(self, client, seconds):
+        return client.send_request({ 'path' : '/sleep', 'command' : 'sleep', 'args' : { 'seconds' : seconds } })
+
+    def connection(self, client):
+        ''' (in flight, queued) on the client's only connection '''
+        def window():
+            for socket, in_flight in client._in_flight.items():
+                return in_flight, len(client._backlog[socket])
+        return self.fabric.call(client, window)
+
+    def test_requests_beyond_the_window_wait_for_replies(self):
+        self.fabric.container({ '/sleep' : self.sleeper }, workers=4)
+        client = self.fabric.client(settings={ 'REQUEST_WINDOW' : 2 })
+        replies = [self.send(client, 0.1) for index in range(5)]
+        self.fabric.wait_until(lambda: self.connection(client) == (2, 3))
+        for reply in replies:
+            self.assertEqual(reply.wait(TIMEOUT), { 'slept' : 0.1 })
+        self.assertEqual(self.sleeper.most_running, 2)
+        self.assertEqual(self.connection(client), (0, 0))
+
+    def test_replies_are_matched_to_requests_in_any_order(self):
+        self.fabric.container({ '/sleep' : self.sleeper }, workers=2)
+        client = self.fabric.client()
+        slow = self.send(client, 0.3)
+        fast = self.send(client, 0.01)
+        self.assertEqual(fast.wait(TIMEOUT), { 'slept' : 0.01 })
+        self.assertFalse(slow.called)
+        self.assertEqual(slow.wait(TIMEOUT), { 'slept' : 0.3 })
+
+    def test_requests_are_pipelined_to_rep_containers(self):
+        self.fabric.container({ '/sleep' : self.sleeper })
+        client = self.fabric.client()
+        replies = [self.send(client, 0) for index in range(10)]
+        self.assertEqual([reply.wait(TIMEOUT) for reply in replies], [{ 'slept' : 0 }] * 10)
+        self.assertEqual(self.sleeper.most_running, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
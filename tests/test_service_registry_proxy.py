@@ -0,0 +1,160 @@
+import time
+import unittest
+
+from zen.fabric.codec import encode_message
+from zen.fabric.service import Service
+from zen.fabric.service_endpoint import ServiceEndpoint
+
+from tests.support import TIMEOUT, Fabric
+
+
+class Echo(Service):
+
+    def echo(self, value):
+        return { 'value' : value }
+
+
+class Subscription(object):
+    ''' Stands in for the SUB socket, receiving one published change '''
+
+    def __init__(self, change):
+        self._frames = [change['path'].encode('utf-8')] + encode_message(change)
+
+    def recv_multipart(self, copy=True):
+        return self._frames
+
+
+class ChangeSequenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = ServiceEndpoint()
+        self.endpoint.init(None)
+        self.proxy = self.endpoint._service_registry
+        self.reloads = []
+        self.proxy._reload = lambda: self.reloads.append(self.proxy._version)
+        self.proxy._apply_snapshot({ 'epoch' : 'e1', 'version' : 3, 'publisher' : None,
+                                     'services' : { '/a' : [self.instance('a')] } })
+
+    def tearDown(self):
+        self.endpoint._context.destroy(linger=0)
+
+    def instance(self, name):
+        return { 'addresses' : { 'REQ' : '{0}:1'.format(name) }, 'codecs' : None }
+
+    def publish(self, version, path, instances, epoch='e1'):
+        self.proxy._handle_change(Subscription({ 'epoch' : epoch, 'version' : version,
+                                                 'path' : path, 'instances' : instances }))
+
+    def test_changes_in_sequence_are_applied(self):
+        self.publish(4, '/b', [self.instance('b')])
+        self.publish(5, '/a', [])
+        self.assertEqual(self.proxy._version, 5)
+        self.assertEqual(list(self.proxy._known_services), ['/b'])
+        self.assertEqual(self.reloads, [])
+
+    def test_changes_in_the_snapshot_are_ignored(self):
+        self.publish(3, '/a', [])
+        self.assertEqual(self.proxy._version, 3)
+        self.assertIn('/a', self.proxy._known_services)
+
+    def test_a_gap_reloads(self):
+        self.publish(5, '/b', [self.instance('b')])
+        self.assertIn('/b', self.proxy._known_services)
+        self.assertIsNone(self.proxy._version)
+        self.assertEqual(self.reloads, [None])
+        # Nothing else applies until the reload arrives
+        self.publish(6, '/c', [self.instance('c')])
+        self.assertNotIn('/c', self.proxy._known_services)
+
+    def test_a_new_epoch_reloads(self):
+        self.publish(1, '/b', [self.instance('b')], epoch='e2')
+        self.assertEqual(self.reloads, [None])
+
+    def test_older_snapshots_are_ignored(self):
+        self.publish(4, '/b', [self.instance('b')])
+        self.proxy._apply_snapshot({ 'epoch' : 'e1', 'version' : 3, 'publisher' : None,
+                                     'services' : { '/a' : [self.instance('a')] } })
+        self.assertEqual(self.proxy._version, 4)
+        self.assertIn('/b', self.proxy._known_services)
+
+
+class SubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def test_clients_follow_registrations(self):
+        self.follow_registrations(self.fabric.address('changes'))
+
+    def test_clients_follow_registrations_over_tcp(self):
+        self.follow_registrations('127.0.0.1')
+
+    def follow_registrations(self, address):
+        registry = self.fabric.registry_service
+        self.fabric.call(self.fabric.registry, registry.bind_publisher, address)
+        client = self.fabric.client()
+        proxy = client._service_registry
+        self.fabric.wait_until(lambda: self.fabric.call(client, lambda: proxy._version is not None))
+        # Give the subscription time to connect; changes published before
+        # it has are only caught up on by the next resync
+        time.sleep(0.2)
+        self.fabric.container({ '/echo' : Echo() })
+        self.fabric.wait_until(lambda: self.fabric.call(client, lambda: '/echo' in proxy._known_services))
+        reply = client.send_request({ 'path' : '/echo', 'command' : 'echo', 'args' : { 'value' : 1 } })
+        self.assertEqual(reply.wait(TIMEOUT), { 'value' : 1 })
+        self.assertEqual(client.metrics.snapshot()['counters']['registry_lookups'], { 'hit' : 1 })
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+        self.fabric.container({ '/a' : Echo(), '/b' : Echo() })
+        self.fabric.container({ '/c' : Echo() })
+        self.client = self.fabric.client()
+        self.proxy = self.client._service_registry
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def configure(self, **settings):
+        def configure():
+            for name, value in settings.items():
+                setattr(self.proxy, name, value)
+        self.fabric.call(self.client, configure)
+
+    def echo(self, path):
+        reply = self.client.send_request({ 'path' : path, 'command' : 'echo', 'args' : { 'value' : path } })
+        self.assertEqual(reply.wait(TIMEOUT), { 'value' : path })
+
+    def connections(self):
+        return self.fabric.call(self.client, lambda: len(self.proxy._connections))
+
+    def test_paths_of_a_container_share_its_connection(self):
+        for path in ('/a', '/b', '/c', '/a'):
+            self.echo(path)
+        self.assertEqual(self.connections(), 2)
+
+    def test_the_least_recently_used_connection_makes_room(self):
+        self.configure(MAX_CONNECTIONS=1)
+        for path in ('/a', '/c', '/b'):
+            self.echo(path)
+            self.assertEqual(self.connections(), 1)
+        counters = self.client.metrics.snapshot()['counters']
+        self.assertEqual(counters['connections_opened'], { 'inproc' : 3 })
+        self.assertEqual(counters['connection_evictions'], { '' : 2 })
+
+    def test_idle_connections_are_closed(self):
+        self.configure(CONNECTION_IDLE_TIMEOUT=0.1)
+        self.echo('/a')
+        self.fabric.wait_until(lambda: self.connections() == 0)
+        # and reopened when needed
+        self.echo('/b')
+        self.assertEqual(self.connections(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
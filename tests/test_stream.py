@@ -0,0 +1,129 @@
+import threading
+import time
+import unittest
+
+from zen.fabric.service import Service
+
+from tests.support import TIMEOUT, Fabric
+
+
+class Rows(Service):
+
+    def __init__(self):
+        super(Rows, self).__init__()
+        # Number of rows the container has pulled from the generator
+        self.pulled = 0
+        self.closed = threading.Event()
+
+    def rows(self, count):
+        try:
+            for index in range(count):
+                self.pulled += 1
+                yield { 'index' : index }
+        finally:
+            self.closed.set()
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+        self.rows = Rows()
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def stream(self, client, count, on_item, **options):
+        ''' Start streaming count rows on the loop of client; returns the
+            ResponseStream, and an Event set once it has finished with
+            what finished fired with
+        '''
+        finished = threading.Event()
+
+        def start():
+            stream = client.stream_request({ 'path' : '/rows', 'command' : 'rows', 'args' : { 'count' : count } },
+                                           on_item, **options)
+
+            def done(result):
+                finished.result = result
+                finished.set()
+
+            stream.finished.addBoth(done)
+            # For on_item, which can be called before this returns
+            self.streamed = stream
+            return stream
+
+        return self.fabric.call(client, start), finished
+
+    def test_items_arrive_in_order(self):
+        self.fabric.container({ '/rows' : self.rows }, workers=2)
+        client = self.fabric.client()
+        items = []
+        stream, finished = self.stream(client, 100, items.append, window=4)
+        self.assertTrue(finished.wait(TIMEOUT))
+        self.assertEqual(finished.result, 100)
+        self.assertEqual(items, [{ 'index' : index } for index in range(100)])
+        self.assertTrue(self.rows.closed.wait(TIMEOUT))
+
+    def test_the_container_waits_for_credit(self):
+        self.fabric.container({ '/rows' : self.rows }, workers=2)
+        client = self.fabric.client()
+        # Items being consumed, which hold their credit until they are
+        consuming = []
+
+        def on_item(item):
+            consuming.append(client._new_deferred())
+            return consuming[-1]
+
+        stream, finished = self.stream(client, 100, on_item, window=4)
+        self.fabric.wait_until(lambda: self.fabric.call(client, len, consuming) == 4)
+        time.sleep(0.1)
+        # No more than the window is produced, or sent
+        self.assertEqual(self.rows.pulled, 4)
+        self.assertEqual(self.fabric.call(client, len, consuming), 4)
+
+        def consume():
+            while consuming:
+                consuming.pop(0).callback(None)
+            return stream.count
+
+        while not finished.is_set():
+            self.fabric.call(client, consume)
+            time.sleep(0.005)
+        self.assertEqual(finished.result, 100)
+
+    def test_cancel(self):
+        self.fabric.container({ '/rows' : self.rows }, workers=2)
+        client = self.fabric.client()
+        items = []
+
+        def on_item(item):
+            items.append(item)
+            if len(items) == 5:
+                self.streamed.cancel()
+
+        stream, finished = self.stream(client, 1000, on_item, window=4)
+        self.assertTrue(finished.wait(TIMEOUT))
+        self.assertEqual(finished.result, 5)
+        self.assertTrue(self.rows.closed.wait(TIMEOUT))
+        self.assertLess(self.rows.pulled, 1000)
+
+    def test_streams_without_credit_are_abandoned(self):
+        self.fabric.container({ '/rows' : self.rows }, workers=2, settings={ 'STREAM_TIMEOUT' : 0.1 })
+        client = self.fabric.client()
+        stream, finished = self.stream(client, 100, lambda item: client._new_deferred(), window=4)
+        self.assertTrue(self.rows.closed.wait(TIMEOUT))
+        self.assertEqual(self.rows.pulled, 4)
+
+    def test_containers_without_workers_send_every_item_at_once(self):
+        self.fabric.container({ '/rows' : self.rows })
+        client = self.fabric.client()
+        items = []
+        stream, finished = self.stream(client, 10, items.append, window=4)
+        self.assertTrue(finished.wait(TIMEOUT))
+        self.assertEqual(len(items), 10)
+        self.assertEqual(self.rows.pulled, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
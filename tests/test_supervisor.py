@@ -0,0 +1,59 @@
+import os
+import unittest
+import zmq
+
+from zen.fabric.service import Service
+
+from tests.support import TIMEOUT, Fabric
+
+
+class Process(Service):
+
+    def pid(self):
+        return { 'pid' : os.getpid() }
+
+    def exit(self):
+        os._exit(3)
+
+
+@unittest.skipUnless(zmq.has('ipc') and hasattr(os, 'fork'), 'worker processes need fork and ipc')
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fabric = Fabric()
+        self.container = self.fabric.container({ '/process' : Process() }, processes=2, workers=1)
+        self.client = self.fabric.client()
+
+    def tearDown(self):
+        self.fabric.shutdown()
+
+    def send(self, command, timeout=None):
+        return self.client.send_request({ 'path' : '/process', 'command' : command }, timeout=timeout)
+
+    def pids(self, count):
+        replies = [self.send('pid') for index in range(count)]
+        return set(reply.wait(TIMEOUT)['pid'] for reply in replies)
+
+    def test_worker_processes_answer_the_requests(self):
+        pids = self.pids(20)
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_worker_processes_that_exit_are_restarted(self):
+        before = self.pids(20)
+        self.assertRaises(Exception, self.send('exit', timeout=0.5).wait, TIMEOUT)
+        self.fabric.wait_until(lambda: self.container.metrics.snapshot()['counters'].get('process_restarts'))
+        after = self.pids(20)
+        self.assertEqual(len(after), 2)
+        self.assertEqual(len(before & after), 1)
+
+    def test_socket_files_are_removed(self):
+        self.pids(2)
+        paths = [address[len('ipc://'):] for address in self.container._supervisor._addresses]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.fabric.shutdown()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+if __name__ == '__main__':
+    unittest.main()
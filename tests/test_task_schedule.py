@@ -0,0 +1,75 @@
+import time
+import unittest
+
+from zen.fabric.task_schedule import TaskSchedule
+
+
+class TaskScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schedule = TaskSchedule()
+        self.calls = []
+
+    def test_due_tasks_run_in_time_order(self):
+        self.schedule.call_later(0.01, self.calls.append, 'later')
+        self.schedule.call_later(0, self.calls.append, 'first')
+        self.schedule.call_later(0, self.calls.append, 'second')
+        self.schedule.call_later(60, self.calls.append, 'not yet')
+        time.sleep(0.02)
+        self.schedule.execute()
+        self.assertEqual(self.calls, ['first', 'second', 'later'])
+        self.assertEqual(len(self.schedule), 1)
+
+    def test_cancel(self):
+        task = self.schedule.call_later(0, self.calls.append, 'cancelled')
+        self.schedule.call_later(0, self.calls.append, 'kept')
+        task.cancel()
+        task.cancel()
+        self.assertEqual(len(self.schedule), 1)
+        self.schedule.execute()
+        self.assertEqual(self.calls, ['kept'])
+        self.assertEqual(len(self.schedule), 0)
+
+    def test_cancel_after_firing_does_nothing(self):
+        task = self.schedule.call_later(0, self.calls.append, 'fired')
+        self.schedule.execute()
+        task.cancel()
+        self.assertFalse(task.cancelled)
+        self.assertEqual(len(self.schedule), 0)
+
+    def test_next_timeout(self):
+        self.assertIsNone(self.schedule.next_timeout())
+        task = self.schedule.call_later(0, self.calls.append, 'due')
+        self.schedule.call_later(30, self.calls.append, 'later')
+        self.assertEqual(self.schedule.next_timeout(), 0.0)
+        task.cancel()
+        self.assertTrue(29 < self.schedule.next_timeout() <= 30)
+
+    def test_many_cancelled_tasks_are_dropped(self):
+        tasks = [self.schedule.call_later(60, self.calls.append, index) for index in range(200)]
+        for task in tasks[:150]:
+            task.cancel()
+        self.assertEqual(len(self.schedule), 50)
+        self.assertLess(len(self.schedule._heap), 200)
+
+    def test_deferred_like_tasks(self):
+        class Task(object):
+            def callback(task, result):
+                self.calls.append(result)
+        self.schedule.queue_relative_task(0, Task())
+        self.schedule.execute()
+        self.assertEqual(self.calls, [None])
+
+    def test_tasks_queued_while_executing(self):
+        def reschedule():
+            self.calls.append('outer')
+            self.schedule.call_later(0, self.calls.append, 'inner')
+        self.schedule.call_later(0, reschedule)
+        self.schedule.execute()
+        self.assertEqual(self.calls[0], 'outer')
+        self.schedule.execute()
+        self.assertEqual(self.calls, ['outer', 'inner'])
+
+
+if __name__ == '__main__':
+    unittest.main()
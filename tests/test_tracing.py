@@ -0,0 +1,89 @@
+import time
+import unittest
+import uuid
+
+from zen.fabric import tracing
+from zen.fabric.service import Service
+from zen.fabric.service_container import ServiceContainer
+
+
+class Exporter(tracing.SpanExporter):
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class Outer(Service):
+
+    def call(self):
+        self._container.send_request({ 'path' : '/inner', 'command' : 'get' })
+        return { 'called' : True }
+
+
+class Inner(Service):
+
+    def get(self):
+        return { 'value' : 1 }
+
+
+class SpanTest(unittest.TestCase):
+
+    def test_lap(self):
+        span = tracing.Span(tracing.new_trace_id(), None, 'client', started=tracing.clock() - 1)
+        span.lap('resolve')
+        self.assertTrue(span.timings['resolve'] >= 1)
+        span.end('failed')
+        self.assertEqual(span.to_dict()['error'], 'failed')
+        self.assertEqual(tracing.parse_context(span.context), (span.trace_id, span.span_id))
+
+    def test_parse_context(self):
+        self.assertIsNone(tracing.parse_context('nope'))
+        self.assertIsNone(tracing.parse_context(':span'))
+
+
+class TraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.container = ServiceContainer()
+        self.container.LOCAL_TRANSPORTS = ()
+        self.container.TRACE_SAMPLE_RATE = 1.0
+        self.container.init('inproc://test-tracing-{0}'.format(uuid.uuid4().hex))
+        self.container.register_service(Outer(), '/outer', localOnly=True)
+        self.container.register_service(Inner(), '/inner', localOnly=True)
+        self.exporter = Exporter()
+        self.container.add_span_exporter(self.exporter)
+
+    def tearDown(self):
+        self.container._teardown()
+        self.container._context.destroy(linger=0)
+
+    def test_requests_sent_while_handling_a_request_join_its_trace(self):
+        self.container.send_request({ 'path' : '/outer', 'command' : 'call' })
+        deadline = time.time() + 5
+        while len(self.exporter.spans) < 2 and time.time() < deadline:
+            self.container._poll_once(10)
+        inner, outer = sorted(self.exporter.spans, key=lambda span: span.name)
+        self.assertEqual(inner.name, '/inner get')
+        self.assertIsNone(outer.parent_id)
+        self.assertEqual(inner.trace_id, outer.trace_id)
+        self.assertEqual(inner.parent_id, outer.span_id)
+
+    def test_parent_is_taken_where_the_request_is_sent(self):
+        parent = tracing.Span(tracing.new_trace_id(), None, 'server')
+        previous = tracing.activate(parent)
+        try:
+            self.container.send_request({ 'path' : '/inner', 'command' : 'get' })
+        finally:
+            tracing.activate(previous)
+        deadline = time.time() + 5
+        while not self.exporter.spans and time.time() < deadline:
+            self.container._poll_once(10)
+        self.assertEqual(self.exporter.spans[0].trace_id, parent.trace_id)
+        self.assertEqual(self.exporter.spans[0].parent_id, parent.span_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
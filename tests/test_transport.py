@@ -0,0 +1,46 @@
+import unittest
+import zmq
+
+from zen.fabric import transport
+
+
+class TransportTest(unittest.TestCase):
+
+    def test_endpoint_url(self):
+        self.assertEqual(transport.endpoint_url('localhost:5555'), 'tcp://localhost:5555')
+        self.assertEqual(transport.endpoint_url('ipc:///tmp/zen.ipc'), 'ipc:///tmp/zen.ipc')
+        self.assertEqual(transport.endpoint_url('inproc://zen'), 'inproc://zen')
+
+    def test_transport_of(self):
+        self.assertEqual(transport.transport_of('localhost:5555'), 'tcp')
+        self.assertEqual(transport.transport_of('*'), 'tcp')
+        self.assertEqual(transport.transport_of('ipc:///tmp/zen.ipc'), transport.IPC)
+        self.assertEqual(transport.transport_of('inproc://zen'), transport.INPROC)
+
+    def test_request_address(self):
+        self.assertEqual(transport.request_address('localhost', 5555), 'localhost:5555')
+        self.assertEqual(transport.request_address('inproc://zen'), 'inproc://zen')
+
+    def test_local_address(self):
+        self.assertTrue(transport.local_address(transport.IPC, '/run').startswith('ipc:///run/zen-'))
+        self.assertTrue(transport.local_address(transport.INPROC, '/run').startswith('inproc://zen-'))
+        self.assertNotEqual(transport.local_address(transport.INPROC, '/run'),
+                            transport.local_address(transport.INPROC, '/run'))
+        self.assertRaises(ValueError, transport.local_address, 'tcp', '/run')
+
+    def test_select_address(self):
+        context = zmq.Context()
+        self.addCleanup(context.term)
+        addresses = { 'REQ' : 'remote:5555' }
+        addresses.update(transport.local_addresses({ transport.IPC : 'ipc:///run/zen.ipc',
+                                                     transport.INPROC : 'inproc://zen' }, context))
+        self.assertEqual(transport.select_address(addresses, context), 'inproc://zen')
+        other = zmq.Context()
+        self.addCleanup(other.term)
+        self.assertEqual(transport.select_address(addresses, other), 'ipc:///run/zen.ipc')
+        addresses['HOST'] = 'elsewhere'
+        self.assertEqual(transport.select_address(addresses, other), 'remote:5555')
+
+
+if __name__ == '__main__':
+    unittest.main()